@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Repeatable benchmarks of the event matching code.
+#			Synthetic zentt.conf files (a mix of literal and -re- filters)
+#			and synthetic events (with DeviceGroups and Systems fanned out
+#			across customers, sites and tiers) are generated from a fixed
+#			seed, so every run sees exactly the same work. Each case is run
+#			in a child process so that its peak memory is its own.
+#
+#			The cases for each size are:
+#			  select     - RuleSet.candidates and selectEvent over every section,
+#			               as analyseEvent does
+#			  template   - rendering the ticket command for each matching section
+#			  reference  - configREMatch/configIntMatch on the ConfigParser object,
+#			               for a sample of the events, checking that the
+#			               compiled rules give the same answers
+#
+#			Usage: bench.py [-s 10,100,500,2000] [-e 1000,10000,100000] [-n repeat]
+#			                [-o results.json] [-b baseline.json] [-t tolerance%]
+#
+# Updates:
+#
+
+import os, sys, time, random, platform, resource, ConfigParser, StringIO
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from rules import compileConfig, selectEvent, EventFields, configREMatch, configIntMatch, \
+     FILTER_ORDER, INT_FILTERS, MULTI_VALUED
+from tickets import EventData, TicketData, CommandBackend
+from events import EVENT_FIELDS
+from stats import percentiles
+
+# Seed for the synthetic configs and events. Change it and the results
+# cannot be compared with earlier ones.
+BENCH_SEED = 20120401
+
+DEFAULT_SECTIONS = '10,100,500,2000'
+DEFAULT_EVENTS = '1000,10000,100000'
+
+# Fraction of the optional filters written as -re- options
+DEFAULT_REGEX_SHARE = 0.5
+
+# The reference matching walks the ConfigParser options for every check,
+# so it is only run on enough events for this many section evaluations
+# (and at least REFERENCE_MIN_EVENTS)
+REFERENCE_EVALUATIONS = 20000
+REFERENCE_MIN_EVENTS = 10
+
+# Each case is run this many times and the fastest run kept, as timeit
+# does, so that other work on the machine matters less
+DEFAULT_REPEAT = 3
+
+# Slow-down, in percent, reported as a regression against a baseline
+DEFAULT_TOLERANCE = 10
+
+# Number of customers, each with its own device groups and devices
+CUSTOMERS = 250
+SITES = 4
+
+FUNCTIONS = ('/Function/Web', '/Function/Database', '/Function/Mail', '/Function/Storage', '/Function/Network')
+SYSTEMS = ('/Prod', '/Preprod', '/Dev')
+DEVICE_CLASSES = ('/Server/Linux', '/Server/Windows', '/Network/Router/Cisco', '/Network/Switch', '/Discovered')
+LOCATIONS = ('/UK/London', '/UK/Leeds', '/US/Boston', '/DE/Berlin')
+SUMMARIES = (
+    'threshold of %(a)d exceeded: current value %(b)d',
+    'interface ge-0/0/%(a)d down',
+    'disk /var %(a)d%% full',
+    'ping failed for %(a)d of %(b)d attempts',
+    'Trivial message %(a)d from agent %(b)d',
+)
+SUMMARY_PATTERNS = ('^threshold', 'down$', r'interface (eth|ge-)[0-9/]+ down', 'disk .* full', '^ping failed')
+SEVERITIES = (0, 1, 2, 2, 3, 3, 3, 4, 4, 5)
+PRODSTATES = (1000, 1000, 1000, 500, 300, -1)
+
+TTCOMMAND = "ssh zenoss@%tthost% /usr/local/bin/zenoss-remote-ticket '%evid%' '%device%' " \
+            "'%severity%' '%summary%' '%devicegroups%' '%param-custid%' '%param-queue%'"
+
+
+# An event with all the fields that zentt reads from the status table
+#
+class SyntheticEvent(object):
+    __slots__ = EVENT_FIELDS
+
+    def __init__(self, **fields):
+        for name in EVENT_FIELDS:
+            setattr(self, name, '')
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+
+def customerGroup( c ):
+    return '/Customers/C%03d' % (c)
+
+# Text of a zentt.conf with nsections filter sections
+#
+def syntheticConfig( nsections, share=DEFAULT_REGEX_SHARE, seed=BENCH_SEED ):
+    rng = random.Random(seed)
+    lines = [ '[DAEMONSTUFF]', 'ttcommand: %s' % (TTCOMMAND), 'tthost: tickets.example.com',
+              'cycletime: 60', '' ]
+    for n in range(nsections):
+        c = n % CUSTOMERS
+        lines.append( '[Section %05d]' % (n) )
+        lines.append( 'param-custid: C%03d' % (c) )
+        lines.append( 'param-queue: Level %d' % (rng.randint(1, 3)) )
+        lines.append( 'devicegroups-1: %s' % (customerGroup(c)) )
+        if rng.random() < share:
+            lines.append( 'devicegroups-re-2: ^%s/Site[0-%d]$' % (customerGroup(c), rng.randint(0, SITES - 1)) )
+        else:
+            lines.append( 'devicegroups-2: %s/Site%d' % (customerGroup(c), rng.randint(0, SITES - 1)) )
+        if rng.random() < 0.3:
+            lines.append( 'notdevicegroups-1: %s' % (rng.choice(FUNCTIONS)) )
+        if rng.random() < share:
+            lines.append( 'device-re-1: \\.c%03d\\.example\\.com$' % (c) )
+        if rng.random() < 0.2:
+            lines.append( 'notdevice-re-1: ^test' )
+        if rng.random() < 0.3:
+            lines.append( 'notdeviceclass-1: /Discovered' )
+        if rng.random() < 0.2:
+            lines.append( 'deviceclass-re-1: ^%s' % ('/'.join(rng.choice(DEVICE_CLASSES).split('/')[:2])) )
+        if rng.random() < 0.5:
+            lines.append( 'prodstate-min: 500' )
+        lines.append( 'severity-min: %d' % (rng.randint(2, 5)) )
+        if rng.random() < share:
+            lines.append( 'summary-re-1: %s' % (rng.choice(SUMMARY_PATTERNS)) )
+        if rng.random() < 0.3:
+            lines.append( 'notsummary-1: Trivial' )
+        if rng.random() < 0.3:
+            lines.append( 'systems-1: %s' % (rng.choice(SYSTEMS)) )
+        if rng.random() < 0.1:
+            lines.append( 'location-re-1: ^%s' % ('/'.join(rng.choice(LOCATIONS).split('/')[:2])) )
+        lines.append( '' )
+    return '\n'.join(lines)
+
+def parseConfig( text ):
+    config = ConfigParser.ConfigParser()
+    config.readfp( StringIO.StringIO(text) )
+    return config
+
+# A list of nevents events spread across the customers
+#
+def syntheticEvents( nevents, seed=BENCH_SEED ):
+    rng = random.Random(seed)
+    events = []
+    for n in range(nevents):
+        c = rng.randint(0, CUSTOMERS - 1)
+        groups = [ customerGroup(c), '%s/Site%d' % (customerGroup(c), rng.randint(0, SITES - 1)) ]
+        groups.extend( rng.sample(FUNCTIONS, rng.randint(0, 3)) )
+        systems = [ rng.choice(SYSTEMS) ] + [ '/Tier%d' % (t) for t in range(rng.randint(0, 3)) ]
+        if rng.random() < 0.05:
+            device = 'test%d.c%03d.example.com' % (rng.randint(1, 20), c)
+        else:
+            device = 'host%d.c%03d.example.com' % (rng.randint(1, 200), c)
+        summary = rng.choice(SUMMARIES) % {'a': rng.randint(1, 99), 'b': rng.randint(1, 99)}
+        events.append( SyntheticEvent(
+            evid='%032x' % (rng.getrandbits(128)), device=device, component='eth%d' % (rng.randint(0, 3)),
+            eventClass='/Perf', summary=summary, message=summary, severity=rng.choice(SEVERITIES),
+            eventState=0, prodState=rng.choice(PRODSTATES), count=rng.randint(1, 50),
+            DeviceClass=rng.choice(DEVICE_CLASSES), Location=rng.choice(LOCATIONS),
+            DeviceGroups='|' + '|'.join(groups), Systems='|' + '|'.join(systems),
+            ipAddress='10.%d.%d.%d' % (c % 256, rng.randint(0, 255), rng.randint(1, 254)),
+            ownerid='', DevicePriority=3) )
+    return events
+
+
+# selectEvent as it was before the rules were compiled: every check
+# walks the section's options on the ConfigParser object
+#
+def referenceSelect( config, s, evt ):
+    for prefix, attr in FILTER_ORDER:
+        value = getattr(evt, attr)
+        if prefix in INT_FILTERS:
+            if not configIntMatch( config, s, prefix, value ):
+                return 0
+            continue
+        if attr in MULTI_VALUED:
+            items = value.split('|')
+        else:
+            items = [value]
+        if not configREMatch( config, s, prefix, items, True ):
+            return 0
+        if configREMatch( config, s, 'not' + prefix, items, False ):
+            return 0
+    return 1
+
+
+# Peak resident memory of this process in kilobytes
+#
+def peakMemory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak / 1024
+    return peak
+
+# The figures for one case from the time taken by each event
+#
+def summarise( times, nevents, matches, elapsed ):
+    p50, p90, p99 = percentiles( times )
+    result = {
+        'events': nevents,
+        'matches': matches,
+        'seconds': round(elapsed, 4),
+        'eventsPerSecond': 0,
+        'p50us': round(p50 * 1000000, 2),
+        'p90us': round(p90 * 1000000, 2),
+        'p99us': round(p99 * 1000000, 2),
+        'maxus': round(max(times or [0]) * 1000000, 2),
+        'peakKB': peakMemory(),
+    }
+    if elapsed > 0:
+        result['eventsPerSecond'] = round(nevents / elapsed, 1)
+    return result
+
+def benchSelect( rules, events ):
+    times = []
+    matches = 0
+    clock = time.time
+    start = clock()
+    for evt in events:
+        t = clock()
+        fields = EventFields(evt)
+        for rule in rules.candidates(fields):
+            if selectEvent( rule, evt, fields ):
+                matches += 1
+        times.append( clock() - t )
+    return summarise( times, len(events), matches, clock() - start )
+
+def benchTemplate( rules, events ):
+    backend = CommandBackend( rules.option('ttcommand') )
+    options = rules.daemonOptions
+    matched = []
+    for evt in events:
+        fields = EventFields(evt)
+        found = [ rule for rule in rules.candidates(fields) if selectEvent( rule, evt, fields ) ]
+        if found:
+            matched.append( (evt, found) )
+    times = []
+    matches = 0
+    clock = time.time
+    start = clock()
+    for evt, found in matched:
+        t = clock()
+        eventData = EventData(evt)
+        for rule in found:
+            backend.prepare( TicketData( eventData, rule.params, options ) )
+            matches += 1
+        times.append( clock() - t )
+    return summarise( times, len(matched), matches, clock() - start )
+
+def benchReference( config, rules, events ):
+    sections = [ rule.name for rule in rules.sections ]
+    events = events[:max(REFERENCE_MIN_EVENTS, REFERENCE_EVALUATIONS / max(1, len(sections)))]
+    times = []
+    matches = 0
+    # (evid, section) for every match
+    reference = set()
+    clock = time.time
+    start = clock()
+    for evt in events:
+        t = clock()
+        for s in sections:
+            if referenceSelect( config, s, evt ):
+                matches += 1
+                reference.add( (evt.evid, s) )
+        times.append( clock() - t )
+    result = summarise( times, len(events), matches, clock() - start )
+
+    # The compiled rules, with the pre-filter, must match exactly the
+    # same sections for each event as the reference
+    compiled = set()
+    for evt in events:
+        fields = EventFields(evt)
+        for rule in rules.candidates(fields):
+            if selectEvent( rule, evt, fields ):
+                compiled.add( (evt.evid, rule.name) )
+    result['agrees'] = (compiled == reference)
+    if not result['agrees']:
+        result['disagreement'] = firstDisagreement( events, sections, reference, compiled )
+    return result
+
+# Describe the first (event, section) on which the compiled rules and
+# the reference do not agree
+#
+def firstDisagreement( events, sections, reference, compiled ):
+    for evt in events:
+        for s in sections:
+            pair = (evt.evid, s)
+            if (pair in reference) != (pair in compiled):
+                if pair in reference:
+                    return 'event %s section %s: reference matches, compiled rules do not' % pair
+                return 'event %s section %s: compiled rules match, reference does not' % pair
+
+CASES = ('select', 'template', 'reference')
+
+def runCase( case, nsections, nevents, share ):
+    text = syntheticConfig( nsections, share )
+    config = parseConfig( text )
+    rules = compileConfig( config )
+    events = syntheticEvents( nevents )
+    if case == 'select':
+        return benchSelect( rules, events )
+    if case == 'template':
+        return benchTemplate( rules, events )
+    return benchReference( config, rules, events )
+
+# Run a case in a child process and return its figures
+#
+def forkCase( case, nsections, nevents, share ):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 0
+        try:
+            try:
+                result = runCase( case, nsections, nevents, share )
+            except Exception as e:
+                result = {'error': str(e)}
+                status = 1
+            os.write(w, json.dumps(result))
+        finally:
+            os._exit(status)
+    os.close(w)
+    chunks = []
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk: break
+        chunks.append( chunk )
+    os.close(r)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(chunks))
+
+# Run the cases for every combination of sizes
+# Returns the results in the form saved by --output
+#
+def runBenchmarks( sections, events, cases=CASES, share=DEFAULT_REGEX_SHARE, repeat=DEFAULT_REPEAT, report=None ):
+    results = []
+    for nsections in sections:
+        for nevents in events:
+            for case in cases:
+                result = None
+                for n in range(repeat):
+                    run = forkCase( case, nsections, nevents, share )
+                    if 'error' in run:
+                        result = run
+                        break
+                    if result is None or run['eventsPerSecond'] > result['eventsPerSecond']:
+                        result = run
+                result.update( {'case': case, 'sections': nsections, 'totalEvents': nevents} )
+                results.append( result )
+                if report is not None:
+                    report( result )
+    return {
+        'seed': BENCH_SEED,
+        'regexShare': share,
+        'repeat': repeat,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': results,
+    }
+
+def caseKey( result ):
+    return (result['case'], result['sections'], result['totalEvents'])
+
+def formatResult( result ):
+    if 'error' in result:
+        return '%-9s %6d %7d  failed: %s' % (result['case'], result['sections'], result['totalEvents'], result['error'])
+    line = '%-9s %6d %7d %12.1f %10.1f %10.1f %10.1f %10d' % (result['case'], result['sections'],
+               result['totalEvents'], result['eventsPerSecond'], result['p50us'], result['p90us'],
+               result['p99us'], result['peakKB'])
+    if result.get('agrees') is False:
+        line += '  COMPILED RULES DISAGREE: %s' % (result.get('disagreement'))
+    return line
+
+RESULT_HEADING = '%-9s %6s %7s %12s %10s %10s %10s %10s' % ('case', 'sects', 'events', 'events/s',
+                                                          'p50 us', 'p90 us', 'p99 us', 'peak KB')
+
+# Lines comparing events/s and p99 latency against an earlier run.
+# Returns the lines and the number of regressions beyond tolerance.
+#
+def compareResults( baseline, current, tolerance=DEFAULT_TOLERANCE ):
+    lines = []
+    regressions = 0
+    if baseline.get('seed') != current.get('seed') or baseline.get('regexShare') != current.get('regexShare'):
+        lines.append( 'Baseline used different synthetic data - results are not comparable' )
+        return lines, 0
+    old = {}
+    for result in baseline['results']:
+        old[caseKey(result)] = result
+    for result in current['results']:
+        before = old.get(caseKey(result))
+        if before is None or 'error' in result or 'error' in before or not before['eventsPerSecond']:
+            continue
+        speed = 100.0 * (result['eventsPerSecond'] - before['eventsPerSecond']) / before['eventsPerSecond']
+        mark = ''
+        if speed < -tolerance:
+            mark = '  REGRESSION'
+            regressions += 1
+        lines.append( '%-9s %6d %7d  events/s %+6.1f%%  p99 %10.1f -> %10.1f us%s' %
+                      (result['case'], result['sections'], result['totalEvents'], speed,
+                       before['p99us'], result['p99us'], mark) )
+    return lines, regressions
+
+
+def intList( text ):
+    return [ int(n) for n in text.split(',') if n.strip() ]
+
+def main( argv ):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--sections', dest='sections', default=DEFAULT_SECTIONS,
+                      help="numbers of config sections, comma separated (default %default)")
+    parser.add_option('-e', '--events', dest='events', default=DEFAULT_EVENTS,
+                      help="numbers of events, comma separated (default %default)")
+    parser.add_option('-c', '--cases', dest='cases', default=','.join(CASES),
+                      help="cases to run (default %default)")
+    parser.add_option('-r', '--regex-share', dest='share', type='float', default=DEFAULT_REGEX_SHARE,
+                      help="fraction of optional filters that are regexes (default %default)")
+    parser.add_option('-n', '--repeat', dest='repeat', type='int', default=DEFAULT_REPEAT,
+                      help="runs of each case, keeping the fastest (default %default)")
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help="save the results as JSON in this file")
+    parser.add_option('-b', '--baseline', dest='baseline', default=None,
+                      help="compare with results saved by an earlier run")
+    parser.add_option('-t', '--tolerance', dest='tolerance', type='float', default=DEFAULT_TOLERANCE,
+                      help="percent slow-down reported as a regression (default %default)")
+    options, args = parser.parse_args(argv[1:])
+    cases = [ case.strip() for case in options.cases.split(',') ]
+    for case in cases:
+        if case not in CASES:
+            parser.error("unknown case %s" % (case))
+
+    def report( result ):
+        print formatResult( result )
+        sys.stdout.flush()
+
+    print RESULT_HEADING
+    current = runBenchmarks( intList(options.sections), intList(options.events), cases, options.share,
+                             max(1, options.repeat), report )
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(current, f, indent=1)
+        finally:
+            f.close()
+
+    if options.baseline:
+        f = open(options.baseline, 'r')
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        lines, regressions = compareResults( baseline, current, options.tolerance )
+        print
+        print 'Compared with %s (%s):' % (options.baseline, baseline.get('date'))
+        for line in lines:
+            print line
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
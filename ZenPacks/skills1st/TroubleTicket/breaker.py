@@ -0,0 +1,206 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Circuit breakers for the ticket backends. After a run of
+#			failures a backend is taken out of use for a while, so that
+#			an outage of the ticket host does not make every event wait
+#			for a connect timeout. Its events are held back, untouched,
+#			and one ticket at a time is let through as a probe until the
+#			backend works again.
+#
+# Updates:
+#
+
+import time, threading, logging
+
+logger = logging.getLogger('ZenTT')
+
+# Defaults for the DAEMONSTUFF breaker options
+DEFAULT_BREAKERFAILURES = 5
+DEFAULT_BREAKERPROBE = 60
+
+# Breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALFOPEN = 'half-open'
+
+
+# The breaker for one backend. It opens after failures tickets in a row
+# have failed (never if failures is 0). While open, a probe ticket is let
+# through every probetime seconds: if it works the breaker closes again.
+# allow(), succeeded() and failed() are called by the ticket workers.
+#
+class CircuitBreaker(object):
+    def __init__(self, name, failures=DEFAULT_BREAKERFAILURES, probetime=DEFAULT_BREAKERPROBE):
+        self.name = name
+        self.failures = failures
+        self.probetime = probetime
+        self.state = CLOSED
+        # Failures in a row, and when the next probe may be sent
+        self.nfailed = 0
+        self.nextProbe = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    # Should tickets for this backend be held back rather than tried?
+    def isOpen(self, now=None):
+        if self.state == CLOSED:
+            return False
+        if now is None:
+            now = time.time()
+        return self.state == HALFOPEN or now < self.nextProbe
+
+    # May a ticket be tried now? While the breaker is open only one
+    # probe is allowed each probetime.
+    def allow(self, now=None):
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and now >= self.nextProbe:
+                self.state = HALFOPEN
+                logger.info( "Trying ticket backend %s again" % (self.name) )
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def succeeded(self, now=None):
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            if self.state != CLOSED:
+                logger.warning( "Ticket backend %s is working again after %.0f seconds - circuit closed"
+                                % (self.name, now - self.opened) )
+                self.opened = None
+            self.state = CLOSED
+            self.nfailed = 0
+        finally:
+            self.lock.release()
+
+    def failed(self, now=None):
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            self.nfailed += 1
+            if self.state == HALFOPEN:
+                self.state = OPEN
+                self.nextProbe = now + self.probetime
+                logger.info( "Ticket backend %s is still failing - next try in %d seconds"
+                             % (self.name, self.probetime) )
+            elif self.state == CLOSED and self.failures > 0 and self.nfailed >= self.failures:
+                self.state = OPEN
+                self.opened = now
+                self.nextProbe = now + self.probetime
+                logger.error( "Ticket backend %s has failed %d times in a row - circuit opened, "
+                              "holding back its tickets and trying again every %d seconds"
+                              % (self.name, self.nfailed, self.probetime) )
+        finally:
+            self.lock.release()
+
+
+# The breakers for all the configured backends, by ttbackend name,
+# and the events held back while a breaker is open (oldest first).
+# Held events are only looked at by the main thread.
+#
+class BreakerSet(object):
+    def __init__(self):
+        self.breakers = {}
+        self.backends = None
+        # evids held back, oldest first, the backend name holding each
+        # back, and the lastTime of each (where known)
+        self.held = []
+        self.heldBy = {}
+        self.lastTimes = {}
+
+    # Follow a new BackendSet and breaker settings. Breakers keep their
+    # state over a reload; those of backends that have gone are dropped,
+    # which lets their events go.
+    def configure(self, backends, failures=DEFAULT_BREAKERFAILURES, probetime=DEFAULT_BREAKERPROBE):
+        self.backends = backends
+        breakers = {}
+        for name in backends.backends:
+            breaker = self.breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker( name, failures, probetime )
+            breaker.failures = failures
+            breaker.probetime = probetime
+            breakers[name] = breaker
+        self.breakers = breakers
+
+    def __len__(self):
+        return len(self.held)
+
+    def isHeld(self, evid):
+        return evid in self.heldBy
+
+    # The breaker for a backend object, or None if it is not configured
+    def forBackend(self, backend):
+        try:
+            return self.breakers.get( self.backends.nameOf(backend) )
+        except KeyError:
+            return None
+
+    # The name of the first of these backends whose breaker is open, or None
+    def blocking(self, backends, now=None):
+        for backend in backends:
+            breaker = self.forBackend(backend)
+            if breaker is not None and breaker.isOpen(now):
+                return breaker.name
+        return None
+
+    # When a backend's breaker will next let a ticket through
+    def nextTry(self, name):
+        breaker = self.breakers.get(name)
+        if breaker is None or breaker.state == CLOSED:
+            return time.time()
+        return breaker.nextProbe
+
+    def hold(self, evid, name, lastTime=None):
+        if evid not in self.heldBy:
+            self.held.append( evid )
+        self.heldBy[evid] = name
+        if lastTime is not None:
+            self.lastTimes[evid] = lastTime
+
+    # The lastTime of the oldest held event, or None. Held events are not
+    # saved, so the poll watermark must not pass this.
+    def oldestTime(self):
+        if not self.lastTimes:
+            return None
+        return min(self.lastTimes.values())
+
+    # The held evids that can be tried again now, oldest first: all of
+    # those whose backend works again, and one as a probe for each open
+    # breaker whose probe is due. The rest stay held.
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        held = [ (evid, self.heldBy[evid], self.lastTimes.get(evid)) for evid in self.held ]
+        self.held = []
+        self.heldBy = {}
+        self.lastTimes = {}
+        probes = set()
+        due = []
+        for evid, name, lastTime in held:
+            breaker = self.breakers.get(name)
+            if breaker is not None and breaker.state != CLOSED:
+                if breaker.isOpen(now) or name in probes:
+                    self.hold( evid, name, lastTime )
+                    continue
+                probes.add(name)
+            due.append( evid )
+        return due
+
+    # Log how many events are waiting, for which backends
+    def log(self):
+        if not self.held:
+            return
+        counts = {}
+        for name in self.heldBy.values():
+            counts[name] = counts.get(name, 0) + 1
+        logger.warning( "Ticket backends out of use are holding back %d events: %s" % (len(self.held),
+                        ', '.join([ '%s: %d' % (name, n) for name, n in sorted(counts.items()) ])) )
@@ -0,0 +1,167 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Memory of events that have already been looked at and
+#			needed nothing doing: no ticket and no AUTOCLEAR.
+#			Each is remembered with a fingerprint of the fields the
+#			filters use, so an event is only looked at again if one of
+#			those has changed or the config file has been changed.
+#			The oldest entries are forgotten once the cache is full.
+#
+# Updates:
+#
+
+import os, hashlib, logging
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from rules import FILTER_ORDER
+
+logger = logging.getLogger('ZenTT')
+
+DEFAULT_CACHESIZE = 100000
+
+# Event fields that decide whether any filter section or AUTOCLEAR
+# selects an event. stateChange and count are included so that anything
+# Zenoss does to the event makes it be looked at again.
+FINGERPRINT_FIELDS = ['stateChange', 'count'] + [ attr for prefix, attr in FILTER_ORDER ]
+
+# The fingerprint is saved with the cache, so it must come out the same
+# in every run: an MD5 digest of the fields' text, not hash(), which
+# changes when hash randomization is turned on. Each value is turned into
+# text the same way whatever its type (int or long, str or unicode, or
+# something like a Zope DateTime that only its text identifies).
+#
+def fieldText( value ):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def fingerprint( evt ):
+    values = [ fieldText( getattr(evt, attr, None) ) for attr in FINGERPRINT_FIELDS ]
+    return hashlib.md5( '\0'.join(values) ).hexdigest()
+
+
+# Least-recently-used map of evid -> fingerprint.
+# Entries are kept in a circular doubly-linked list of [prev, next, evid]
+# cells, most recently used at the end, so that lookups, updates and
+# evictions all take constant time.
+#
+class EventCache(object):
+    def __init__(self, size=DEFAULT_CACHESIZE, generation='', statefile=None):
+        self.size = size
+        self.generation = generation
+        self.statefile = statefile
+        self.hits = 0
+        self.clear()
+        if statefile:
+            self.load()
+
+    def clear(self):
+        self.root = []
+        self.root[:] = [self.root, self.root, None]
+        # evid -> (cell, fingerprint)
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def unlink(self, cell):
+        prev, next = cell[0], cell[1]
+        prev[1] = next
+        next[0] = prev
+
+    def append(self, cell):
+        last = self.root[0]
+        cell[0] = last
+        cell[1] = self.root
+        last[1] = cell
+        self.root[0] = cell
+
+    # True if the event has been seen before with the same fingerprint
+    def unchanged(self, evt):
+        entry = self.entries.get(evt.evid)
+        if entry is None:
+            return False
+        cell, fp = entry
+        if fp != fingerprint(evt):
+            return False
+        self.unlink(cell)
+        self.append(cell)
+        self.hits += 1
+        return True
+
+    # Remember an event that needs nothing doing
+    def add(self, evt):
+        if self.size <= 0:
+            return
+        self.put(evt.evid, fingerprint(evt))
+
+    def put(self, evid, fp):
+        entry = self.entries.get(evid)
+        if entry is not None:
+            cell = entry[0]
+            self.unlink(cell)
+        else:
+            cell = [None, None, evid]
+            while self.entries and len(self.entries) >= self.size:
+                oldest = self.root[1]
+                self.unlink(oldest)
+                del self.entries[oldest[2]]
+        self.append(cell)
+        self.entries[evid] = (cell, fp)
+
+    # Forget an event, e.g. because a ticket is now wanted for it
+    def discard(self, evid):
+        entry = self.entries.pop(evid, None)
+        if entry is not None:
+            self.unlink(entry[0])
+
+    # The rules have changed, so nothing we remember can be trusted
+    def setGeneration(self, generation):
+        if generation != self.generation:
+            self.generation = generation
+            self.clear()
+
+    # Entries from oldest to most recently used
+    def items(self):
+        cell = self.root[1]
+        while cell is not self.root:
+            yield cell[2], self.entries[cell[2]][1]
+            cell = cell[1]
+
+    # Read the entries saved by a previous run, if the config is the same
+    def load(self):
+        try:
+            f = open(self.statefile, 'r')
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return
+        if state.get('generation') != self.generation:
+            return
+        for evid, fp in state.get('entries', []):
+            self.put(str(evid), str(fp))
+        logger.info("Loaded %d evaluated events from %s" % (len(self.entries), self.statefile))
+
+    def save(self):
+        if not self.statefile:
+            return
+        state = {
+            'generation': self.generation,
+            'entries': list(self.items()),
+        }
+        tmpfile = self.statefile + '.tmp'
+        try:
+            f = open(tmpfile, 'w')
+            try:
+                json.dump(state, f)
+            finally:
+                f.close()
+            os.rename(tmpfile, self.statefile)
+        except (IOError, OSError) as e:
+            logger.warning("Cannot save evaluated events to %s: %s" % (self.statefile, e))
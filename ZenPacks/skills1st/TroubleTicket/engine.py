@@ -0,0 +1,513 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		The work of one zentt cycle: poll for new and changed events,
+#			compare them against the filter sections, create tickets and
+#			write the results back to Zenoss. It needs only an object with
+#			the ZenEventManager methods that zentt uses, so it is driven
+#			both by the daemon and by the offline replay.
+#
+# Updates:
+#
+
+import os, time, logging
+from rules import selectEvent, EventFields
+from poller import EventPoller, eventTime
+from events import fetchEvents, fetchDetails
+from writer import StatusWriter
+from tickets import TicketJob, TicketPool, EventData, TicketData
+from outbox import Outbox
+from cache import EventCache
+from stats import CycleStats, timed, writeStats
+from explain import RuleProfiler
+from ratelimit import RateLimiter
+from breaker import BreakerSet
+
+logger = logging.getLogger('ZenTT')
+
+# Function to analyse an event and possibly create a troubleticket
+# The tickets are created by the pool in the background; the number of
+# sections that want a ticket is returned (0 if none).
+# select is the function that applies a section's filters to the event.
+# If the rate limiter says the tickets must wait, the event is deferred
+# rather than sent to the pool. If the backend for its first ticket (with
+# multi-ticket, for any of them) is out of use, the event is held by breakers.
+def analyseEvent( rules, backends, pool, evt, stats=None, select=selectEvent, limiter=None, breakers=None ):
+    logger.debug( "analyseEvent" )
+
+    # We are only interested in new events
+    if evt.eventState != 0:
+        return 0
+
+    # Do we want to allow the creation of multiple tickets for a single event?
+    multiTicket = rules.multiTicket
+    logger.debug( "multiTicket: %d", multiTicket )
+
+    # Log a warning if a device does not belong to any groups.
+    if not evt.DeviceGroups.replace('|',''):
+        logger.warning("Device %s is not in a device group in event %s" % (evt.device, evt.evid))
+
+    # Prepare the event attributes once for all the sections
+    fields = EventFields(evt)
+    eventData = EventData(evt)
+
+    requests = []
+    # The rate limit buckets for each request
+    limits = []
+
+    # Consider each section in the config file in turn
+    # Do this in alphabetical order, ignoring case
+    # (the rule set holds them in that order, without DAEMONSTUFF and AUTOCLEAR)
+    # Sections whose severity, eventstate or prodstate filters cannot
+    # accept this event are skipped without being looked at.
+    for rule in rules.candidates(fields):
+        logger.debug( "## Section %s" % (rule.name) )
+
+        # Compare event against filters - do we want it?
+        if not select( rule, evt, fields ):
+            continue
+
+        logger.debug( "creating ticket" )
+        if stats is not None:
+            stats.matched( rule.name )
+
+        # The things we might want to substitute: event data, then the
+        # 'param-*' options from the current section, then DAEMONSTUFF options.
+        # Only the values the backend's templates refer to are looked up.
+        data = TicketData( eventData, rule.params, rules.daemonOptions )
+
+        # Let the section's backend substitute the data into its command or request
+        backend = backends.forRule( rule )
+        payload = backend.prepare( data )
+
+        # Without multi-ticket all the matching sections are still passed on:
+        # the later ones are tried in order if the first ticket fails.
+        requests.append( (rule.name, backend, payload) )
+        if limiter is not None:
+            limits.append( limiter.keys( rule, data, backends.nameOf(backend) ) )
+
+    if requests:
+        if breakers is not None:
+            if multiTicket:
+                tried = requests
+            else:
+                tried = requests[:1]
+            name = breakers.blocking([ backend for section, backend, payload in tried ])
+            if name is not None:
+                logger.debug( "Event %s held while ticket backend %s is out of use" % (evt.evid, name) )
+                breakers.hold( evt.evid, name, eventTime(evt.lastTime) )
+                if stats is not None:
+                    stats.count( 'eventsHeld' )
+                return len(requests)
+        if limiter is not None and not limiter.allow( evt.evid, limits, multiTicket,
+                                                      lastTime=eventTime(evt.lastTime) ):
+            logger.debug( "Event %s deferred by rate limits" % (evt.evid) )
+            if stats is not None:
+                stats.count( 'eventsDeferred' )
+            return len(requests)
+        pool.submit( TicketJob( evt, requests, multiTicket ) )
+
+    return len(requests)
+
+# Record the outcome of a finished TicketJob
+# Failed requests are put in the outbox to be retried later.
+# If nothing was tried because of an open circuit breaker, the event is
+# left untouched and held by breakers (or its retry put off).
+# Returns the number of tickets created, or -1 if any creation failed
+def recordTickets( writer, outbox, backends, job, stats=None, breakers=None ):
+    evt = job.evt
+    ntickets = 0
+    ticketerror = 0
+    lasterror = None
+    done = set()
+
+    if stats is not None:
+        for seconds in job.latencies:
+            stats.ticketLatency( seconds )
+
+    for section, ticket, errmsg in job.results:
+        if ticket is None:
+            logger.error( "Ticket creation failed for %s: %s" % (evt.evid, errmsg) )
+            if stats is not None:
+                stats.count( 'ticketsFailed' )
+            ticketerror = 1
+            lasterror = errmsg
+            continue
+
+        ntickets += 1
+        done.add(section)
+        if stats is not None:
+            stats.count( 'ticketsCreated' )
+
+        logger.info("Ticket %s created for event %s" % (ticket, evt.evid))
+
+        # If ticket was successfully created, acknowledge the event in Zenoss.
+        # The writes are grouped with those for other events and done later.
+        writer.ticketCreated(evt.evid, ticket)
+
+    # Nothing was done, so there is nothing to retry or mark as failed
+    if job.held and not ntickets and (not ticketerror or not job.multiTicket):
+        name = backends.nameOf( job.held[0][1] )
+        if job.retry:
+            outbox.postpone( evt.evid, breakers.nextTry(name) )
+        else:
+            breakers.hold( evt.evid, name, eventTime(evt.lastTime) )
+        if stats is not None:
+            stats.count( 'eventsHeld' )
+        return 0
+    if job.held and lasterror is None:
+        lasterror = "Ticket backend %s is out of use" % (backends.nameOf( job.held[0][1] ))
+
+    # Work out what is left to do: with multi-ticket, the sections that
+    # did not get a ticket (including any held back); otherwise all of
+    # them if no ticket was created
+    if not ticketerror and not job.held:
+        retry = []
+    elif job.multiTicket:
+        retry = [ r for r in job.requests if r[0] not in done ]
+    elif ntickets:
+        retry = []
+    else:
+        retry = job.requests
+
+    if retry:
+        outbox.failed( evt.evid, [ (section, backends.nameOf(backend), payload)
+                                   for section, backend, payload in retry ],
+                       job.multiTicket, lasterror )
+    elif job.retry:
+        outbox.remove( evt.evid )
+
+    # If this event has not errored before, we need to update the message
+    if ticketerror and not ntickets and ('FAILED' not in evt.ownerid):
+        writer.ticketFailed(evt.evid)
+
+    if ticketerror: return -1
+
+    # We did it!
+    return ntickets
+
+
+# Everything that lasts from one cycle to the next: the poll position,
+# pending writes, the ticket workers, the outbox and the cache.
+# State files are kept in vardir, named after name (e.g. zentt-poll.state).
+# In sharded mode shard is the part of the events that this process owns.
+# makePool(size, breakers) makes the pool that runs the TicketJobs.
+#
+class TicketEngine(object):
+    def __init__(self, zem, config, vardir, name='zentt', shard=None, makePool=TicketPool):
+        self.zem = zem
+        self.makePool = makePool
+        self.config = config
+        self.shard = shard
+        self.share = 1
+        if shard is not None:
+            self.share = shard.count
+        self.statefile = os.path.join(vardir, name + '-poll.state')
+        self.outboxfile = os.path.join(vardir, name + '-outbox.db')
+        self.cachefile = os.path.join(vardir, name + '-cache.state')
+        self.statsfile = os.path.join(vardir, name + '-stats.json')
+        self.profilefile = os.path.join(vardir, name + '-profile.json')
+
+        # Only fetch events that are new or changed since the last cycle
+        self.poller = EventPoller( zem, self.statefile, config.resynctime, config.generation, shard )
+
+        # Remember the events that needed nothing doing, so that they are
+        # not filtered again unless they change
+        self.cache = EventCache( config.cachesize, config.generation,
+                                 config.persistcache and self.cachefile or None )
+
+        # Event acks and ownerid changes are collected and written in groups
+        self.writer = StatusWriter( zem, config.writebatch )
+
+        # A circuit breaker per ticket backend, and the events held back
+        # while a backend is out of use
+        self.breakers = BreakerSet()
+        self.breakers.configure( config.backends, config.breakerFailures, config.breakerProbe )
+
+        # Ticket commands run in the background, several at a time
+        self.pool = makePool( config.concurrency, self.breakers )
+
+        # Failed tickets are kept on disk and retried with increasing delays
+        self.outbox = Outbox( self.outboxfile, config.retrytime, config.retrymax, config.retrylimit,
+                              config.generation )
+
+        # Figures for 'zentt stats': the last cycle and totals since we started
+        self.started = time.time()
+        self.ncycles = 0
+        self.totals = CycleStats()
+        self.stats = CycleStats()
+        # Figures for tickets that finish between cycles (with the event
+        # loop), added to the next cycle's, and the tickets created since
+        # the last cycle's summary was logged
+        self.between = CycleStats()
+        self.inCycle = False
+        self.ncreated = 0
+
+        # Time and rejections per section and filter, if the profile option is set
+        self.profiler = RuleProfiler()
+
+        # Token buckets per ticket target and section, and the events they hold back
+        self.limiter = RateLimiter()
+        self.limiter.configure( config.targetRate, config.targetBurst, config.ratelimitKey, config.rules.sections,
+                                self.share )
+
+        # If set, trace.event(evt, seconds) is called for each event evaluated
+        # and trace.job(job) for each finished TicketJob (used by the replay)
+        self.trace = None
+
+    # Switch to a new version of the config file between cycles
+    def reconfigure(self, config):
+        # Let any tickets still in progress finish with the old backends
+        for job in self.pool.wait():
+            self.finished( job )
+        self.config.backends.close()
+        self.config = config
+        self.poller.resynctime = config.resynctime
+        self.writer.writebatch = config.writebatch
+        self.outbox.retrytime = config.retrytime
+        self.outbox.retrymax = config.retrymax
+        self.outbox.retrylimit = config.retrylimit
+        self.cache.size = config.cachesize
+        self.cache.statefile = config.persistcache and self.cachefile or None
+        self.limiter.configure( config.targetRate, config.targetBurst, config.ratelimitKey, config.rules.sections,
+                                self.share )
+        self.breakers.configure( config.backends, config.breakerFailures, config.breakerProbe )
+        if config.concurrency != self.pool.size:
+            self.pool.stop()
+            self.pool = self.makePool( config.concurrency, self.breakers )
+
+        # Old events may be wanted by the new rules, so look at them all again
+        if config.generation != self.poller.generation:
+            self.poller.generation = config.generation
+            self.poller.reset()
+            self.cache.setGeneration( config.generation )
+            self.outbox.clearGivenUp( config.generation )
+
+    # Record a finished TicketJob
+    # Returns the number of tickets created
+    def finished(self, job):
+        if self.trace is not None:
+            self.trace.job( job )
+        stats = self.stats
+        if not self.inCycle:
+            stats = self.between
+        created = recordTickets( self.writer, self.outbox, self.config.backends, job, stats, self.breakers )
+        if created > 0:
+            self.ncreated += created
+            return created
+        return 0
+
+    # Look at one event: create its tickets, or else clear it if it
+    # matches AUTOCLEAR, or else remember that it needed nothing doing
+    def evaluate(self, evt, select):
+        rules = self.config.rules
+        if self.trace is not None:
+            evalStart = time.time()
+
+        # Create a ticket for all new events that match defined criteria
+        tt = analyseEvent( rules, self.config.backends, self.pool, evt, self.stats, select,
+                           self.limiter, self.breakers )
+
+        # If no section wanted a ticket then we may want to clear the event
+        if ((tt == 0) and rules.autoclear):
+            # If no ticket was created then consider clearing the event
+            logger.debug( "Checking AUTOCLEAR" )
+
+            if select( rules.autoclear, evt ):
+                logger.debug( "Clearing event %s" % (evt.evid) )
+
+                self.writer.clearEvent(evt.evid)
+                tt = -1
+
+        if tt == 0:
+            self.cache.add(evt)
+
+        if self.trace is not None:
+            self.trace.event( evt, time.time() - evalStart )
+
+    # Look again at the events that the rate limits or the circuit
+    # breakers held back, oldest first. Those that have gone or been
+    # acknowledged are forgotten. Events whose bucket is still empty, or
+    # whose backend is still out of use, are not fetched at all.
+    # Returns the number looked at.
+    def evaluateDeferred(self, select):
+        evids = self.limiter.due() + self.breakers.due()
+        nlooked = 0
+        for start in range(0, len(evids), self.config.fetchsize):
+            page = evids[start:start+self.config.fetchsize]
+            records = fetchDetails( self.zem, page )
+            for evid in page:
+                evt = records.get(evid)
+                if evt is None or evt.eventState != 0:
+                    continue
+                if self.writer.isPending(evid) or self.pool.isBusy(evid) or self.outbox.contains(evid):
+                    continue
+                nlooked += 1
+                self.evaluate( evt, select )
+        return nlooked
+
+    # The lastTime that the poll watermark must not pass, or None: that of
+    # the oldest event deferred by the rate limits, held while its ticket
+    # backend is out of use or, if the cycle did not wait for its tickets,
+    # with tickets still in progress. Those events
+    # are only kept in memory, so are found again after a restart by
+    # polling from there.
+    def watermarkLimit(self, wait=True):
+        times = [ self.limiter.oldestTime(), self.breakers.oldestTime() ]
+        if not wait:
+            times.append( self.pool.oldestTime() )
+        times = [ t for t in times if t is not None ]
+        if not times:
+            return None
+        return min(times)
+
+    # Run one cycle. Returns the number of events that had to be looked at.
+    # If wait is False the cycle does not wait for its tickets: they are
+    # collected as they finish by whatever is driving the engine.
+    def runCycle(self, wait=True):
+        config = self.config
+        backends = config.backends
+        writer = self.writer
+        pool = self.pool
+        outbox = self.outbox
+        cache = self.cache
+
+        # Keep track of how many events we have had to look at
+        nlooked = 0
+        stats = self.stats = CycleStats()
+        stats.merge( self.between )
+        self.between = CycleStats()
+        self.inCycle = True
+        cycleStart = time.time()
+        if config.profile:
+            select = self.profiler.select
+        else:
+            select = selectEvent
+
+        # Retry the failed tickets that are due, whatever the scan finds
+        start = time.time()
+        for job in outbox.dueJobs( self.zem, backends ):
+            if pool.isBusy(job.evt.evid):
+                continue
+            # After a change in the number of shards the event may now belong
+            # to another worker, which will see it as a new event
+            if self.shard is not None and not self.shard.owns(job.evt):
+                logger.info( "Event %s now belongs to another worker - dropping its ticket retry" % (job.evt.evid) )
+                outbox.remove( job.evt.evid )
+                continue
+            # Wait without using up an attempt while the backend is out of use
+            tried = job.requests
+            if not job.multiTicket:
+                tried = tried[:1]
+            name = self.breakers.blocking([ backend for section, backend, payload in tried ])
+            if name is not None:
+                outbox.postpone( job.evt.evid, self.breakers.nextTry(name) )
+                continue
+            pool.submit( job )
+            stats.count( 'ticketRetries' )
+        stats.addTime( 'fetchTime', time.time() - start )
+
+        # Then the events held back by the rate limits and breakers, before any new ones
+        start = time.time()
+        nlooked += self.evaluateDeferred( select )
+        stats.addTime( 'evaluateTime', time.time() - start )
+
+        start = time.time()
+        events = self.poller.poll()
+        stats.addTime( 'pollTime', time.time() - start )
+        stats.count( 'eventsPolled', len(events) )
+
+        # Events to create new tickets for.....
+        # Ticket creation cycle begins here.
+        # The details are fetched a page of events at a time.
+        # The time spent on the events themselves is whatever is
+        # left after fetching them and any early database writes.
+        loopStart = time.time()
+        fetchTime = stats.times['fetchTime']
+        writeTime = writer.writeTime
+        for evt in timed( fetchEvents( self.zem, events, config.fetchsize ), stats, 'fetchTime' ):
+
+            stats.count( 'eventsFetched' )
+
+            logger.debug( "#### Event %s" % (evt.evid) )
+
+            # Leave it alone until our earlier work on it has been finished
+            # (tickets waiting to be retried are left to the outbox, and
+            # events held back by the rate limits or breakers to them)
+            if writer.isPending(evt.evid) or pool.isBusy(evt.evid) or outbox.contains(evt.evid) \
+                    or self.limiter.isDeferred(evt.evid) or self.breakers.isHeld(evt.evid):
+                logger.debug( "Event %s has writes pending" % (evt.evid) )
+                stats.count( 'eventsPending' )
+                continue
+
+            # Nothing to do if we have already looked at it as it is now
+            if cache.unchanged(evt):
+                stats.count( 'eventsUnchanged' )
+                continue
+            nlooked += 1
+            self.evaluate( evt, select )
+
+            # Pick up the tickets that have been created so far
+            for job in pool.completed():
+                self.finished( job )
+
+        stats.count( 'eventsEvaluated', nlooked )
+        stats.addTime( 'evaluateTime', (time.time() - loopStart)
+                                       - (stats.times['fetchTime'] - fetchTime)
+                                       - (writer.writeTime - writeTime) )
+
+        # Wait for the rest of this cycle's tickets
+        if wait:
+            start = time.time()
+            for job in pool.wait():
+                self.finished( job )
+            stats.addTime( 'ticketWaitTime', time.time() - start )
+
+        # Write the acks, ownerids and clears for this cycle, then
+        # move on the poll watermark past the events we have dealt with
+        # (but not past any that are only remembered in memory)
+        writer.flush()
+        self.poller.commit( self.watermarkLimit(wait) )
+
+        # Write activity summary to log file.
+        if self.ncreated > 0:
+                logger.info('Tickets created: %d', self.ncreated)
+        self.ncreated = 0
+        if len(outbox) > 0:
+                logger.info('Tickets waiting to be retried: %d', len(outbox))
+        if writer.nCleared > 0:
+                logger.info('Events auto-cleared: %d', writer.nCleared)
+        if cache.hits > 0:
+                logger.info('Unchanged events skipped: %d', cache.hits)
+        self.limiter.log()
+        self.breakers.log()
+
+        # Save the figures for this cycle
+        stats.count( 'autoCleared', writer.nCleared )
+        stats.addTime( 'writeTime', writer.writeTime )
+        stats.addTime( 'cycleTime', time.time() - cycleStart )
+        writer.nCleared = 0
+        writer.writeTime = 0.0
+        cache.hits = 0
+        self.inCycle = False
+        self.totals.merge( stats )
+        self.ncycles += 1
+        writeStats( self.statsfile, self.started, self.ncycles, stats, self.totals )
+        if config.profile:
+            self.profiler.log()
+            self.profiler.save( self.profilefile )
+            self.profiler.reset()
+
+        return nlooked
+
+    # Write out anything still pending before we go.
+    # Tickets that are being created must not be forgotten,
+    # but there is no need to start any more.
+    def close(self):
+        self.pool.cancel()
+        for job in self.pool.wait():
+            self.finished( job )
+        self.pool.stop()
+        self.config.backends.close()
+        self.outbox.close()
+        self.writer.flush()
+        self.cache.save()
@@ -0,0 +1,323 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Event loop for zentt, used when the DAEMONSTUFF 'eventloop'
+#			option is set. Ticket commands run as non-blocking
+#			subprocesses watched with select(), so that many tickets can be
+#			in progress at once without a thread each, and the poll cycles
+#			carry on while they run instead of waiting for them. Tickets
+#			are recorded as soon as they finish and the writes they need
+#			are made by a timer of their own.
+#			Backends without a start() method are still run in threads.
+#
+# Updates:
+#
+
+import os, time, errno, fcntl, select, heapq, threading, logging, Queue
+from tickets import TicketError
+from poller import eventTime
+
+logger = logging.getLogger('ZenTT')
+
+# Most threads for backends that the loop cannot drive itself
+MAX_TICKET_THREADS = 16
+
+# Default number of tickets in progress at once. A ticket in progress
+# only costs the loop a pipe and a child process, so it is more than
+# the one thread of the worker pool.
+DEFAULT_LOOP_CONCURRENCY = 10
+
+# Seconds after a ticket has finished within which its event is acked
+WRITE_DELAY = 5
+
+
+# A select() loop with timers. callSoon() may be used from other
+# threads and from signal handlers; everything else is for the loop's
+# own thread.
+#
+class EventLoop(object):
+    def __init__(self):
+        # Heap of [when, sequence, function] (function None once cancelled)
+        self.timers = []
+        self.sequence = 0
+        # fd -> function to call when it can be read
+        self.readers = {}
+        self.soon = []
+        self.stopped = False
+        # Writing to this pipe wakes up select()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.readers[self.wakeRead] = self.drainWake
+
+    def callLater(self, delay, function):
+        self.sequence += 1
+        timer = [time.time() + delay, self.sequence, function]
+        heapq.heappush( self.timers, timer )
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def callSoon(self, function):
+        self.soon.append( function )
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write( self.wakeWrite, 'x' )
+        except OSError:
+            # The pipe is full, so the loop will wake up anyway
+            pass
+
+    def drainWake(self):
+        try:
+            while os.read( self.wakeRead, 4096 ):
+                pass
+        except OSError:
+            pass
+
+    def addReader(self, fd, function):
+        self.readers[fd] = function
+
+    def removeReader(self, fd):
+        self.readers.pop(fd, None)
+
+    # Wait up to timeout seconds (None for as long as it takes) for
+    # something to do, and do it. May be called from inside a callback.
+    # With timers False the timers are left for later. A poll cycle still
+    # cannot start inside another when timers are run, as LoopDriver only
+    # sets its cycle timer once a cycle has finished.
+    def runOnce(self, timeout=None, timers=True):
+        if self.soon:
+            timeout = 0
+        if timers and self.timers:
+            untilNext = max(0, self.timers[0][0] - time.time())
+            if timeout is None or untilNext < timeout:
+                timeout = untilNext
+        try:
+            ready = select.select( self.readers.keys(), [], [], timeout )[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        for fd in ready:
+            function = self.readers.get(fd)
+            if function is not None:
+                function()
+        while self.soon:
+            self.soon.pop(0)()
+        if not timers:
+            return
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            function = heapq.heappop( self.timers )[2]
+            if function is not None:
+                function()
+
+    def run(self):
+        self.stopped = False
+        while not self.stopped:
+            self.runOnce()
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
+
+    def close(self):
+        os.close( self.wakeRead )
+        os.close( self.wakeWrite )
+
+
+# Runs TicketJobs from the loop, with up to size tickets in progress at
+# once. It can be used by TicketEngine in place of a TicketPool. A job's
+# tickets are still made one after another, in section order.
+# notify() is called from the loop when a job has finished, so that it
+# can be collected straight away.
+#
+class LoopTicketPool(object):
+    def __init__(self, loop, size=DEFAULT_LOOP_CONCURRENCY, breakers=None, notify=None):
+        self.loop = loop
+        self.size = max(1, size)
+        self.breakers = breakers
+        self.notify = notify
+        # evid -> job, for every job not yet collected
+        self.jobs = {}
+        # Jobs waiting for a free place, and the number of tickets in progress
+        self.waiting = []
+        self.running = 0
+        self.finished = []
+        # Threads for backends without start()
+        self.todo = Queue.Queue()
+        self.workers = []
+
+    def submit(self, job):
+        self.jobs[job.evt.evid] = job
+        self.waiting.append( job )
+        self.startMore()
+
+    def isBusy(self, evid):
+        return evid in self.jobs
+
+    # Start the next ticket of as many waiting jobs as there is room for
+    def startMore(self):
+        while self.waiting and self.running < self.size:
+            job = self.waiting.pop(0)
+            step = job.nextRequest( self.breakers )
+            if step is None:
+                self.finished.append( job )
+                if self.notify is not None:
+                    self.loop.callSoon( self.notify )
+                continue
+            self.running += 1
+            self.startRequest( job, step[0], step[1] )
+
+    def startRequest(self, job, request, breaker):
+        section, backend, payload = request
+        start = time.time()
+        def done(ticket, errmsg):
+            self.attempted( job, request, breaker, ticket, errmsg, time.time() - start )
+        if not hasattr(backend, 'start'):
+            self.runInThread( job, request, breaker )
+            return
+        try:
+            backend.start( self.loop, payload, done )
+        except Exception as e:
+            logger.exception("Unexpected error creating tickets for %s" % (job.evt.evid))
+            done( None, str(e) )
+
+    # A ticket has been made or has failed: carry on with its job first
+    def attempted(self, job, request, breaker, ticket, errmsg, seconds):
+        job.attempted( request, breaker, ticket, errmsg, seconds )
+        self.running -= 1
+        self.waiting.insert( 0, job )
+        self.startMore()
+
+    def runInThread(self, job, request, breaker):
+        if len(self.workers) < min(self.size, MAX_TICKET_THREADS):
+            t = threading.Thread(target=self.work, name='zentt-ticket-%d' % (len(self.workers)))
+            t.setDaemon(True)
+            t.start()
+            self.workers.append(t)
+        self.todo.put( (job, request, breaker) )
+
+    def work(self):
+        while True:
+            item = self.todo.get()
+            if item is None:
+                return
+            job, request, breaker = item
+            start = time.time()
+            try:
+                ticket, errmsg = request[1].create( request[2] ), None
+            except TicketError as e:
+                ticket, errmsg = None, e.errmsg
+            except Exception as e:
+                logger.exception("Unexpected error creating tickets for %s" % (job.evt.evid))
+                ticket, errmsg = None, str(e)
+            seconds = time.time() - start
+            def done(job=job, request=request, breaker=breaker, ticket=ticket, errmsg=errmsg, seconds=seconds):
+                self.attempted( job, request, breaker, ticket, errmsg, seconds )
+            self.loop.callSoon( done )
+
+    # Jobs that have finished, without waiting for any others.
+    # Tickets that have finished meanwhile are picked up on the way.
+    def completed(self):
+        self.loop.runOnce(0, False)
+        while self.finished:
+            job = self.finished.pop(0)
+            self.jobs.pop(job.evt.evid, None)
+            yield job
+
+    # All outstanding jobs, waiting for them to finish
+    def wait(self):
+        while self.jobs:
+            if not self.finished:
+                self.loop.runOnce(1.0)
+            while self.finished:
+                job = self.finished.pop(0)
+                self.jobs.pop(job.evt.evid, None)
+                yield job
+
+    # Drop the jobs that have not started yet
+    def cancel(self):
+        for job in self.waiting[:]:
+            if job.next == 0:
+                self.waiting.remove( job )
+                self.jobs.pop(job.evt.evid, None)
+
+    # The lastTime of the oldest event with tickets in progress, or None
+    def oldestTime(self):
+        if not self.jobs:
+            return None
+        return min([ eventTime(job.evt.lastTime) for job in self.jobs.values() ])
+
+    def stop(self):
+        for t in self.workers:
+            self.todo.put(None)
+        for t in self.workers:
+            t.join(5)
+
+
+# Runs a TicketEngine from an EventLoop. A poll cycle is run whenever
+# the scheduler says one is due, without waiting for its tickets;
+# tickets are recorded as they finish, and their writes flushed within
+# WRITE_DELAY seconds. beforeCycle() is called before each cycle and
+# stops the loop if it returns False.
+#
+class LoopDriver(object):
+    def __init__(self, loop, scheduler):
+        self.loop = loop
+        self.scheduler = scheduler
+        self.engine = None
+        self.beforeCycle = None
+        self.cycleTimer = None
+        self.flushTimer = None
+
+    # Pool factory for the TicketEngine
+    def makePool(self, size, breakers):
+        if size == 1:
+            logger.warning( "max-concurrent-tickets is 1, so the event loop only makes one ticket at a time" )
+        return LoopTicketPool( self.loop, size, breakers, self.ticketsDone )
+
+    def run(self, engine, beforeCycle=None):
+        self.engine = engine
+        self.beforeCycle = beforeCycle
+        self.cycleTimer = self.loop.callLater( 0, self.cycle )
+        self.loop.run()
+
+    def cycle(self):
+        self.cycleTimer = None
+        if self.beforeCycle is not None and not self.beforeCycle():
+            self.loop.stop()
+            return
+        self.scheduler.start()
+        nlooked = self.engine.runCycle( wait=False )
+        delay = self.scheduler.finish( nlooked )
+        logger.debug('End of cycle - next in %.1f seconds', delay)
+        self.cycleTimer = self.loop.callLater( delay, self.cycle )
+
+    # Start the next cycle straight away, e.g. when a reload is requested
+    def cycleNow(self):
+        if self.cycleTimer is not None:
+            self.loop.cancel( self.cycleTimer )
+            self.cycleTimer = self.loop.callLater( 0, self.cycle )
+
+    def ticketsDone(self):
+        if self.engine is None:
+            return
+        for job in self.engine.pool.completed():
+            self.engine.finished( job )
+        if self.flushTimer is None and self.engine.writer.pending():
+            self.flushTimer = self.loop.callLater( WRITE_DELAY, self.flush )
+
+    def flush(self):
+        self.flushTimer = None
+        self.engine.writer.flush()
+
+    # No more cycles or timed writes; whatever is left is for engine.close()
+    def stop(self):
+        for timer in (self.cycleTimer, self.flushTimer):
+            if timer is not None:
+                self.loop.cancel( timer )
+        self.cycleTimer = self.flushTimer = None
+        self.loop.stopped = True
@@ -0,0 +1,74 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Batched access to event details.
+#			Instead of one getEventDetailFromStatusOrHistory call per event,
+#			the fields zentt needs are loaded for a whole page of evids
+#			with a single query.
+#
+# Updates:
+#
+
+import logging
+
+logger = logging.getLogger('ZenTT')
+
+# Every status table field that the filters or the ticket command may use
+EVENT_FIELDS = [
+    'evid', 'device', 'component', 'eventClass', 'eventKey', 'summary',
+    'message', 'severity', 'eventState', 'eventClassKey', 'eventGroup',
+    'stateChange', 'firstTime', 'lastTime', 'count', 'prodState', 'suppid',
+    'manager', 'agent', 'DeviceClass', 'Location', 'Systems', 'DeviceGroups',
+    'ipAddress', 'facility', 'priority', 'ntevid', 'ownerid', 'clearid',
+    'DevicePriority', 'eventClassMapping',
+]
+
+# Number of events fetched by one detail query
+DEFAULT_FETCHSIZE = 500
+
+# Quote a string for use in an SQL statement
+#
+def sqlQuote( value ):
+    return "'%s'" % (str(value).replace('\\', '\\\\').replace("'", "\\'"))
+
+# Build an SQL 'in' list from a list of evids
+#
+def evidList( evids ):
+    return "(%s)" % (', '.join([sqlQuote(evid) for evid in evids]))
+
+
+# The details of one event, copied out of the row returned by Zenoss
+#
+class EventRecord(object):
+    __slots__ = EVENT_FIELDS
+
+    def __init__(self, row):
+        for field in EVENT_FIELDS:
+            setattr(self, field, getattr(row, field, None))
+
+
+# Load the details of a list of evids with a single query
+# Returns a dictionary of EventRecords keyed by evid
+#
+def fetchDetails( zem, evids ):
+    if not evids:
+        return {}
+    where = "evid in %s" % (evidList(evids))
+    records = {}
+    for row in zem.getEventList(EVENT_FIELDS, where, ""):
+        records[row.evid] = EventRecord(row)
+    return records
+
+# Generate EventRecords for the events returned by a poll,
+# fetching their details a page at a time and keeping the poll order.
+# Events that have gone away since the poll are logged and skipped.
+#
+def fetchEvents( zem, events, fetchsize=DEFAULT_FETCHSIZE ):
+    for start in range(0, len(events), fetchsize):
+        page = [e.evid for e in events[start:start+fetchsize]]
+        records = fetchDetails( zem, page )
+        for evid in page:
+            evt = records.get(evid)
+            if evt is None:
+                logger.warning("Event %s not found" % (evid))
+                continue
+            yield evt
@@ -0,0 +1,200 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Tools for understanding what the filter sections do.
+#			explainEvent() runs one event through every section and says
+#			which filter option rejected it, as used by 'zentt explain'.
+#			RuleProfiler is used in place of selectEvent when the
+#			DAEMONSTUFF 'profile' option is set, and adds up the time and
+#			rejections for each section and each filter over a cycle.
+#
+# Updates:
+#
+
+import os, time, logging
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from rules import EventFields, IntFilter
+from tickets import EventData, TicketData
+
+logger = logging.getLogger('ZenTT')
+
+# Number of times each section is run against the event by explainEvent,
+# so that the times shown are not lost in the clock resolution
+EXPLAIN_REPEATS = 100
+
+# Say why a check failed for an event
+#
+def describeFailure( check, fields ):
+    prefix, attr, f, negate = check
+    if isinstance(f, IntFilter):
+        limits = []
+        if f.min is not None: limits.append( 'min %d' % (f.min) )
+        if f.max is not None: limits.append( 'max %d' % (f.max) )
+        if f.values is not None: limits.append( 'one of %s' % (', '.join([ str(v) for v in sorted(f.values) ])) )
+        return "%s %s is not %s" % (attr, fields.value(attr), ' and '.join(limits))
+    values = ', '.join([ repr(item) for item in fields.items(attr) ])
+    if negate:
+        return "%s option %s matches %s %s" % (prefix, f.which(fields, attr), attr, values)
+    return "no %s option matches %s %s" % (prefix, attr, values)
+
+# Run one section's checks in order, stopping at the first that fails.
+# Returns the failing check, or None if the section selects the event.
+#
+def firstFailure( rule, fields ):
+    for check in rule.checks:
+        prefix, attr, f, negate = check
+        if f.match( fields, attr ) == negate:
+            return check
+    return None
+
+# Average time in seconds for a section to look at the event, as it is
+# in the main loop: with the event's fields prepared for another section
+#
+def timeRule( rule, evt, repeats=EXPLAIN_REPEATS ):
+    fields = EventFields(evt)
+    firstFailure( rule, fields )
+    start = time.time()
+    for n in range(repeats):
+        firstFailure( rule, fields )
+    return (time.time() - start) / repeats
+
+# Lines of text explaining what zentt would do with an event
+#
+def explainEvent( config, evt ):
+    rules = config.rules
+    fields = EventFields(evt)
+    lines = []
+    lines.append( "Event %s: device %s, severity %s, eventState %s, prodState %s" %
+                  (evt.evid, evt.device, evt.severity, evt.eventState, evt.prodState) )
+    lines.append( "  DeviceGroups %s" % (evt.DeviceGroups) )
+    lines.append( "  summary %s" % (evt.summary) )
+    if evt.eventState != 0:
+        lines.append( "Only new events get tickets, so no section will be used for this one" )
+
+    candidates = set([ rule.name for rule in rules.candidates(fields) ])
+    matched = []
+    for rule in rules.sections:
+        check = firstFailure( rule, fields )
+        took = timeRule( rule, evt ) * 1000000
+        if check is None:
+            matched.append( rule )
+            lines.append( "Section %s: MATCH (%.1fus)" % (rule.name, took) )
+            continue
+        lines.append( "Section %s: rejected by %s - %s (%.1fus%s)" %
+                      (rule.name, check[0], describeFailure( check, fields ), took,
+                       (rule.name not in candidates) and ', skipped by the integer index' or '') )
+
+    if rules.autoclear:
+        check = firstFailure( rules.autoclear, fields )
+        if check is None:
+            lines.append( "AUTOCLEAR: MATCH" )
+        else:
+            lines.append( "AUTOCLEAR: rejected by %s - %s" % (check[0], describeFailure( check, fields )) )
+
+    if evt.eventState != 0:
+        return lines
+    if not matched:
+        if rules.autoclear and firstFailure( rules.autoclear, fields ) is None:
+            lines.append( "Result: no ticket; the event would be auto-cleared" )
+        else:
+            lines.append( "Result: no ticket" )
+        return lines
+    if rules.multiTicket:
+        lines.append( "Result: a ticket from each of %s" % (', '.join([ rule.name for rule in matched ])) )
+    else:
+        lines.append( "Result: a ticket from section %s (later matches are tried only if it fails)" % (matched[0].name) )
+
+    # Show the ticket request each matching section would make
+    eventData = EventData(evt)
+    for rule in matched:
+        data = TicketData( eventData, rule.params, rules.daemonOptions )
+        backend = config.backends.forRule( rule )
+        lines.append( "  %s would send: %r" % (rule.name, backend.prepare( data )) )
+    return lines
+
+
+# Time and rejections for each section and each filter prefix.
+# select() is a drop-in replacement for rules.selectEvent.
+#
+class RuleProfiler(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # section -> [events looked at, events rejected, seconds]
+        self.sections = {}
+        # prefix -> [checks made, events rejected, seconds]
+        self.prefixes = {}
+
+    def select(self, rule, evt, fields=None):
+        if fields is None:
+            fields = EventFields(evt)
+        section = self.sections.get(rule.name)
+        if section is None:
+            section = self.sections[rule.name] = [0, 0, 0.0]
+        section[0] += 1
+        start = time.time()
+        for prefix, attr, f, negate in rule.checks:
+            t = time.time()
+            fails = ( f.match( fields, attr ) == negate )
+            now = time.time()
+            p = self.prefixes.get(prefix)
+            if p is None:
+                p = self.prefixes[prefix] = [0, 0, 0.0]
+            p[0] += 1
+            p[2] += now - t
+            if fails:
+                p[1] += 1
+                section[1] += 1
+                section[2] += now - start
+                return 0
+        section[2] += time.time() - start
+        return 1
+
+    def asDict(self):
+        return {'sections': self.sections, 'prefixes': self.prefixes}
+
+    # Log the most expensive sections and filters
+    def log(self, top=10):
+        for title, table in (('section', self.sections), ('filter', self.prefixes)):
+            rows = table.items()
+            rows.sort(key=lambda row: -row[1][2])
+            for name, (looked, rejected, seconds) in rows[:top]:
+                logger.info( "Profile %s %s: %d looked at, %d rejected, %.3fms" %
+                             (title, name, looked, rejected, seconds * 1000) )
+
+    def save(self, path):
+        tmpfile = path + '.tmp'
+        try:
+            f = open(tmpfile, 'w')
+            try:
+                json.dump(self.asDict(), f)
+            finally:
+                f.close()
+            os.rename(tmpfile, path)
+        except (IOError, OSError) as e:
+            logger.warning("Cannot write profile to %s: %s" % (path, e))
+
+
+def readProfile( path ):
+    f = open(path, 'r')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+# Text for 'zentt profile', most expensive first
+#
+def formatProfile( profile ):
+    lines = []
+    for title, key in (('Section', 'sections'), ('Filter', 'prefixes')):
+        lines.append( '%-30s %10s %10s %12s' % (title, 'looked at', 'rejected', 'ms') )
+        rows = profile[key].items()
+        rows.sort(key=lambda row: -row[1][2])
+        for name, (looked, rejected, seconds) in rows:
+            lines.append( '%-30s %10d %10d %12.3f' % (name, looked, rejected, seconds * 1000) )
+        lines.append( '' )
+    return lines
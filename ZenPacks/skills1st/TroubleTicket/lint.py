@@ -0,0 +1,418 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Static checks of a zentt.conf file, as used by 'zentt lint'.
+#			Finds sections that can never match (contradictory integer
+#			filters), sections shadowed by an earlier section that matches
+#			every event they do, regular expressions that may backtrack
+#			catastrophically, and estimates what each section costs to
+#			evaluate for every event.
+#
+# Updates:
+#
+
+import re, sre_parse, sre_constants
+from rules import compileSection, RuleError, IntFilter, DAEMON_SECTION, AUTOCLEAR_SECTION, \
+     FILTER_ORDER, INT_FILTERS, MULTI_VALUED
+
+ERROR = 'error'
+WARNING = 'warning'
+
+# Values that Zenoss gives these attributes
+INT_DOMAINS = {
+    'severity': (0, 5),
+    'eventstate': (0, 2),
+}
+
+# Largest integer range enumerated when comparing a range with a list of values
+MAX_ENUMERATED = 1000
+
+# Relative costs used for the per-section estimate: an integer comparison,
+# a set lookup of the event values, and one regex search of one value.
+# Organiser attributes (DeviceGroups, Systems) are assumed to hold
+# ORGANISERS values.
+COST_INT = 1
+COST_LITERAL = 2
+COST_REGEX = 10
+ORGANISERS = 3
+
+# Regexes that start like this are searched with a pointless leading .*
+LEADING_DOTSTAR = re.compile( r'^\(*\.\*' )
+
+
+# Options in a section with the given prefix, as (option, suffix) pairs
+#
+def prefixOptions( config, s, pattern ):
+    optpattern = re.compile( pattern, re.IGNORECASE )
+    found = []
+    for opt in config.options(s):
+        m = optpattern.match(opt)
+        if m:
+            found.append( (opt, m.group(1)) )
+    return found
+
+# Contradictions between the integer options of one section
+# Returns a list of (level, message)
+#
+def checkIntOptions( config, s, rule ):
+    findings = []
+    for prefix in INT_FILTERS:
+        options = prefixOptions( config, s, prefix + '-(.+)' )
+        if not options:
+            continue
+        mins = []
+        maxs = []
+        for opt, suffix in options:
+            value = config.get(s, opt).rstrip()
+            if not re.search( '^[-+]?[0-9]+$', value ):
+                findings.append( (WARNING, "%s has a non-integer value %s, which is treated as 0" % (opt, value)) )
+            if suffix.lower() == 'min':
+                mins.append( opt )
+            elif suffix.lower() == 'max':
+                maxs.append( opt )
+        f = None
+        for check in rule.checks:
+            if check[0] == prefix:
+                f = check[2]
+        if len(mins) > 1:
+            findings.append( (WARNING, "%s all apply, so only the highest, %d, matters" % (', '.join(mins), f.min)) )
+        if len(maxs) > 1:
+            findings.append( (WARNING, "%s all apply, so only the lowest, %d, matters" % (', '.join(maxs), f.max)) )
+        if f.min is not None and f.max is not None and f.min > f.max:
+            findings.append( (ERROR, "%s-min %d is above %s-max %d, so the section can never match" %
+                              (prefix, f.min, prefix, f.max)) )
+            continue
+        if f.values is not None:
+            outside = [ v for v in sorted(f.values) if not f.accepts(v) ]
+            if len(outside) == len(f.values):
+                findings.append( (ERROR, "none of the %s values %s is within the %s-min/max range, so the section can never match" %
+                                  (prefix, ', '.join([ str(v) for v in outside ]), prefix)) )
+                continue
+            if outside:
+                findings.append( (WARNING, "%s values %s are outside the %s-min/max range and can never match" %
+                                  (prefix, ', '.join([ str(v) for v in outside ]), prefix)) )
+        domain = INT_DOMAINS.get(prefix)
+        if domain and not [ v for v in range(domain[0], domain[1] + 1) if f.accepts(v) ]:
+            findings.append( (ERROR, "no %s from %d to %d is accepted, so the section can never match" %
+                              (prefix, domain[0], domain[1])) )
+        elif prefix == 'eventstate' and s != AUTOCLEAR_SECTION and not f.accepts(0):
+            findings.append( (ERROR, "eventstate filters exclude 0 (new), and only new events get tickets") )
+    return findings
+
+# Can the section ever select an event? (judged by the integer filters)
+#
+def canMatch( rule ):
+    for prefix, attr, f, negate in rule.checks:
+        if not isinstance(f, IntFilter):
+            continue
+        if f.min is not None and f.max is not None and f.min > f.max:
+            return False
+        if f.values is not None and not [ v for v in f.values if f.accepts(v) ]:
+            return False
+        domain = INT_DOMAINS.get(prefix)
+        if domain and not [ v for v in range(domain[0], domain[1] + 1) if f.accepts(v) ]:
+            return False
+        if prefix == 'eventstate' and not f.accepts(0):
+            return False
+    return True
+
+
+# The lowercased characters that a piece of a parsed regex can start
+# with, or None if it could start with anything or match nothing
+#
+def firstChars( items ):
+    chars = set()
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            chars.add( unichr(av).lower() )
+            return chars
+        if op == sre_constants.IN:
+            for o, a in av:
+                if o == sre_constants.LITERAL:
+                    chars.add( unichr(a).lower() )
+                elif o == sre_constants.RANGE and a[1] - a[0] < 256:
+                    for c in range(a[0], a[1] + 1):
+                        chars.add( unichr(c).lower() )
+                else:
+                    return None
+            return chars
+        if op == sre_constants.SUBPATTERN:
+            sub = firstChars( av[-1] )
+            if sub is None:
+                return None
+            chars.update( sub )
+            return chars
+        if op == sre_constants.BRANCH:
+            for branch in av[1]:
+                sub = firstChars( branch )
+                if sub is None:
+                    return None
+                chars.update( sub )
+            return chars
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            sub = firstChars( av[2] )
+            if sub is None:
+                return None
+            chars.update( sub )
+            if av[0] == 0:
+                continue
+            return chars
+        if op == sre_constants.AT:
+            continue
+        return None
+    # Could match the empty string
+    return None
+
+# Is there a pair of alternatives that can start with the same character?
+#
+def overlapping( branches ):
+    seen = set()
+    for branch in branches:
+        chars = firstChars( branch )
+        if chars is None or not seen.isdisjoint(chars):
+            return True
+        seen.update( chars )
+    return False
+
+# Look for the shapes that make a backtracking regex engine take
+# exponential time on a string that nearly matches: a repeat inside a
+# repeat, such as (\w+\s?)*, or a repeated choice between alternatives
+# that can match the same text, such as (a|ab)*.
+# Returns a description of the problem, or None.
+#
+def backtrackRisk( items, repeated=False ):
+    for op, av in items:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            lo, hi, sub = av
+            unbounded = (hi == sre_constants.MAXREPEAT)
+            if unbounded and repeated:
+                return "a repeat nested inside another repeat"
+            risk = backtrackRisk( sub, repeated or unbounded )
+            if risk:
+                return risk
+        elif op == sre_constants.SUBPATTERN:
+            risk = backtrackRisk( av[-1], repeated )
+            if risk:
+                return risk
+        elif op == sre_constants.BRANCH:
+            if repeated and overlapping( av[1] ):
+                return "a repeated choice between alternatives that can match the same text"
+            for branch in av[1]:
+                risk = backtrackRisk( branch, repeated )
+                if risk:
+                    return risk
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            risk = backtrackRisk( av[1], repeated )
+            if risk:
+                return risk
+    return None
+
+# Problems with the regexes of one section
+# Returns a list of (level, message)
+#
+def checkRegexes( config, s ):
+    findings = []
+    for prefix, attr in FILTER_ORDER:
+        if prefix in INT_FILTERS:
+            continue
+        for p in (prefix, 'not' + prefix):
+            for opt, suffix in prefixOptions( config, s, p + '-(re-)' ):
+                value = config.get(s, opt).rstrip()
+                try:
+                    risk = backtrackRisk( sre_parse.parse( value, re.IGNORECASE ) )
+                except (sre_constants.error, RuntimeError):
+                    continue
+                if risk:
+                    findings.append( (WARNING, "%s: %s has %s, which can take exponential time on some %s values" %
+                                      (opt, value, risk, attr)) )
+                if LEADING_DOTSTAR.match( value ):
+                    findings.append( (WARNING, "%s: %s starts with .*, which is not needed as regexes may match "
+                                      "anywhere, and makes failing matches slower" % (opt, value)) )
+    return findings
+
+
+# The literal values and regex texts of a string filter
+#
+def regexTexts( config, s, prefix ):
+    return set([ config.get(s, opt).rstrip() for opt, suffix in prefixOptions( config, s, prefix + '-(re-)' ) ])
+
+# Does the filter accept a (lowercased) literal value?
+#
+def acceptsLiteral( f, literal ):
+    if literal in f.literals:
+        return True
+    for automaton, names in f.automata:
+        if automaton.search( literal ):
+            return True
+    return False
+
+# Does string filter a (with regex texts aTexts) match whenever b does?
+#
+def stringCovers( a, aTexts, b, bTexts ):
+    for literal in b.literals:
+        if not acceptsLiteral( a, literal ):
+            return False
+    return bTexts.issubset( aTexts )
+
+# Does integer filter a accept every value that b accepts?
+#
+def intCovers( a, b ):
+    if b.values is not None:
+        for v in b.values:
+            if b.accepts(v) and not a.accepts(v):
+                return False
+        return True
+    lo, hi = b.min, b.max
+    if a.values is not None:
+        if lo is None or hi is None or hi - lo > MAX_ENUMERATED:
+            return False
+        for v in range(lo, hi + 1):
+            if not a.accepts(v):
+                return False
+        return True
+    if a.min is not None and (lo is None or lo < a.min):
+        return False
+    if a.max is not None and (hi is None or hi > a.max):
+        return False
+    return True
+
+# A compiled section with what the shadowing check needs
+#
+class LintSection(object):
+    def __init__(self, config, rule):
+        self.rule = rule
+        self.checks = {}
+        self.texts = {}
+        self.negated = set()
+        for prefix, attr, f, negate in rule.checks:
+            self.checks[prefix] = f
+            if negate:
+                self.negated.add( prefix )
+            if not isinstance(f, IntFilter):
+                self.texts[prefix] = regexTexts( config, rule.name, prefix )
+        self.prefixes = frozenset(self.checks)
+
+    # Does every event that other selects also get selected by this section?
+    def covers(self, other):
+        if not self.prefixes.issubset( other.prefixes ):
+            return False
+        for prefix, f in self.checks.items():
+            g = other.checks[prefix]
+            if isinstance(f, IntFilter):
+                if not intCovers( f, g ):
+                    return False
+            elif prefix in self.negated:
+                # A negated filter: other must reject at least what this one rejects
+                if not stringCovers( g, other.texts[prefix], f, self.texts[prefix] ):
+                    return False
+            elif not stringCovers( f, self.texts[prefix], g, other.texts[prefix] ):
+                return False
+        return True
+
+
+# Estimated relative cost of evaluating a section for an event that
+# passes all its filters (the worst case: every check is made)
+# Returns (cost, integer checks, literal checks, regex searches)
+#
+def sectionCost( rule ):
+    ints = literals = regexes = 0
+    for prefix, attr, f, negate in rule.checks:
+        if isinstance(f, IntFilter):
+            ints += 1
+            continue
+        items = 1
+        if attr in MULTI_VALUED:
+            items = ORGANISERS
+        if f.literals:
+            literals += 1
+        regexes += len(f.automata) * items
+    return (ints * COST_INT + literals * COST_LITERAL + regexes * COST_REGEX, ints, literals, regexes)
+
+
+# Check a whole config file
+# Returns a list of (level, section, message) and a list of
+# (section, cost, integer checks, literal checks, regex searches)
+#
+def lintConfig( config ):
+    findings = []
+    costs = []
+    multiTicket = '0'
+    if config.has_section(DAEMON_SECTION) and config.has_option(DAEMON_SECTION, 'multi-ticket'):
+        multiTicket = config.get(DAEMON_SECTION, 'multi-ticket').rstrip()
+    multiTicket = (multiTicket == '1') or (multiTicket.lower() == 'yes')
+
+    earlier = []
+    for s in sorted(config.sections(), key=str.lower):
+        if s == DAEMON_SECTION:
+            continue
+        try:
+            rule = compileSection( config, s )
+        except RuleError as e:
+            findings.append( (ERROR, s, e.errmsg) )
+            continue
+        for level, message in checkIntOptions( config, s, rule ) + checkRegexes( config, s ):
+            findings.append( (level, s, message) )
+        if s == AUTOCLEAR_SECTION:
+            if not rule.checks:
+                findings.append( (WARNING, s, "AUTOCLEAR has no filters, so every event that gets no ticket is cleared") )
+            continue
+
+        cost = sectionCost( rule )
+        costs.append( (s,) + cost )
+        if not rule.checks:
+            findings.append( (WARNING, s, "the section has no filters and matches every new event") )
+        if not canMatch( rule ):
+            continue
+
+        # Without multi-ticket a later section is only used when the
+        # tickets for all the earlier matching sections fail
+        section = LintSection( config, rule )
+        if not multiTicket:
+            for other in earlier:
+                if other.covers( section ):
+                    findings.append( (WARNING, s, "shadowed by section %s, which comes first and matches every event "
+                                      "this one does; it only gets a ticket when %s fails (%d units wasted per event)" %
+                                      (other.rule.name, other.rule.name, cost[0])) )
+                    break
+        earlier.append( section )
+    return findings, costs
+
+
+# Text for 'zentt lint'. profile is what 'zentt profile' shows, if there
+# is one, to add the measured time per event to the estimates.
+#
+def formatLint( findings, costs, profile=None, top=20 ):
+    lines = []
+    for level, section, message in findings:
+        lines.append( "%s: [%s] %s" % (level.upper(), section, message) )
+    if not findings:
+        lines.append( "No problems found" )
+
+    lines.append( "" )
+    costs = list(costs)
+    costs.sort(key=lambda row: -row[1])
+    total = sum([ row[1] for row in costs ])
+    lines.append( "Estimated cost per event: %d units over %d sections (int check %d, literal set %d, regex search %d)" %
+                  (total, len(costs), COST_INT, COST_LITERAL, COST_REGEX) )
+    measured = {}
+    if profile:
+        for name, (looked, rejected, seconds) in profile.get('sections', {}).items():
+            if looked:
+                measured[name] = seconds / looked * 1000000
+    lines.append( "%-30s %8s %6s %8s %8s %12s" % ('Section', 'units', 'ints', 'literals', 'regexes', 'measured us') )
+    for name, cost, ints, literals, regexes in costs[:top]:
+        if name in measured:
+            us = '%12.1f' % (measured[name])
+        else:
+            us = '%12s' % ('-')
+        lines.append( "%-30s %8d %6d %8d %8d %s" % (name, cost, ints, literals, regexes, us) )
+    if len(costs) > top:
+        lines.append( "... and %d cheaper sections" % (len(costs) - top) )
+    return lines
+
+# Are any of the findings errors?
+#
+def hasErrors( findings ):
+    for level, section, message in findings:
+        if level == ERROR:
+            return True
+    return False
@@ -0,0 +1,210 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Durable queue of tickets that could not be created.
+#			Failed ticket requests are kept in an SQLite file under
+#			$ZENHOME/var with their attempt count, next retry time and
+#			last error, and are retried with exponential backoff until
+#			they succeed or the retry limit is reached. Events waiting
+#			here, and those whose tickets have been given up, are left
+#			alone by the normal event scan.
+#
+# Updates:
+#
+
+import time, random, logging, sqlite3
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from events import fetchDetails
+from tickets import TicketJob
+
+logger = logging.getLogger('ZenTT')
+
+# Defaults for the DAEMONSTUFF retry options
+DEFAULT_RETRYTIME = 60
+DEFAULT_RETRYMAX = 3600
+DEFAULT_RETRYLIMIT = 10
+
+# Seconds between checks for given-up events that have since been dealt with
+GIVENUP_CHECKTIME = 3600
+
+SCHEMA = """
+create table if not exists outbox (
+    evid text primary key,
+    requests text not null,
+    multiticket integer not null,
+    attempts integer not null,
+    nextretry real not null,
+    lasterror text,
+    created real not null
+)
+"""
+
+# Events whose tickets have been given up, so that a full scan does
+# not start their retries all over again
+GIVENUP_SCHEMA = """
+create table if not exists givenup (
+    evid text primary key,
+    givenup real not null,
+    generation text
+)
+"""
+
+
+# json gives back unicode strings; turn them into the plain strings
+# that the backends were given when the requests were first prepared
+#
+def plainStrings( value ):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [ plainStrings(v) for v in value ]
+    return value
+
+
+class Outbox(object):
+    def __init__(self, path, retrytime=DEFAULT_RETRYTIME, retrymax=DEFAULT_RETRYMAX,
+                 retrylimit=DEFAULT_RETRYLIMIT, generation=None):
+        self.retrytime = retrytime
+        self.retrymax = retrymax
+        self.retrylimit = retrylimit
+        self.db = sqlite3.connect(path)
+        self.db.execute(SCHEMA)
+        self.db.execute(GIVENUP_SCHEMA)
+        self.db.commit()
+        # evids in the outbox, so the event scan can check without a query
+        self.evids = set([ row[0] for row in self.db.execute("select evid from outbox") ])
+        if self.evids:
+            logger.info("%d ticket requests waiting to be retried" % (len(self.evids)))
+        # Given up under other rules: those events may get tickets now
+        self.generation = generation
+        self.db.execute("delete from givenup where generation is not ?", (generation,))
+        self.db.commit()
+        self.givenUp = set([ row[0] for row in self.db.execute("select evid from givenup") ])
+        self.lastCheck = 0
+
+    # Is the event waiting to be retried, or has its ticket been given up?
+    # Either way the event scan must leave it alone.
+    def contains(self, evid):
+        return evid in self.evids or evid in self.givenUp
+
+    def __len__(self):
+        return len(self.evids)
+
+    # Seconds to wait before the next attempt: doubling each time up to
+    # retrymax, with some jitter so that retries do not all come together
+    def backoff(self, attempts):
+        delay = min(self.retrymax, self.retrytime * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    # Record a failed attempt for an event. requests is a list of
+    # (section, backend name, payload) still to be done.
+    # Returns False if the event has been given up: the retry limit has
+    # been reached or its requests cannot be saved.
+    def failed(self, evid, requests, multiTicket, error):
+        now = time.time()
+        row = self.db.execute("select attempts, created from outbox where evid = ?", (evid,)).fetchone()
+        if row:
+            attempts, created = row[0] + 1, row[1]
+        else:
+            attempts, created = 1, now
+
+        if attempts > self.retrylimit:
+            logger.error("Giving up on ticket for %s after %d attempts: %s" % (evid, attempts, error))
+            self.giveUp(evid)
+            return False
+
+        # A plugin backend's payload may be something JSON cannot hold
+        try:
+            saved = json.dumps(requests)
+        except (TypeError, ValueError) as e:
+            logger.error("Cannot keep the ticket for %s to be retried (%s): %s" % (evid, e, error))
+            self.giveUp(evid)
+            return False
+
+        nextretry = now + self.backoff(attempts)
+        self.db.execute("insert or replace into outbox values (?, ?, ?, ?, ?, ?, ?)",
+                        (evid, saved, int(multiTicket), attempts, nextretry, error, created))
+        self.db.commit()
+        self.evids.add(evid)
+        logger.info("Ticket for %s will be retried in %.0f seconds (attempt %d)" % (evid, nextretry - now, attempts))
+        return True
+
+    # Put off the next attempt for an event until when, without counting
+    # it as a failure (used while its ticket backend is out of use)
+    def postpone(self, evid, when):
+        self.db.execute("update outbox set nextretry = ? where evid = ?", (when, evid))
+        self.db.commit()
+
+    def remove(self, evid):
+        self.db.execute("delete from outbox where evid = ?", (evid,))
+        self.db.commit()
+        self.evids.discard(evid)
+
+    # Stop trying to make the event's ticket. It stays marked 'Ticket FAILED'
+    # and is not looked at again until it has been dealt with.
+    def giveUp(self, evid):
+        self.db.execute("delete from outbox where evid = ?", (evid,))
+        self.db.execute("insert or replace into givenup values (?, ?, ?)",
+                        (evid, time.time(), self.generation))
+        self.db.commit()
+        self.evids.discard(evid)
+        self.givenUp.add(evid)
+
+    # The rules have changed, so the given-up events may now get tickets
+    def clearGivenUp(self, generation):
+        self.generation = generation
+        self.db.execute("delete from givenup")
+        self.db.commit()
+        self.givenUp = set()
+
+    # Forget the given-up events that have gone or are no longer new,
+    # at most once every GIVENUP_CHECKTIME seconds
+    def checkGivenUp(self, zem, now):
+        if not self.givenUp or now - self.lastCheck < GIVENUP_CHECKTIME:
+            return
+        self.lastCheck = now
+        events = fetchDetails( zem, sorted(self.givenUp) )
+        for evid in list(self.givenUp):
+            evt = events.get(evid)
+            if evt is None or evt.eventState != 0:
+                self.db.execute("delete from givenup where evid = ?", (evid,))
+                self.givenUp.discard(evid)
+        self.db.commit()
+
+    # TicketJobs for the entries whose retry time has come.
+    # Events that have gone away or are no longer new are dropped,
+    # and now and then forgotten if they had been given up.
+    def dueJobs(self, zem, backends, now=None):
+        if now is None:
+            now = time.time()
+        self.checkGivenUp( zem, now )
+        rows = self.db.execute("select evid, requests, multiticket from outbox "
+                               "where nextretry <= ? order by nextretry", (now,)).fetchall()
+        if not rows:
+            return []
+        events = fetchDetails( zem, [ row[0] for row in rows ] )
+        jobs = []
+        for evid, requests, multiTicket in rows:
+            evt = events.get(evid)
+            # With multi-ticket the event will have been acknowledged if
+            # some of its tickets were created, so only give up if it has gone
+            if evt is None or (evt.eventState != 0 and not multiTicket):
+                logger.info("Event %s has been dealt with - dropping its ticket retry" % (evid))
+                self.remove(evid)
+                continue
+            try:
+                requests = [ (section, backends.get(name), payload)
+                             for section, name, payload in plainStrings( json.loads(requests) ) ]
+            except KeyError as e:
+                logger.error("Ticket backend %s for %s is no longer configured - dropping its retry" % (e, evid))
+                self.remove(evid)
+                continue
+            job = TicketJob( evt, requests, bool(multiTicket) )
+            job.retry = True
+            jobs.append(job)
+        return jobs
+
+    def close(self):
+        self.db.close()
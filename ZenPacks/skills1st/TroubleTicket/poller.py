@@ -0,0 +1,171 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Incremental polling of the Zenoss event status table.
+#			Only events that are new or have changed since the last cycle
+#			are fetched. The high-water mark is kept in a state file under
+#			$ZENHOME/var so that it survives a restart, and a full scan of
+#			all open events is made every 'resynctime' seconds as a safety net.
+#			In sharded mode only the events of this worker's devices are fetched.
+#
+# Updates:
+#
+
+import os, time, logging, hashlib
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+logger = logging.getLogger('ZenTT')
+
+# Fields needed to decide what to process and to move the watermark on
+POLL_FIELDS = ['evid', 'lastTime', 'stateChange']
+
+# Format used by Zenoss when it returns event times as strings
+TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+# Convert an event time as returned by Zenoss into seconds since the epoch
+# Zenoss may give us a float, a Zope DateTime, a datetime or a string
+#
+def eventTime( value ):
+    if value is None:
+        return 0
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    if hasattr(value, 'timeTime'):
+        return float(value.timeTime())
+    if hasattr(value, 'timetuple'):
+        return time.mktime(value.timetuple())
+    value = str(value).split('.')[0].replace('-', '/')
+    try:
+        return time.mktime(time.strptime(value, TIME_FORMAT))
+    except ValueError:
+        logger.warning("Cannot parse event time %s" % (value))
+        return 0
+
+# Identify a particular version of the config file, so that a change
+# of rules forces all events to be looked at again
+#
+def configGeneration( path ):
+    try:
+        f = open(path, 'rb')
+        try:
+            return hashlib.md5(f.read()).hexdigest()
+        finally:
+            f.close()
+    except IOError:
+        return ''
+
+
+class EventPoller(object):
+    def __init__(self, zem, statefile, resynctime, generation, shard=None):
+        self.zem = zem
+        self.shard = shard
+        self.statefile = statefile
+        self.resynctime = resynctime
+        self.generation = generation
+        # Watermarks as of the last completed cycle
+        self.lastTime = 0
+        self.stateChange = 0
+        self.lastFull = 0
+        # Watermarks reached by the cycle in progress
+        self.pending = None
+        self.load()
+
+    # Read the watermark saved by a previous run.
+    # It is only used if the config file has not changed since.
+    def load(self):
+        try:
+            f = open(self.statefile, 'r')
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return
+        if state.get('generation') != self.generation:
+            logger.info("Config has changed since the last run - starting with a full scan")
+            return
+        self.lastTime = state.get('lastTime', 0)
+        self.stateChange = state.get('stateChange', 0)
+        self.lastFull = state.get('lastFull', 0)
+
+    # Write the watermark, replacing the old state file in one step
+    def save(self):
+        state = {
+            'generation': self.generation,
+            'lastTime': self.lastTime,
+            'stateChange': self.stateChange,
+            'lastFull': self.lastFull,
+        }
+        tmpfile = self.statefile + '.tmp'
+        try:
+            f = open(tmpfile, 'w')
+            try:
+                json.dump(state, f)
+            finally:
+                f.close()
+            os.rename(tmpfile, self.statefile)
+        except (IOError, OSError) as e:
+            logger.warning("Cannot save poll state to %s: %s" % (self.statefile, e))
+
+    # Do we need to look at all the open events this cycle?
+    def fullScanDue(self, now):
+        if not self.lastTime:
+            return True
+        return (now - self.lastFull) >= self.resynctime
+
+    # Fetch the events to be processed this cycle, oldest first
+    def poll(self):
+        now = time.time()
+        full = self.fullScanDue(now)
+        if full:
+            where = ""
+            logger.info("Full scan of open events")
+        else:
+            # Events are looked at again if they were updated at the watermark
+            # itself, so nothing is lost if several share the same second.
+            where = "(lastTime >= %f or stateChange >= FROM_UNIXTIME(%d))" % (
+                        self.lastTime, int(self.stateChange))
+        # The database leaves out the other workers' events, so that each
+        # worker only reads its own share of the status table
+        if self.shard is not None:
+            where = ' and '.join([ clause for clause in (where, self.shard.where()) if clause ])
+
+        events = self.zem.getEventList(POLL_FIELDS, where, "lastTime ASC, firstTime ASC")
+
+        lastTime = self.lastTime
+        stateChange = self.stateChange
+        for e in events:
+            lastTime = max(lastTime, eventTime(e.lastTime))
+            stateChange = max(stateChange, eventTime(e.stateChange))
+        if full:
+            lastFull = now
+        else:
+            lastFull = self.lastFull
+        self.pending = (lastTime, stateChange, lastFull)
+
+        logger.debug("Polled %d events (%s)" % (len(events), full and 'full' or 'incremental'))
+        return events
+
+    # The cycle has finished with the events from poll(),
+    # so move the watermark on and save it. limit, if given, is the
+    # lastTime of the oldest event still being worked on: the watermark
+    # is not moved past it, so that the event is polled again after a
+    # restart (but it is never moved back).
+    def commit(self, limit=None):
+        if self.pending is None:
+            return
+        lastTime, self.stateChange, self.lastFull = self.pending
+        if limit is not None:
+            lastTime = max(self.lastTime, min(lastTime, limit))
+        self.lastTime = lastTime
+        self.pending = None
+        self.save()
+
+    # Forget the watermark so that the next poll is a full scan
+    def reset(self):
+        self.lastTime = 0
+        self.stateChange = 0
+        self.lastFull = 0
+        self.pending = None
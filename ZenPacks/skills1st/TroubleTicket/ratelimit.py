@@ -0,0 +1,178 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Rate limits on ticket creation, to protect the ticket system
+#			during an event storm. Each ticket target (by default each
+#			ttbackend, or whatever the DAEMONSTUFF 'ratelimit-key' template
+#			gives, e.g. %param-tthost%) and each section with a 'ratelimit'
+#			option has a token bucket. An event whose buckets are empty is
+#			deferred and tried again, oldest first, in later cycles.
+#
+# Updates:
+#
+
+import time, logging
+from tickets import Template
+
+logger = logging.getLogger('ZenTT')
+
+
+# Allows rate tickets per minute on average, and up to burst at once
+#
+class TokenBucket(object):
+    def __init__(self, rate, burst, now=None):
+        if now is None:
+            now = time.time()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate / 60.0)
+        self.updated = now
+
+    def available(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class RateLimiter(object):
+    def __init__(self, targetRate=0, targetBurst=0, keyTemplate=None):
+        # ('target', key) or ('section', name) -> TokenBucket
+        self.buckets = {}
+        # evids waiting for tokens, oldest first, the bucket holding each
+        # back, and the lastTime of each (where known)
+        self.deferred = []
+        self.blockedBy = {}
+        self.lastTimes = {}
+        self.configure( targetRate, targetBurst, keyTemplate )
+
+    # Set the limits from a new config. Buckets whose limits have changed
+    # start again full; the deferred events are kept.
+    # When share is more than 1 (the number of zentt workers) each rate
+    # and burst is divided between them.
+    def configure(self, targetRate, targetBurst, keyTemplate, sections=(), share=1):
+        self.share = share
+        self.targetRate, self.targetBurst = self.divide( targetRate, targetBurst or targetRate )
+        self.keyTemplate = None
+        if keyTemplate:
+            self.keyTemplate = Template( keyTemplate )
+        limits = {}
+        for rule in sections:
+            if rule.limit:
+                limits[('section', rule.name)] = self.divide( *rule.limit )
+        for key, bucket in self.buckets.items():
+            if key[0] == 'target':
+                limit = (self.targetRate, self.targetBurst)
+            else:
+                limit = limits.get(key)
+            if limit != (bucket.rate, bucket.burst):
+                del self.buckets[key]
+
+    # This worker's share of a (rate, burst) limit; the burst is at least 1
+    def divide(self, rate, burst):
+        if self.share > 1:
+            return (float(rate) / self.share, max(1, burst // self.share))
+        return (rate, max(1, burst))
+
+    def __len__(self):
+        return len(self.deferred)
+
+    def isDeferred(self, evid):
+        return evid in self.blockedBy
+
+    # The buckets that a request for rule (with substitution data, sent
+    # by the backend called backendName) has to take a token from
+    def keys(self, rule, data, backendName):
+        keys = []
+        if rule.limit:
+            keys.append( (('section', rule.name), self.divide( *rule.limit )) )
+        if self.targetRate > 0:
+            if self.keyTemplate is not None:
+                target = ' '.join(self.keyTemplate.render( data ))
+            else:
+                target = backendName
+            keys.append( (('target', target), (self.targetRate, self.targetBurst)) )
+        return keys
+
+    # May a ticket job go ahead now? requestKeys holds the keys() of each
+    # of the job's requests. Without multi-ticket only the first request
+    # counts, as the others are only tried if its ticket fails.
+    # If it may, a token is taken from each of its buckets; if not, the
+    # event is added to the deferred list. lastTime is the event's lastTime
+    # in seconds, so that the poll watermark can be kept behind it.
+    def allow(self, evid, requestKeys, multiTicket, now=None, lastTime=None):
+        if now is None:
+            now = time.time()
+        if not multiTicket:
+            requestKeys = requestKeys[:1]
+        needed = []
+        for keys in requestKeys:
+            for key, (rate, burst) in keys:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket( rate, burst, now )
+                if not bucket.available(now):
+                    self.defer( evid, key, lastTime )
+                    return False
+                needed.append( bucket )
+        for bucket in needed:
+            bucket.take(now)
+        return True
+
+    def defer(self, evid, key, lastTime=None):
+        if evid not in self.blockedBy:
+            self.deferred.append( evid )
+        self.blockedBy[evid] = key
+        if lastTime is not None:
+            self.lastTimes[evid] = lastTime
+
+    # The lastTime of the oldest deferred event, or None. The deferred
+    # list is not saved, so the poll watermark must not pass this for the
+    # events to be found again after a restart.
+    def oldestTime(self):
+        if not self.lastTimes:
+            return None
+        return min(self.lastTimes.values())
+
+    # The deferred evids worth trying again now, oldest first: no more
+    # for each bucket than it has tokens. The rest stay deferred, and
+    # any of these that are still held back are deferred again by allow().
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        deferred = [ (evid, self.blockedBy[evid], self.lastTimes.get(evid)) for evid in self.deferred ]
+        self.deferred = []
+        self.blockedBy = {}
+        self.lastTimes = {}
+        budget = {}
+        due = []
+        for evid, key, lastTime in deferred:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                if key not in budget:
+                    bucket.refill(now)
+                    budget[key] = int(bucket.tokens)
+                if budget[key] < 1:
+                    self.defer( evid, key, lastTime )
+                    continue
+                budget[key] -= 1
+            due.append( evid )
+        return due
+
+    # Log how many events are waiting, and for which limits
+    def log(self):
+        if not self.deferred:
+            return
+        counts = {}
+        for key in self.blockedBy.values():
+            counts[key] = counts.get(key, 0) + 1
+        waiting = counts.items()
+        waiting.sort(key=lambda item: -item[1])
+        logger.warning( "Rate limits are holding back %d events: %s" % (len(self.deferred),
+                        ', '.join([ '%s %s: %d' % (kind, name, n) for (kind, name), n in waiting[:10] ])) )
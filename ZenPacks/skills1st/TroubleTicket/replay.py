@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Offline replay of recorded events through the zentt cycle.
+#			A dump of the event status table (made with --record on a
+#			Zenoss server) is loaded into FakeEventManager, which stands in
+#			for dmd.ZenEventManager, and run through TicketEngine with a
+#			given zentt.conf. Tickets are created by a stub that only counts
+#			them, or by a ttcommand given on the command line, so rule and
+#			performance changes can be tried without touching live Zenoss
+#			or a real ticket system.
+#
+#			Usage: replay.py [-c zentt.conf] [-n cycles] [-t ttcommand] dump.json ...
+#			       replay.py --record dump.json
+#
+# Updates:
+#
+
+import os, sys, re, time, shutil, tempfile, threading, logging
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from Products.ZenEvents.Exceptions import ZenEventNotFound
+from events import EVENT_FIELDS
+from poller import eventTime
+from settings import DaemonConfig
+from tickets import CommandBackend
+from engine import TicketEngine
+from stats import percentiles
+from shards import shardOf
+
+logger = logging.getLogger('ZenTT')
+
+# Fields that hold times; the fake keeps them as seconds since the epoch
+TIME_FIELDS = ('firstTime', 'lastTime', 'stateChange')
+
+# Values for the fields a dump does not give
+FIELD_DEFAULTS = {
+    'severity': 3,
+    'eventState': 0,
+    'count': 1,
+    'prodState': 1000,
+    'priority': -1,
+    'DevicePriority': 3,
+    'firstTime': 0,
+    'lastTime': 0,
+    'stateChange': 0,
+}
+
+# The where clauses that zentt builds
+QUOTED = r"'((?:[^'\\]|\\.)*)'"
+EVID_IN = re.compile(r"^(?:where\s+)?evid in \((.*)\)$", re.S)
+INCREMENTAL = re.compile(r"^\(lastTime >= ([0-9.]+) or stateChange >= FROM_UNIXTIME\(([0-9]+)\)\)$")
+SET_FIELD = re.compile(r"^update status set (\w+)\s*=\s*(.*)$", re.S)
+CASE_WHEN = re.compile(r"WHEN %s THEN %s" % (QUOTED, QUOTED))
+CONCAT = re.compile(r"^CONCAT\((\w+), %s\)$" % (QUOTED))
+NOT_LIKE = re.compile(r"^(.*) and (\w+) not like %s$" % (QUOTED), re.S)
+SHARD = re.compile(r"^(?:(.*) and )?CRC32\(device\) % ([0-9]+) = ([0-9]+)$", re.S)
+
+# Undo events.sqlQuote
+#
+def sqlUnquote( text ):
+    return re.sub(r"\\(.)", r"\1", text)
+
+def quotedList( text ):
+    return [ sqlUnquote(value) for value in re.findall(QUOTED, text) ]
+
+# Regex for an SQL LIKE pattern (which ignores case, as MySQL does)
+#
+def likePattern( like ):
+    parts = []
+    for c in like:
+        if c == '%':
+            parts.append('.*')
+        elif c == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(c))
+    return re.compile('^%s$' % (''.join(parts)), re.I | re.S)
+
+
+# A row of the fake status table, with the fields as attributes
+#
+class FakeEvent(object):
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+# Enough of ZenEventManager for zentt: the status table is a dictionary
+# of evid -> fields, and deleted events move to a history dictionary.
+# Only the SQL that zentt itself generates is understood; anything else
+# raises ValueError so that a change to the queries is noticed.
+#
+class FakeEventManager(object):
+    def __init__(self, events=()):
+        self.status = {}
+        self.history = {}
+        # (method, number of events) for each write made
+        self.writes = []
+        self.lock = threading.Lock()
+        for fields in events:
+            self.add(fields)
+
+    # Load one or more dumps made by recordEvents
+    def load(cls, paths):
+        zem = cls()
+        for path in paths:
+            f = open(path, 'r')
+            try:
+                dump = json.load(f)
+            finally:
+                f.close()
+            if isinstance(dump, dict):
+                dump = dump['events']
+            for fields in dump:
+                zem.add(fields)
+        return zem
+    load = classmethod(load)
+
+    def add(self, fields):
+        evt = dict.fromkeys(EVENT_FIELDS, '')
+        evt.update(FIELD_DEFAULTS)
+        for name, value in fields.items():
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            evt[str(name)] = value
+        for name in TIME_FIELDS:
+            evt[name] = eventTime(evt[name])
+        self.status[evt['evid']] = evt
+
+    def where(self, clause):
+        clause = clause.strip()
+        if not clause:
+            return lambda evt: True
+        m = NOT_LIKE.match(clause)
+        if m:
+            test = self.where(m.group(1))
+            field = m.group(2)
+            pattern = likePattern(sqlUnquote(m.group(3)))
+            return lambda evt: test(evt) and not pattern.match(str(evt[field]))
+        m = SHARD.match(clause)
+        if m:
+            test = self.where(m.group(1) or '')
+            nshards, index = int(m.group(2)), int(m.group(3))
+            return lambda evt: test(evt) and shardOf(evt['device'], nshards) == index
+        m = EVID_IN.match(clause)
+        if m:
+            evids = set(quotedList(m.group(1)))
+            return lambda evt: evt['evid'] in evids
+        m = INCREMENTAL.match(clause)
+        if m:
+            lastTime = float(m.group(1))
+            stateChange = int(m.group(2))
+            return lambda evt: evt['lastTime'] >= lastTime or evt['stateChange'] >= stateChange
+        raise ValueError("FakeEventManager cannot handle where clause: %s" % (clause))
+
+    def getEventList(self, resultFields=[], where="", orderby="", **kw):
+        test = self.where(where)
+        self.lock.acquire()
+        try:
+            rows = [ evt for evt in self.status.values() if test(evt) ]
+        finally:
+            self.lock.release()
+        if orderby.startswith('lastTime'):
+            rows.sort(key=lambda evt: (evt['lastTime'], evt['firstTime']))
+        return [ FakeEvent(evt) for evt in rows ]
+
+    def getEventDetailFromStatusOrHistory(self, evid):
+        evt = self.status.get(evid) or self.history.get(evid)
+        if evt is None:
+            raise ZenEventNotFound("Event %s not found" % (evid))
+        return FakeEvent(evt)
+
+    def manage_setEventStates(self, eventState=None, evids=()):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for evid in evids:
+                evt = self.status.get(evid)
+                if evt is not None:
+                    evt['eventState'] = eventState
+                    evt['stateChange'] = now
+            self.writes.append( ('manage_setEventStates', len(evids)) )
+        finally:
+            self.lock.release()
+
+    def updateEvents(self, update, whereClause, reason):
+        m = SET_FIELD.match(update.strip())
+        if not m:
+            raise ValueError("FakeEventManager cannot handle update: %s" % (update))
+        field, value = m.group(1), m.group(2).strip()
+        if value.startswith('CASE evid'):
+            values = dict([ (sqlUnquote(evid), sqlUnquote(v)) for evid, v in CASE_WHEN.findall(value) ])
+            newValue = lambda evt: values.get(evt['evid'], evt[field])
+        elif CONCAT.match(value):
+            source, suffix = CONCAT.match(value).groups()
+            suffix = sqlUnquote(suffix)
+            newValue = lambda evt: str(evt[source]) + suffix
+        elif re.match("^%s$" % (QUOTED), value):
+            literal = quotedList(value)[0]
+            newValue = lambda evt: literal
+        else:
+            raise ValueError("FakeEventManager cannot handle update: %s" % (update))
+
+        test = self.where(whereClause)
+        now = time.time()
+        n = 0
+        self.lock.acquire()
+        try:
+            for evt in self.status.values():
+                if test(evt):
+                    evt[field] = newValue(evt)
+                    evt['stateChange'] = now
+                    n += 1
+            self.writes.append( ('updateEvents', n) )
+        finally:
+            self.lock.release()
+
+    def manage_deleteEvents(self, evids=()):
+        self.lock.acquire()
+        try:
+            for evid in evids:
+                evt = self.status.pop(evid, None)
+                if evt is not None:
+                    self.history[evid] = evt
+            self.writes.append( ('manage_deleteEvents', len(evids)) )
+        finally:
+            self.lock.release()
+
+
+# Stands in for a real backend: the request is prepared by the real one,
+# so the templates are exercised, but the ticket is only counted.
+# latency seconds are spent in create() to mimic a slow ticket system.
+#
+class StubBackend(object):
+    def __init__(self, backend, latency=0.0):
+        self.backend = backend
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def prepare(self, data):
+        return self.backend.prepare( data )
+
+    def create(self, payload):
+        if self.latency:
+            time.sleep(self.latency)
+        self.lock.acquire()
+        try:
+            self.created += 1
+            return 'REPLAY-%d' % (self.created)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        pass
+
+
+# Replaces a config's BackendSet, giving each of its backends a
+# stand-in made by factory(backend)
+#
+class ReplayBackends(object):
+    def __init__(self, backends, factory):
+        self.real = backends
+        self.default = backends.default
+        self.backends = {}
+        for name, backend in backends.backends.items():
+            self.backends[name] = factory( backend )
+
+    def forRule(self, rule):
+        return self.backends[ rule.backend or self.default ]
+
+    def get(self, name):
+        return self.backends[ name ]
+
+    def nameOf(self, backend):
+        for name, b in self.backends.items():
+            if b is backend:
+                return name
+        raise KeyError(backend)
+
+    def close(self):
+        closed = []
+        for backend in self.backends.values():
+            if backend not in closed:
+                backend.close()
+                closed.append( backend )
+        self.real.close()
+
+
+# Collects the per-event and per-ticket timings from TicketEngine
+#
+class ReplayTrace(object):
+    def __init__(self):
+        self.eventTimes = []
+        self.ticketTimes = []
+
+    def event(self, evt, seconds):
+        self.eventTimes.append( seconds )
+
+    def job(self, job):
+        self.ticketTimes.extend( job.latencies )
+
+
+# Run the events in zem through cycles zentt cycles with the given
+# config, whose backends should already have been replaced.
+# The state files go in a temporary directory that is removed afterwards.
+# Returns the engine's totals, the trace and the elapsed time.
+#
+def replayEvents( zem, config, cycles=1 ):
+    vardir = tempfile.mkdtemp(prefix='zentt-replay')
+    try:
+        engine = TicketEngine( zem, config, vardir, 'replay' )
+        trace = engine.trace = ReplayTrace()
+        start = time.time()
+        try:
+            for n in range(cycles):
+                engine.runCycle()
+        finally:
+            engine.close()
+        return engine.totals, trace, time.time() - start
+    finally:
+        shutil.rmtree(vardir, True)
+
+# Text report of a replay
+#
+def formatReplay( nevents, cycles, totals, trace, elapsed ):
+    counts = totals.counts
+    times = totals.times
+    lines = []
+    lines.append( "Replayed %d events in %d cycles: %.3fs" % (nevents, cycles, elapsed) )
+    evaluated = counts['eventsEvaluated']
+    if elapsed > 0:
+        lines.append( "  %d events evaluated, %.1f events/s overall" % (evaluated, evaluated / elapsed) )
+    if times['evaluateTime'] > 0:
+        lines.append( "  %.1f events/s while filtering" % (evaluated / times['evaluateTime']) )
+    lines.append( "  Skipped: %d unchanged, %d pending; %d deferred by rate limits, %d held by breakers" %
+                  (counts['eventsUnchanged'], counts['eventsPending'], counts['eventsDeferred'], counts['eventsHeld']) )
+    p50, p90, p99 = percentiles( trace.eventTimes )
+    lines.append( "  Evaluation latency: p50 %.1fus, p90 %.1fus, p99 %.1fus, max %.1fus" %
+                  (p50 * 1000000, p90 * 1000000, p99 * 1000000, max(trace.eventTimes or [0]) * 1000000) )
+    lines.append( "  Tickets: %d created, %d failed; %d events auto-cleared" %
+                  (counts['ticketsCreated'], counts['ticketsFailed'], counts['autoCleared']) )
+    p50, p90, p99 = percentiles( trace.ticketTimes )
+    lines.append( "  Ticket latency: p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms" %
+                  (p50 * 1000, p90 * 1000, p99 * 1000, max(trace.ticketTimes or [0]) * 1000) )
+    for name in ('pollTime', 'fetchTime', 'evaluateTime', 'ticketWaitTime', 'writeTime'):
+        lines.append( "  %-16s %10.3fs" % (name, times[name]) )
+    sections = totals.sections.keys()
+    sections.sort()
+    for section in sections:
+        lines.append( "  Section %s matched %d events" % (section, totals.sections[section]) )
+    return lines
+
+
+# Write the open events from the live Zenoss event status table to a dump
+# file. This needs to run as the zenoss user on the Zenoss server.
+#
+def recordEvents( path ):
+    import Globals
+    from Products.ZenUtils.ZenScriptBase import ZenScriptBase
+    zem = ZenScriptBase(connect=True).dmd.ZenEventManager
+    events = []
+    for row in zem.getEventList(EVENT_FIELDS, "", "lastTime ASC, firstTime ASC"):
+        fields = {}
+        for name in EVENT_FIELDS:
+            value = getattr(row, name, None)
+            if name in TIME_FIELDS:
+                value = eventTime(value)
+            elif value is not None and not isinstance(value, (int, long, float, basestring)):
+                value = str(value)
+            fields[name] = value
+        events.append( fields )
+    tmpfile = path + '.tmp'
+    f = open(tmpfile, 'w')
+    try:
+        json.dump({'recorded': time.time(), 'events': events}, f)
+    finally:
+        f.close()
+    os.rename(tmpfile, path)
+    return len(events)
+
+
+def main( argv ):
+    parser = OptionParser(usage="%prog [options] dump.json ...\n       %prog --record dump.json")
+    parser.add_option('-c', '--config', dest='config',
+                      default=os.path.join(os.environ.get('ZENHOME', '/usr/local/zenoss'), 'etc', 'zentt.conf'),
+                      help="zentt config file to replay with (default %default)")
+    parser.add_option('-n', '--cycles', dest='cycles', type='int', default=1,
+                      help="number of zentt cycles to run (default %default)")
+    parser.add_option('-t', '--ttcommand', dest='ttcommand', default=None,
+                      help="run this command for every ticket instead of counting them")
+    parser.add_option('-l', '--latency', dest='latency', type='float', default=0.0,
+                      help="seconds each counted ticket takes to create (default %default)")
+    parser.add_option('-r', '--record', dest='record', action='store_true', default=False,
+                      help="record the open events from Zenoss into the file given")
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False,
+                      help="show the zentt log messages")
+    options, args = parser.parse_args(argv[1:])
+    if not args:
+        parser.error("no dump file given")
+
+    logging.basicConfig(level=options.verbose and logging.INFO or logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    if options.record:
+        print "Recorded %d events in %s" % (recordEvents( args[0] ), args[0])
+        return 0
+
+    zem = FakeEventManager.load( args )
+    nevents = len(zem.status)
+    config = DaemonConfig( options.config )
+    if options.ttcommand:
+        command = CommandBackend( options.ttcommand )
+        config.backends = ReplayBackends( config.backends, lambda backend: command )
+    else:
+        config.backends = ReplayBackends( config.backends, lambda backend: StubBackend( backend, options.latency ) )
+
+    totals, trace, elapsed = replayEvents( zem, config, options.cycles )
+    for line in formatReplay( nevents, options.cycles, totals, trace, elapsed ):
+        print line
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,588 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Compiled form of the zentt.conf filter sections.
+#			The config file is parsed once into immutable rule objects so that
+#			event matching does not have to walk ConfigParser options, re-read
+#			values or recompile regexes for every event and every section.
+#
+# Updates:
+#
+
+import re, logging
+from bisect import bisect_right
+
+logger = logging.getLogger('ZenTT')
+
+# Sections with special meaning - everything else is a ticket filter section
+# (DEFAULT is never returned by ConfigParser.sections())
+DAEMON_SECTION = 'DAEMONSTUFF'
+AUTOCLEAR_SECTION = 'AUTOCLEAR'
+
+# Integer-valued filters
+INT_FILTERS = ('prodstate', 'eventstate', 'severity')
+
+# Event attributes holding '|'-separated lists of organisers
+MULTI_VALUED = ('DeviceGroups', 'Systems')
+
+# The filters applied by selectEvent, in evaluation order, with the event
+# attribute that each one tests. String filters also have a 'not' form.
+FILTER_ORDER = (
+    ('devicegroups', 'DeviceGroups'),
+    ('device', 'device'),
+    ('deviceclass', 'DeviceClass'),
+    ('prodstate', 'prodState'),
+    ('eventstate', 'eventState'),
+    ('severity', 'severity'),
+    ('summary', 'summary'),
+    ('message', 'message'),
+    ('component', 'component'),
+    ('location', 'Location'),
+    ('systems', 'Systems'),
+    ('ipaddress', 'ipAddress'),
+)
+
+# Exception class for config values that cannot be compiled
+#
+class RuleError(Exception):
+    def __init__(self, errmsg):
+        self.errmsg = errmsg
+
+    def __str__(self):
+        return self.errmsg
+
+# Match a list of strings against the list of regexes or literal strings in a specific config section
+# e.g. to find whether a device group is of interest
+# If no options in the section match the supplied prefix, return the supplied default value
+#
+# This works directly on the ConfigParser object and is kept as the reference
+# for the semantics that the compiled rules below must reproduce.
+#
+def configREMatch( config, s, prefix, list, default ):
+    seen = 0
+    # Compare against all '^<prefix>.*' strings in this config section
+    # First build a pattern to match the options we are interested in
+    optpattern = re.compile( prefix+'-(re-)?', re.IGNORECASE )
+    for opt in config.options(s):
+        # Ignore config options that do not have the prefix of interest
+        m = optpattern.match(opt)
+        if not m: continue
+        # Note that we have seen at least one matching option
+        seen = 1
+        # Is this a regex match item? (name has -re)
+        suffix = m.group(1)
+        if suffix and (suffix.lower() == 're-'):
+            # The option value should be treated as a regex
+            pattern = re.compile( config.get(s, opt).rstrip(), re.IGNORECASE )
+            # Is there a match for that pattern in the supplied list?
+            for item in list:
+                if pattern.search( item ):
+                    return True;
+        else:
+            # Is the exact option value in the supplied list?
+            for item in list:
+                if config.get(s, opt).rstrip().lower() == item.lower():
+                    return True;
+    if seen:
+        # We saw at least one matching option and none of their values matched the list
+        return False
+    else:
+        # We did not see any matching options
+        return default
+
+# Get an integer option value from the config
+#
+def getIntOptValue( config, s, opt ):
+    value = config.get(s, opt).rstrip()
+    if not re.search( '^[-+]?[0-9]+$', value ):
+        logger.error("Option %s in section %s has a non-integer value: %s" % (opt, s, value))
+        return 0
+    return int(value)
+
+# Match an integer against a range specified by -min and -max options
+# or against a list of acceptable values.
+# If the section specifies a range and also a list of values, any
+# values outside the range will not be matched.
+#
+def configIntMatch( config, s, prefix, value ):
+    # First build a pattern to match the options we are interested in
+    optpattern = re.compile( prefix+'-(.+)', re.IGNORECASE )
+    # Assume the value is in range until proved otherwise
+    inrange = 1
+    # Assume the value is not in the list until proved otherwise
+    inlist = 0
+    # We have not yet seen a range spec
+    seenrange = 0
+    # We have not yet seen a list spec
+    seenlist = 0
+
+    # Walk through ALL the options
+    for opt in config.options(s):
+        # Ignore config options that do not have the prefix of interest
+        m = optpattern.match(opt)
+        if not m: continue
+
+        optvalue = getIntOptValue( config, s, opt )
+        suffix = m.group(1)
+
+        # Is this a -min option?
+        if suffix and (suffix.lower() == 'min'):
+            seenrange = 1
+            if value < optvalue:
+                inrange = 0
+            continue
+
+        # Is this a -max option?
+        if suffix and (suffix.lower() == 'max'):
+            seenrange = 1
+            if value > optvalue:
+                inrange = 0
+            continue
+
+        # All other options are assumed to be list values
+        seenlist = 1
+        if value == optvalue:
+            inlist = 1
+
+    # Right, now we need to sort out the result!
+    # If we have a range spec then the value must comply
+    if seenrange and not inrange: return 0
+    # If we have a list spec then the value must comply
+    if seenlist and not inlist: return 0
+    # Default case
+    return 1
+
+
+# The attributes of one event in the form the filters want.
+# Each attribute is split and lowercased at most once, however many
+# sections look at it.
+#
+class EventFields(object):
+    __slots__ = ('evt', '_items', '_lowered')
+
+    def __init__(self, evt):
+        self.evt = evt
+        self._items = {}
+        self._lowered = {}
+
+    # Raw attribute value (used by the integer filters)
+    def value(self, attr):
+        return getattr(self.evt, attr)
+
+    # List of strings for an attribute - organiser attributes are split on '|'
+    def items(self, attr):
+        try:
+            return self._items[attr]
+        except KeyError:
+            value = getattr(self.evt, attr)
+            if attr in MULTI_VALUED:
+                items = value.split('|')
+            else:
+                items = [value]
+            self._items[attr] = items
+            return items
+
+    # Set of lowercased strings for an attribute
+    def lowered(self, attr):
+        try:
+            return self._lowered[attr]
+        except KeyError:
+            lowered = frozenset([item.lower() for item in self.items(attr)])
+            self._lowered[attr] = lowered
+            return lowered
+
+
+# Regexes that cannot safely share an alternation with others:
+# backreferences, conditional references and group names depend on
+# group numbering, and inline flags such as (?x) would apply to the
+# whole alternation.
+UNMERGEABLE = re.compile( r'\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[iLmsux]+\)' )
+
+# Python's re module allows at most 99 groups per expression (100 with
+# the whole match), counting the groups in the regexes themselves as
+# well as the one added around each of them
+MAX_GROUPS = 99
+
+# Combine a list of (option, regex) pairs into as few compiled expressions
+# as possible. Each option becomes a named group so that the option which
+# matched can still be reported.
+# Returns a tuple of (compiled expression, {group name: option}) pairs.
+#
+def compileAlternation( patterns ):
+    automata = []
+    chunks = []
+    chunk = []
+    ngroups = 0
+    for opt, value in patterns:
+        single = re.compile( value, re.IGNORECASE )
+        # This option's group and the regex's own groups
+        needed = 1 + single.groups
+        if UNMERGEABLE.search(value) or needed > MAX_GROUPS:
+            automata.append( (single, {None: opt}) )
+            continue
+        if ngroups + needed > MAX_GROUPS:
+            chunks.append( chunk )
+            chunk = []
+            ngroups = 0
+        chunk.append( (opt, value) )
+        ngroups += needed
+    if chunk:
+        chunks.append( chunk )
+    for chunk in chunks:
+        names = {}
+        alternatives = []
+        for index, (opt, value) in enumerate(chunk):
+            name = 'o%d' % (index)
+            names[name] = opt
+            alternatives.append( '(?P<%s>%s)' % (name, value) )
+        try:
+            automaton = re.compile( '|'.join(alternatives), re.IGNORECASE )
+        except (re.error, AssertionError, OverflowError, RuntimeError) as e:
+            # Something the checks above did not foresee: match these
+            # options one at a time instead
+            logger.debug( "Cannot merge %d regexes (%s), matching them separately" % (len(chunk), e) )
+            for opt, value in chunk:
+                automata.append( (re.compile( value, re.IGNORECASE ), {None: opt}) )
+            continue
+        automata.append( (automaton, names) )
+    return tuple(automata)
+
+
+# Compiled form of all the '<prefix>-*' string options in one section.
+# Literal values are held as a set of lowercased strings so that they can
+# be intersected with the event values. All the regex values are merged
+# into a single alternation so each event string is scanned only once.
+#
+class StringFilter(object):
+    __slots__ = ('prefix', 'literals', 'literalOptions', 'automata')
+
+    # literals is {lowercased value: option}, patterns is a list of (option, regex)
+    def __init__(self, prefix, literals, patterns):
+        object.__setattr__(self, 'prefix', prefix)
+        object.__setattr__(self, 'literals', frozenset(literals))
+        object.__setattr__(self, 'literalOptions', dict(literals))
+        object.__setattr__(self, 'automata', compileAlternation(patterns))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    # Find the option that matches a value of the event attribute
+    # Returns the option name, or None if nothing matches
+    def which(self, fields, attr):
+        if self.literals:
+            common = self.literals.intersection(fields.lowered(attr))
+            if common:
+                return self.literalOptions[min(common)]
+        if self.automata:
+            items = fields.items(attr)
+            for automaton, names in self.automata:
+                for item in items:
+                    m = automaton.search(item)
+                    if m:
+                        return names.get(m.lastgroup, names.get(None))
+        return None
+
+    # Does any value of the event attribute match a literal value or a regex?
+    def match(self, fields, attr):
+        if self.literals and not self.literals.isdisjoint(fields.lowered(attr)):
+            return True
+        for automaton, names in self.automata:
+            for item in fields.items(attr):
+                if automaton.search(item):
+                    return True
+        return False
+
+
+# Compiled form of all the '<prefix>-*' integer options in one section.
+# Several -min (or -max) options all apply, so only the tightest bound is kept.
+#
+class IntFilter(object):
+    __slots__ = ('prefix', 'min', 'max', 'values')
+
+    def __init__(self, prefix, min=None, max=None, values=None):
+        object.__setattr__(self, 'prefix', prefix)
+        object.__setattr__(self, 'min', min)
+        object.__setattr__(self, 'max', max)
+        if values is not None:
+            values = frozenset(values)
+        object.__setattr__(self, 'values', values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def match(self, fields, attr):
+        return self.accepts( fields.value(attr) )
+
+    def accepts(self, value):
+        # If we have a range spec then the value must comply
+        if self.min is not None and value < self.min: return False
+        if self.max is not None and value > self.max: return False
+        # If we have a list spec then the value must comply
+        if self.values is not None and value not in self.values: return False
+        return True
+
+
+# Build a StringFilter from the section options with the given prefix
+# Returns None if the section has no such options
+#
+def compileStringFilter( config, s, prefix ):
+    optpattern = re.compile( prefix+'-(re-)?', re.IGNORECASE )
+    seen = 0
+    literals = {}
+    patterns = []
+    for opt in config.options(s):
+        m = optpattern.match(opt)
+        if not m: continue
+        seen = 1
+        value = config.get(s, opt).rstrip()
+        suffix = m.group(1)
+        if suffix and (suffix.lower() == 're-'):
+            try:
+                re.compile( value, re.IGNORECASE )
+            except (re.error, AssertionError, OverflowError, RuntimeError) as e:
+                raise RuleError("Option %s in section %s has a bad regular expression: %s (%s)" % (opt, s, value, e))
+            patterns.append( (opt, value) )
+        else:
+            literals[value.lower()] = opt
+    if not seen:
+        return None
+    return StringFilter( prefix, literals, patterns )
+
+# Build an IntFilter from the section options with the given prefix
+# Returns None if the section has no such options
+#
+def compileIntFilter( config, s, prefix ):
+    optpattern = re.compile( prefix+'-(.+)', re.IGNORECASE )
+    seen = 0
+    lo = None
+    hi = None
+    values = None
+    for opt in config.options(s):
+        m = optpattern.match(opt)
+        if not m: continue
+        seen = 1
+        optvalue = getIntOptValue( config, s, opt )
+        suffix = m.group(1).lower()
+        if suffix == 'min':
+            if lo is None or optvalue > lo: lo = optvalue
+        elif suffix == 'max':
+            if hi is None or optvalue < hi: hi = optvalue
+        else:
+            if values is None: values = []
+            values.append( optvalue )
+    if not seen:
+        return None
+    return IntFilter( prefix, lo, hi, values )
+
+
+# All the filters and parameters from one config section
+#
+class SectionRule(object):
+    __slots__ = ('name', 'checks', 'params', 'backend', 'limit')
+
+    def __init__(self, name, checks, params, backend=None, limit=None):
+        object.__setattr__(self, 'name', name)
+        # Tuple of (prefix, attribute, filter, negate) in evaluation order.
+        # Filters not mentioned in the section are left out altogether.
+        object.__setattr__(self, 'checks', tuple(checks))
+        # The 'param-*' options of the section
+        object.__setattr__(self, 'params', dict(params))
+        # The ticket backend named by the section's 'ttbackend' option, if any
+        object.__setattr__(self, 'backend', backend)
+        # (tickets per minute, burst) from the 'ratelimit' options, or None
+        object.__setattr__(self, 'limit', limit)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+# Relative cost of a check, used to try the cheapest ones first:
+# integer comparisons, then set lookups, then regex scans.
+# All the checks must pass, so the order does not change the result.
+#
+def checkCost( check ):
+    f = check[2]
+    if isinstance(f, IntFilter):
+        return 0
+    if not f.automata:
+        return 1
+    return 2
+
+# Get a rate limit option, which must be a whole number
+#
+def rateOption( config, s, opt ):
+    value = config.get(s, opt).strip()
+    if not re.search( '^[0-9]+$', value ):
+        raise RuleError("Option %s in section %s must be a whole number of tickets per minute, not %s" % (opt, s, value))
+    return int(value)
+
+# Compile one config section
+#
+def compileSection( config, s ):
+    checks = []
+    for prefix, attr in FILTER_ORDER:
+        if prefix in INT_FILTERS:
+            f = compileIntFilter( config, s, prefix )
+            if f: checks.append( (prefix, attr, f, False) )
+            continue
+        f = compileStringFilter( config, s, prefix )
+        if f: checks.append( (prefix, attr, f, False) )
+        f = compileStringFilter( config, s, 'not'+prefix )
+        if f: checks.append( ('not'+prefix, attr, f, True) )
+
+    params = {}
+    optpattern = re.compile( 'param-', re.IGNORECASE )
+    for opt in config.options(s):
+        if optpattern.match(opt):
+            params[opt] = config.get(s, opt).rstrip()
+
+    backend = None
+    if config.has_option(s, 'ttbackend'):
+        backend = config.get(s, 'ttbackend').strip()
+
+    limit = None
+    if config.has_option(s, 'ratelimit'):
+        rate = rateOption( config, s, 'ratelimit' )
+        burst = rate
+        if config.has_option(s, 'ratelimit-burst'):
+            burst = rateOption( config, s, 'ratelimit-burst' )
+        if rate > 0:
+            limit = (rate, max(1, burst))
+
+    # sort() is stable so checks of equal cost keep the FILTER_ORDER sequence
+    checks.sort( key=checkCost )
+    return SectionRule( s, checks, params, backend, limit )
+
+
+# Index of the sections by the values one integer attribute may take.
+# The integer line is cut at every bound and listed value that any
+# section mentions; within each interval every section either accepts
+# all values or none, so each interval holds the set of sections
+# (by position) that can accept it.
+#
+class IntIndex(object):
+    __slots__ = ('attr', 'starts', 'buckets')
+
+    def __init__(self, attr, prefix, sections):
+        object.__setattr__(self, 'attr', attr)
+        filters = []
+        points = set()
+        for index, rule in enumerate(sections):
+            f = None
+            for check in rule.checks:
+                if check[0] == prefix:
+                    f = check[2]
+            filters.append( (index, f) )
+            if f is None: continue
+            if f.min is not None: points.add( f.min )
+            if f.max is not None: points.add( f.max + 1 )
+            if f.values is not None:
+                for v in f.values:
+                    points.add( v )
+                    points.add( v + 1 )
+        starts = sorted(points)
+        # Bucket 0 is everything below the first start point,
+        # bucket i is the interval [starts[i-1], starts[i])
+        if starts:
+            samples = [ starts[0] - 1 ] + starts
+        else:
+            samples = [ 0 ]
+        buckets = []
+        for sample in samples:
+            buckets.append( frozenset([ index for index, f in filters
+                                        if f is None or f.accepts(sample) ]) )
+        object.__setattr__(self, 'starts', tuple(starts))
+        object.__setattr__(self, 'buckets', tuple(buckets))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    # Positions of the sections that can accept this value
+    def lookup(self, value):
+        return self.buckets[ bisect_right(self.starts, value) ]
+
+# Build the indexes for all the integer filters
+#
+def buildIndexes( sections ):
+    indexes = []
+    for prefix, attr in FILTER_ORDER:
+        if prefix in INT_FILTERS:
+            indexes.append( IntIndex( attr, prefix, sections ) )
+    return tuple(indexes)
+
+
+# The whole config file in compiled form
+#
+class RuleSet(object):
+    __slots__ = ('sections', 'autoclear', 'daemonOptions', 'multiTicket', 'indexes')
+
+    def __init__(self, sections, autoclear, daemonOptions, multiTicket):
+        # Ticket filter sections, in the order they are to be tried
+        object.__setattr__(self, 'sections', tuple(sections))
+        # Pre-filter on the integer attributes
+        object.__setattr__(self, 'indexes', buildIndexes(self.sections))
+        # The AUTOCLEAR filter, or None
+        object.__setattr__(self, 'autoclear', autoclear)
+        # All the DAEMONSTUFF options, trailing spaces removed
+        object.__setattr__(self, 'daemonOptions', dict(daemonOptions))
+        object.__setattr__(self, 'multiTicket', multiTicket)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    # Get a DAEMONSTUFF option, or the default if it is not set
+    def option(self, name, default=None):
+        return self.daemonOptions.get(name, default)
+
+    # The sections whose integer filters accept the event, in the order
+    # they are to be tried. Only these need to be passed to selectEvent.
+    def candidates(self, fields):
+        found = None
+        for index in self.indexes:
+            positions = index.lookup( fields.value(index.attr) )
+            if found is None:
+                found = positions
+            else:
+                found = found.intersection(positions)
+            if not found:
+                return []
+        sections = self.sections
+        return [ sections[i] for i in sorted(found) ]
+
+# Compile a ConfigParser object into a RuleSet
+#
+def compileConfig( config ):
+    daemonOptions = {}
+    if config.has_section(DAEMON_SECTION):
+        for opt in config.options(DAEMON_SECTION):
+            daemonOptions[opt] = config.get(DAEMON_SECTION, opt).rstrip()
+
+    # Do we want to allow the creation of multiple tickets for a single event?
+    multiTicket = daemonOptions.get('multi-ticket', '0')
+    multiTicket = (multiTicket == '1') or (multiTicket.lower() == 'yes')
+
+    autoclear = None
+    if config.has_section(AUTOCLEAR_SECTION):
+        autoclear = compileSection( config, AUTOCLEAR_SECTION )
+
+    # Consider the sections in alphabetical order, ignoring case
+    sections = []
+    for s in sorted(config.sections(), key=str.lower):
+        if (s == DAEMON_SECTION) or (s == AUTOCLEAR_SECTION):
+            continue
+        sections.append( compileSection( config, s ) )
+
+    return RuleSet( sections, autoclear, daemonOptions, multiTicket )
+
+
+# Filter code to select events that match in a section
+# Pass in the EventFields when testing one event against many sections
+# so that its attributes are only prepared once.
+def selectEvent( rule, evt, fields=None ):
+    if fields is None:
+        fields = EventFields(evt)
+    for prefix, attr, f, negate in rule.checks:
+        if f.match( fields, attr ) == negate:
+            logger.debug( "%s match fails" % (prefix) )
+            return 0
+
+    # We want this one!
+    return 1
@@ -0,0 +1,90 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Timing of the zentt main loop.
+#			Cycles start at a fixed cadence, measured from the start of
+#			one cycle to the start of the next, so the time spent working
+#			does not add to the period and errors do not build up.
+#			The period shortens (down to mincycletime) while events keep
+#			arriving and lengthens again (up to maxcycletime) when quiet.
+#
+# Updates:
+#
+
+import time, logging
+
+logger = logging.getLogger('ZenTT')
+
+# Default shortest cycle time, in seconds, while events are arriving
+DEFAULT_MINCYCLETIME = 10
+
+# No cycle time may be set below this, so that zentt never polls the
+# database in a busy loop
+SHORTEST_CYCLETIME = 1
+
+
+class CycleScheduler(object):
+    def __init__(self, cycletime, mincycletime=None, maxcycletime=None):
+        self.configure(cycletime, mincycletime, maxcycletime)
+        self.interval = self.cycletime
+        # Time at which the current cycle was due to start
+        self.due = None
+        self.started = None
+        self.overruns = 0
+
+    # Set the cycle times, e.g. when the config file has been reloaded
+    def configure(self, cycletime, mincycletime=None, maxcycletime=None):
+        self.cycletime = max(float(cycletime), SHORTEST_CYCLETIME)
+        if mincycletime is None:
+            mincycletime = DEFAULT_MINCYCLETIME
+        if maxcycletime is None:
+            maxcycletime = self.cycletime
+        mincycletime = max(float(mincycletime), SHORTEST_CYCLETIME)
+        self.mincycletime = min(mincycletime, self.cycletime)
+        self.maxcycletime = max(float(maxcycletime), self.cycletime)
+        if hasattr(self, 'interval'):
+            self.interval = min(self.maxcycletime, max(self.mincycletime, self.interval))
+
+    # Called at the top of each cycle
+    def start(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.due is None:
+            self.due = now
+        self.started = now
+
+    # Called at the end of each cycle with the number of events that had
+    # to be looked at. Returns the number of seconds until the next cycle.
+    def finish(self, activity, now=None):
+        if now is None:
+            now = time.time()
+        duration = now - self.started
+
+        if duration > self.interval:
+            self.overruns += 1
+            logger.warning("Cycle took %.1f seconds, longer than the %.1f second cycle time" %
+                           (duration, self.interval))
+
+        # Poll faster while there is work arriving, slow down when there is not
+        if activity:
+            self.interval = max(self.mincycletime, self.interval / 2)
+        elif self.interval < self.cycletime:
+            self.interval = min(self.cycletime, self.interval * 2)
+        else:
+            self.interval = min(self.maxcycletime, self.interval * 1.5)
+
+        # The next cycle is due one interval after this one was due, not
+        # after it finished. If we are already late, start again from now
+        # rather than running a string of cycles back to back; if the clock
+        # has been put back, also start again from now.
+        self.due = self.due + self.interval
+        if self.due < now:
+            self.due = now
+        elif self.due > now + self.interval:
+            self.due = now + self.interval
+        return self.due - now
+
+    def sleep(self, activity):
+        delay = self.finish(activity)
+        logger.debug('End of cycle - sleeping for %.1f seconds', delay)
+        if delay > 0:
+            time.sleep(delay)
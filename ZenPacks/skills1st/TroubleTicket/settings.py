@@ -0,0 +1,148 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Loading of $ZENHOME/etc/zentt.conf.
+#			The whole file is read, compiled and checked in one go, so
+#			that a new version can be tried out while the old one is
+#			still in use and only swapped in if it is good.
+#
+# Updates:
+#
+
+import os, hashlib, logging, ConfigParser, StringIO
+from rules import compileConfig, RuleError, DAEMON_SECTION
+from tickets import BackendSet, TicketError, DEFAULT_CONCURRENCY, DEFAULT_TIMEOUT
+from events import DEFAULT_FETCHSIZE
+from writer import DEFAULT_WRITEBATCH
+from outbox import DEFAULT_RETRYTIME, DEFAULT_RETRYMAX, DEFAULT_RETRYLIMIT
+from cache import DEFAULT_CACHESIZE
+from scheduler import DEFAULT_MINCYCLETIME, SHORTEST_CYCLETIME
+from breaker import DEFAULT_BREAKERFAILURES, DEFAULT_BREAKERPROBE
+from shards import DEFAULT_SHARDS
+from eventloop import DEFAULT_LOOP_CONCURRENCY
+
+logger = logging.getLogger('ZenTT')
+
+# Modification time of the config file, or None if it cannot be seen
+#
+def configMtime( path ):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+# A complete, checked configuration: the compiled rules, the ticket
+# backends and the DAEMONSTUFF settings that the daemon uses.
+# Raises RuleError or TicketError if the file cannot be used.
+#
+class DaemonConfig(object):
+    def __init__(self, path):
+        self.path = path
+        self.mtime = configMtime(path)
+        try:
+            f = open(path, 'rb')
+            try:
+                text = f.read()
+            finally:
+                f.close()
+        except IOError as e:
+            raise RuleError("Cannot read %s: %s" % (path, e.strerror))
+
+        # The same as poller.configGeneration(), but for exactly the text we use
+        self.generation = hashlib.md5(text).hexdigest()
+
+        config = ConfigParser.ConfigParser()
+        try:
+            config.readfp(StringIO.StringIO(text), path)
+        except ConfigParser.Error as e:
+            raise RuleError(str(e))
+        self.rules = compileConfig( config )
+
+        self.cycletime = self.intOption("cycletime", None, SHORTEST_CYCLETIME)
+        self.mincycletime = self.intOption("mincycletime", DEFAULT_MINCYCLETIME, SHORTEST_CYCLETIME)
+        self.maxcycletime = self.intOption("maxcycletime", self.cycletime, SHORTEST_CYCLETIME)
+        self.resynctime = self.intOption("resynctime", 3600, 0)
+        self.fetchsize = self.intOption("fetchsize", DEFAULT_FETCHSIZE, 1)
+        self.writebatch = self.intOption("writebatch", DEFAULT_WRITEBATCH, 1)
+        self.retrytime = self.intOption("retrytime", DEFAULT_RETRYTIME, 1)
+        self.retrymax = self.intOption("retrymax", DEFAULT_RETRYMAX, 1)
+        self.retrylimit = self.intOption("retrylimit", DEFAULT_RETRYLIMIT, 0)
+        self.cachesize = self.intOption("cachesize", DEFAULT_CACHESIZE, 0)
+        self.persistcache = self.rules.option("persistcache", "no").lower() in ('yes', '1', 'true')
+        self.profile = self.rules.option("profile", "no").lower() in ('yes', '1', 'true')
+        # Run ticket commands from an event loop (only read when zentt starts)
+        self.eventloop = self.rules.option("eventloop", "no").lower() in ('yes', '1', 'true')
+        # The event loop can have many more tickets in progress than there are threads
+        if self.eventloop:
+            self.concurrency = self.intOption("max-concurrent-tickets", DEFAULT_LOOP_CONCURRENCY, 1)
+        else:
+            self.concurrency = self.intOption("max-concurrent-tickets", DEFAULT_CONCURRENCY, 1)
+        # Tickets per minute for each ticket target, 0 for no limit
+        self.targetRate = self.intOption("ratelimit-target", 0, 0)
+        self.targetBurst = self.intOption("ratelimit-target-burst", self.targetRate, 0)
+        self.ratelimitKey = self.rules.option("ratelimit-key")
+        # Failures in a row that take a ticket backend out of use (0 never),
+        # and the seconds between probes while it is out of use
+        self.breakerFailures = self.intOption("breaker-failures", DEFAULT_BREAKERFAILURES, 0)
+        self.breakerProbe = self.intOption("breaker-probetime", DEFAULT_BREAKERPROBE, 1)
+        # Number of worker processes sharing the events between them
+        self.shards = self.intOption("shards", DEFAULT_SHARDS, 1)
+        # Seconds a ticket may take, read by the backends themselves
+        self.tttimeout = self.numberOption("tttimeout", DEFAULT_TIMEOUT)
+
+        # Built last: backends may hold resources that would need closing
+        self.backends = BackendSet( self.rules )
+
+    # Get a whole number DAEMONSTUFF option, which must be at least minimum
+    def intOption(self, name, default=None, minimum=None):
+        value = self.rules.option(name, default)
+        if value is None:
+            raise RuleError("%s must be set in the %s section" % (name, DAEMON_SECTION))
+        try:
+            value = int(value)
+        except ValueError:
+            raise RuleError("%s in the %s section must be a whole number, not %s" % (name, DAEMON_SECTION, value))
+        if minimum is not None and value < minimum:
+            raise RuleError("%s in the %s section must be at least %d, not %d" % (name, DAEMON_SECTION, minimum, value))
+        return value
+
+    # Get a DAEMONSTUFF option that must be a number of seconds above 0
+    def numberOption(self, name, default):
+        value = self.rules.option(name, default)
+        try:
+            number = float(value)
+        except ValueError:
+            raise RuleError("%s in the %s section must be a number, not %s" % (name, DAEMON_SECTION, value))
+        if not number > 0:
+            raise RuleError("%s in the %s section must be more than 0, not %s" % (name, DAEMON_SECTION, value))
+        return number
+
+    # Has the file changed since this version was read?
+    def changed(self):
+        return configMtime(self.path) != self.mtime
+
+
+# Load a new version of the config file, checking it fully before use.
+# Returns the new config, or the current one if the new file cannot be used.
+#
+def reloadConfig( config ):
+    try:
+        newconfig = DaemonConfig( config.path )
+    except (RuleError, TicketError) as e:
+        logger.error( "Keeping the current configuration - cannot use %s: %s" % (config.path, e.errmsg) )
+        # Do not try again until the file changes again
+        config.mtime = configMtime( config.path )
+        return config
+    except Exception:
+        # Whatever is wrong with the new file, zentt carries on with the old one
+        logger.exception( "Keeping the current configuration - cannot use %s" % (config.path) )
+        config.mtime = configMtime( config.path )
+        return config
+    if newconfig.generation == config.generation:
+        # Only touched: keep the backends we have, with their connections
+        logger.info( "%s has not changed" % (config.path) )
+        newconfig.backends.close()
+        config.mtime = newconfig.mtime
+        return config
+    logger.info( "Loaded new configuration from %s: %d filter sections" % (config.path, len(newconfig.rules.sections)) )
+    return newconfig
@@ -0,0 +1,216 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Sharded running of zentt. When the DAEMONSTUFF 'shards'
+#			option is more than 1, the daemon becomes a supervisor that
+#			forks one worker process per shard. Each worker handles the
+#			events of the devices whose name hashes to its shard, so the
+#			events of any one device are always handled by the same worker
+#			and in order. Each worker has its own pidfile and its own poll,
+#			outbox, cache and stats files under $ZENHOME/var.
+#
+# Updates:
+#
+
+import os, time, errno, signal, zlib, logging
+from stats import readStats
+
+logger = logging.getLogger('ZenTT')
+
+# Default number of worker processes: 1 runs zentt as a single process
+DEFAULT_SHARDS = 1
+
+# Shortest time, in seconds, between starts of the same worker, so that
+# a worker that keeps failing is not restarted in a tight loop
+RESTART_DELAY = 10
+
+# Seconds between the supervisor's checks on its workers
+SUPERVISE_INTERVAL = 2
+
+# A worker that has not finished a cycle in this many times maxcycletime
+# is reported as stalled by 'zentt status'
+STALL_CYCLES = 3
+
+# The shard, from 0 to nshards-1, that a device belongs to. CRC-32 of
+# the device name does not change between runs or processes, unlike hash().
+#
+def shardOf( device, nshards ):
+    return (zlib.crc32( str(device) ) & 0xffffffff) % nshards
+
+# Name used for the state files of a worker, e.g. zentt-1-poll.state
+#
+def shardName( index ):
+    return 'zentt-%d' % (index + 1)
+
+def shardPidfile( vardir, index ):
+    return os.path.join( vardir, 'zentt-localhost-%d.pid' % (index + 1) )
+
+# Process ID in a pidfile, or None
+#
+def readPid( path ):
+    try:
+        f = open(path, 'r')
+        try:
+            return int(f.read().strip())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+def pidRunning( pid ):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+# One worker's part of the events
+#
+class Shard(object):
+    __slots__ = ('index', 'count')
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    def owns(self, evt):
+        return shardOf( evt.device, self.count ) == self.index
+
+    # SQL condition for the events this shard owns. MySQL's CRC32() is the
+    # same CRC-32 as shardOf() uses.
+    def where(self):
+        return "CRC32(device) %% %d = %d" % (self.count, self.index)
+
+    def __str__(self):
+        return '%d/%d' % (self.index + 1, self.count)
+
+
+# Starts a worker process for each shard and starts it again if it dies.
+# runWorker(shard) is called in the new process; when it returns (or
+# raises SystemExit) the process exits without running the parent's
+# exit handlers. A worker is only ever started again once the old one
+# has been seen to exit, so no two workers handle the same events.
+#
+class ShardSupervisor(object):
+    def __init__(self, nshards, runWorker):
+        self.nshards = nshards
+        self.runWorker = runWorker
+        # pid -> shard index of the running workers
+        self.workers = {}
+        # shard index -> time it was last started
+        self.started = {}
+        # shard indexes waiting to be started again
+        self.restarts = []
+
+    def startWorker(self, index):
+        self.started[index] = time.time()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                try:
+                    self.runWorker( Shard(index, self.nshards) )
+                    status = 0
+                except SystemExit as e:
+                    if isinstance(e.code, int):
+                        status = e.code
+                    elif e.code is None:
+                        status = 0
+                except:
+                    logger.exception( "zentt worker %d/%d failed" % (index + 1, self.nshards) )
+            finally:
+                logging.shutdown()
+                os._exit(status)
+        self.workers[pid] = index
+        logger.info( "Started zentt worker %d/%d, pid %d" % (index + 1, self.nshards, pid) )
+
+    def startAll(self):
+        self.restarts = []
+        for index in range(self.nshards):
+            self.startWorker( index )
+
+    # Notice the workers that have exited, and start again those that are due
+    def check(self, now=None):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self.workers = {}
+                break
+            if pid == 0:
+                break
+            index = self.workers.pop(pid, None)
+            if index is None:
+                continue
+            if os.WIFSIGNALED(status):
+                how = 'was killed by signal %d' % (os.WTERMSIG(status))
+            else:
+                how = 'exited with status %d' % (os.WEXITSTATUS(status))
+            logger.error( "zentt worker %d/%d (pid %d) %s - it will be restarted"
+                          % (index + 1, self.nshards, pid, how) )
+            self.restarts.append( index )
+
+        if now is None:
+            now = time.time()
+        for index in self.restarts[:]:
+            if now - self.started.get(index, 0) >= RESTART_DELAY:
+                self.restarts.remove( index )
+                self.startWorker( index )
+
+    def signalAll(self, signum):
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    # Stop all the workers and wait for them to finish their tickets
+    # and writes. No worker is started again until startAll().
+    def stopAll(self):
+        self.restarts = []
+        self.signalAll( signal.SIGTERM )
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            index = self.workers.pop(pid, None)
+            if index is not None:
+                logger.info( "zentt worker %d/%d (pid %d) has stopped" % (index + 1, self.nshards, pid) )
+        self.workers = {}
+
+
+# Lines for 'zentt status' about each worker: whether it is running and
+# how long ago it last finished a cycle. A worker that has not finished
+# one for stalltime seconds is reported as stalled.
+#
+def workerStatus( vardir, nshards, stalltime, now=None ):
+    if now is None:
+        now = time.time()
+    lines = []
+    for index in range(nshards):
+        label = 'worker %d/%d' % (index + 1, nshards)
+        pid = readPid( shardPidfile(vardir, index) )
+        if not pid or not pidRunning(pid):
+            lines.append( '%s: not running' % (label) )
+            continue
+        try:
+            state = readStats( os.path.join(vardir, shardName(index) + '-stats.json') )
+        except (IOError, ValueError):
+            state = None
+        if state is None or state.get('pid') != pid:
+            lines.append( '%s: running; pid=%s, no cycle finished yet' % (label, pid) )
+            continue
+        age = now - state['updated']
+        last = state['lastCycle']
+        health = 'running'
+        if age > stalltime:
+            health = 'STALLED'
+        lines.append( '%s: %s; pid=%s, %d cycles, last cycle %.0fs ago (%d events evaluated, %d tickets created)'
+                      % (label, health, pid, state['cycles'], age, last['eventsEvaluated'], last['ticketsCreated']) )
+    return lines
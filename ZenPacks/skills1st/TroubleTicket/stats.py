@@ -0,0 +1,186 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Performance statistics for zentt.
+#			Counters and timings are gathered for each cycle and written,
+#			with running totals since the daemon started, to a JSON file
+#			under $ZENHOME/var that 'zentt stats' reads and prints.
+#
+# Updates:
+#
+
+import os, time, logging
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+logger = logging.getLogger('ZenTT')
+
+COUNTERS = (
+    'eventsPolled',         # events returned by the poll
+    'eventsFetched',        # events whose details were loaded
+    'eventsPending',        # skipped as earlier work on them is not finished
+    'eventsUnchanged',      # skipped as unchanged since last looked at
+    'eventsEvaluated',      # compared against the filter sections
+    'eventsDeferred',       # held back by the rate limits
+    'eventsHeld',           # held back while their ticket backend is out of use
+    'ticketsCreated',
+    'ticketsFailed',
+    'ticketRetries',        # tickets retried from the outbox
+    'autoCleared',
+)
+
+TIMERS = (
+    'pollTime',             # finding the new and changed events
+    'fetchTime',            # loading event details
+    'evaluateTime',         # filtering and preparing tickets
+    'ticketWaitTime',       # waiting for tickets at the end of the cycle
+    'writeTime',            # acks, ownerids and AUTOCLEAR writes
+    'cycleTime',            # the whole cycle
+)
+
+# Upper bounds, in seconds, of the ticket latency histogram buckets.
+# The last bucket counts everything slower.
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class CycleStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.times = dict.fromkeys(TIMERS, 0.0)
+        # section name -> number of events it matched
+        self.sections = {}
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def addTime(self, name, seconds):
+        self.times[name] += seconds
+
+    def matched(self, section):
+        self.sections[section] = self.sections.get(section, 0) + 1
+
+    def ticketLatency(self, seconds):
+        for n in range(len(LATENCY_BUCKETS)):
+            if seconds <= LATENCY_BUCKETS[n]:
+                self.latency[n] += 1
+                return
+        self.latency[-1] += 1
+
+    # Add another set of statistics into these, for the running totals
+    def merge(self, other):
+        for name in COUNTERS:
+            self.counts[name] += other.counts[name]
+        for name in TIMERS:
+            self.times[name] += other.times[name]
+        for section, n in other.sections.items():
+            self.sections[section] = self.sections.get(section, 0) + n
+        for n in range(len(self.latency)):
+            self.latency[n] += other.latency[n]
+
+    def asDict(self):
+        result = {}
+        result.update(self.counts)
+        for name in TIMERS:
+            result[name] = round(self.times[name], 4)
+        result['sectionMatches'] = self.sections
+        result['ticketLatency'] = self.latency
+        return result
+
+
+# Nearest-rank percentiles of a list of numbers, as a list in the order
+# of points. An empty list gives zeros.
+#
+def percentiles( values, points=(50, 90, 99) ):
+    values = sorted(values)
+    result = []
+    for p in points:
+        if not values:
+            result.append( 0 )
+            continue
+        rank = int(round( p / 100.0 * len(values) + 0.5 ))
+        result.append( values[ min(len(values), max(1, rank)) - 1 ] )
+    return result
+
+
+# Pass on the items of an iterable, adding the time taken to produce
+# them (but not the time spent by the caller on each) to a timer
+#
+def timed( iterable, stats, name ):
+    it = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = it.next()
+        except StopIteration:
+            stats.addTime(name, time.time() - start)
+            return
+        stats.addTime(name, time.time() - start)
+        yield item
+
+
+# Write the last cycle's statistics and the totals, replacing the old
+# file in one step so that readers never see half of it
+#
+def writeStats( path, started, cycles, last, totals ):
+    state = {
+        'pid': os.getpid(),
+        'started': started,
+        'updated': time.time(),
+        'cycles': cycles,
+        'latencyBuckets': list(LATENCY_BUCKETS),
+        'lastCycle': last.asDict(),
+        'totals': totals.asDict(),
+    }
+    tmpfile = path + '.tmp'
+    try:
+        f = open(tmpfile, 'w')
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(tmpfile, path)
+    except (IOError, OSError) as e:
+        logger.warning("Cannot write statistics to %s: %s" % (path, e))
+
+def readStats( path ):
+    f = open(path, 'r')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+# Text for 'zentt stats'. The first line is in the Nagios plugin format,
+# so a Zenoss COMMAND datasource running 'zentt stats' can graph the last
+# cycle's figures as datapoints.
+#
+def formatStats( state ):
+    last = state['lastCycle']
+    totals = state['totals']
+    perf = [ '%s=%s' % (name, last[name]) for name in COUNTERS + TIMERS ]
+    lines = [ 'zentt OK - %d cycles since %s|%s' % (state['cycles'],
+                  time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['started'])), ' '.join(perf)) ]
+    lines.append( 'Last updated: %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['updated']))) )
+    lines.append( '%-20s %12s %12s' % ('', 'last cycle', 'total') )
+    for name in COUNTERS:
+        lines.append( '%-20s %12d %12d' % (name, last[name], totals[name]) )
+    for name in TIMERS:
+        lines.append( '%-20s %12.3f %12.3f' % (name, last[name], totals[name]) )
+
+    lines.append( 'Ticket latency:' )
+    bounds = [ '<= %ss' % (b) for b in state['latencyBuckets'] ] + [ '> %ss' % (state['latencyBuckets'][-1]) ]
+    for n in range(len(bounds)):
+        lines.append( '  %-18s %12d %12d' % (bounds[n], last['ticketLatency'][n], totals['ticketLatency'][n]) )
+
+    lines.append( 'Section matches:' )
+    sections = totals['sectionMatches'].keys()
+    sections.sort()
+    for section in sections:
+        lines.append( '  %-18s %12d %12d' % (section, last['sectionMatches'].get(section, 0),
+                                             totals['sectionMatches'][section]) )
+    return lines
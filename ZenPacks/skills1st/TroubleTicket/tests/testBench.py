@@ -0,0 +1,65 @@
+#
+# Tests for the matching benchmarks.
+#
+
+import unittest
+
+from ZenPacks.skills1st.TroubleTicket.bench import syntheticConfig, syntheticEvents, parseConfig, \
+     runCase, compareResults, benchReference, referenceSelect
+from ZenPacks.skills1st.TroubleTicket.rules import compileConfig
+
+
+class TestBench(unittest.TestCase):
+    def testSyntheticDataRepeats(self):
+        self.assertEqual(syntheticConfig(20), syntheticConfig(20))
+        self.assertEqual([evt.evid for evt in syntheticEvents(50)],
+                         [evt.evid for evt in syntheticEvents(50)])
+
+    def testSyntheticConfigCompiles(self):
+        rules = compileConfig(parseConfig(syntheticConfig(30, share=1.0)))
+        self.assertEqual(len(rules.sections), 30)
+        self.assertTrue('%evid%' in rules.option('ttcommand'))
+
+    def testCases(self):
+        for case in ('select', 'template', 'reference'):
+            result = runCase(case, 20, 100, 0.5)
+            self.assertTrue(result['eventsPerSecond'] > 0)
+            self.assertTrue(result['p50us'] <= result['p99us'] <= result['maxus'])
+        self.assertTrue(result['agrees'])
+
+    def testDisagreementFound(self):
+        text = syntheticConfig(20, share=0.5)
+        rules = compileConfig(parseConfig(text))
+        events = syntheticEvents(100)
+        config = parseConfig(text)
+        self.assertTrue(benchReference(config, rules, events)['agrees'])
+        # Stop the first section that matches anything from matching in the reference
+        first = None
+        for evt in events:
+            for s in [ rule.name for rule in rules.sections ]:
+                if referenceSelect(config, s, evt):
+                    first = (evt.evid, s)
+                    break
+            if first is not None:
+                break
+        config.set(first[1], 'severity-max', '-1')
+        result = benchReference(config, rules, events)
+        self.assertFalse(result['agrees'])
+        self.assertEqual(result['disagreement'], 'event %s section %s: compiled rules match, reference does not' % first)
+
+    def testCompare(self):
+        def results(speed):
+            return {'seed': 1, 'regexShare': 0.5, 'results': [
+                {'case': 'select', 'sections': 10, 'totalEvents': 1000, 'eventsPerSecond': speed, 'p99us': 10.0}]}
+        lines, regressions = compareResults(results(1000.0), results(800.0), 10)
+        self.assertEqual(regressions, 1)
+        self.assertTrue(lines[0].endswith('REGRESSION'))
+        lines, regressions = compareResults(results(1000.0), results(950.0), 10)
+        self.assertEqual(regressions, 0)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestBench))
+    return suite
@@ -0,0 +1,162 @@
+#
+# Tests for the ticket backend circuit breakers and command timeouts.
+#
+
+import os, time, shutil, tempfile, unittest
+
+from ZenPacks.skills1st.TroubleTicket.breaker import CircuitBreaker, CLOSED, OPEN, HALFOPEN
+from ZenPacks.skills1st.TroubleTicket.tickets import runTicketCommand, TicketError
+from ZenPacks.skills1st.TroubleTicket.settings import DaemonConfig
+from ZenPacks.skills1st.TroubleTicket.engine import TicketEngine
+from ZenPacks.skills1st.TroubleTicket.replay import FakeEventManager, ReplayBackends
+
+CONFIG = """
+[DAEMONSTUFF]
+ttcommand: /bin/echo %evid%
+cycletime: 60
+breaker-failures: 2
+breaker-probetime: 300
+
+[Linux]
+devicegroups-1: /Linux
+"""
+
+
+# Stands in for a ticket backend on a host that can be taken down
+class FlakyBackend(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.working = False
+        self.created = 0
+
+    def prepare(self, data):
+        return self.backend.prepare( data )
+
+    def create(self, payload):
+        if not self.working:
+            raise TicketError("ssh: connect to host tickets.example.com port 22: Connection timed out")
+        self.created += 1
+        return 'TT-%d' % (self.created)
+
+    def close(self):
+        pass
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def testOpensAfterFailuresInARow(self):
+        breaker = CircuitBreaker('command', 3, 60)
+        breaker.failed(now=0.0)
+        breaker.failed(now=1.0)
+        breaker.succeeded(now=2.0)
+        breaker.failed(now=3.0)
+        breaker.failed(now=4.0)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.failed(now=5.0)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertTrue(breaker.isOpen(now=30.0))
+        self.assertFalse(breaker.allow(now=30.0))
+
+    def testOneProbeAtATime(self):
+        breaker = CircuitBreaker('command', 1, 60)
+        breaker.failed(now=0.0)
+        self.assertFalse(breaker.isOpen(now=60.0))
+        self.assertTrue(breaker.allow(now=60.0))
+        self.assertEqual(breaker.state, HALFOPEN)
+        self.assertFalse(breaker.allow(now=61.0))
+        # A failed probe waits another probetime
+        breaker.failed(now=62.0)
+        self.assertFalse(breaker.allow(now=100.0))
+        self.assertTrue(breaker.allow(now=122.0))
+        breaker.succeeded(now=123.0)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow(now=123.0))
+
+    def testNeverOpensWithZeroFailures(self):
+        breaker = CircuitBreaker('command', 0, 60)
+        for n in range(10):
+            breaker.failed(now=float(n))
+        self.assertEqual(breaker.state, CLOSED)
+
+
+class TestCommandTimeout(unittest.TestCase):
+    def testHungCommandIsKilled(self):
+        start = time.time()
+        try:
+            runTicketCommand(['/bin/sleep', '10'], 0.5)
+        except TicketError as e:
+            self.assertTrue('did not finish within' in e.errmsg)
+        else:
+            self.fail('no TicketError')
+        self.assertTrue(time.time() - start < 5)
+
+    def testQuickCommand(self):
+        self.assertEqual(runTicketCommand(['/bin/echo', 'TT-42'], 5), 'TT-42')
+
+
+class TestHeldEvents(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'zentt.conf')
+        f = open(path, 'w')
+        f.write(CONFIG)
+        f.close()
+        config = DaemonConfig(path)
+        config.backends = ReplayBackends(config.backends, FlakyBackend)
+        self.backend = config.backends.get('command')
+        self.zem = FakeEventManager([ {'evid': 'e%d' % (n), 'DeviceGroups': '|/Linux', 'lastTime': 100 + n}
+                                      for n in range(5) ])
+        self.engine = TicketEngine(self.zem, config, self.dir, 'test')
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.dir)
+
+    def testHeldUntouchedUntilBackendWorks(self):
+        engine = self.engine
+        engine.runCycle()
+        self.assertEqual(engine.stats.counts['ticketsFailed'], 2)
+        self.assertEqual(len(engine.outbox), 2)
+        self.assertEqual(engine.breakers.held, ['e2', 'e3', 'e4'])
+        # The poll watermark is kept at the oldest held event
+        self.assertEqual(engine.poller.lastTime, 102)
+        for evid in ('e2', 'e3', 'e4'):
+            self.assertEqual(self.zem.status[evid]['eventState'], 0)
+            self.assertFalse('FAILED' in self.zem.status[evid].get('ownerid', ''))
+
+        # Still out of use: nothing is tried
+        engine.runCycle()
+        self.assertEqual(engine.stats.counts['ticketsFailed'], 0)
+        self.assertEqual(len(engine.breakers), 3)
+
+        # The host comes back: one probe, then the rest
+        self.backend.working = True
+        engine.breakers.breakers['command'].nextProbe = 0
+        engine.runCycle()
+        self.assertEqual(engine.stats.counts['ticketsCreated'], 1)
+        self.assertEqual(engine.breakers.breakers['command'].state, CLOSED)
+        engine.runCycle()
+        self.assertEqual(engine.stats.counts['ticketsCreated'], 2)
+        self.assertEqual(len(engine.breakers), 0)
+        self.assertEqual([ evid for evid in sorted(self.zem.status) if self.zem.status[evid]['eventState'] == 1 ],
+                         ['e2', 'e3', 'e4'])
+
+    def testHeldFoundAfterRestart(self):
+        self.engine.runCycle()
+        self.assertEqual(len(self.engine.breakers), 3)
+        config = self.engine.config
+        self.engine.close()
+        self.backend.working = True
+        self.engine = TicketEngine(self.zem, config, self.dir, 'test')
+        self.engine.runCycle()
+        self.assertEqual(self.engine.stats.counts['ticketsCreated'], 3)
+        self.assertEqual([ evid for evid in sorted(self.zem.status) if self.zem.status[evid]['eventState'] == 1 ],
+                         ['e2', 'e3', 'e4'])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestCircuitBreaker))
+    suite.addTest(makeSuite(TestCommandTimeout))
+    suite.addTest(makeSuite(TestHeldEvents))
+    return suite
@@ -0,0 +1,83 @@
+#
+# Tests for the cache of events that have already been looked at.
+#
+
+import os, shutil, tempfile, unittest
+
+from ZenPacks.skills1st.TroubleTicket.cache import EventCache, fingerprint
+
+# MD5 fingerprint of a StubEvent: missing fields count as None
+FINGERPRINT = 'ddbf364a1edcc5088fbdc1a6eab4819d'
+
+
+class StubEvent(object):
+    stateChange = '2012/07/07 10:00:00'
+    count = 1
+    DeviceGroups = '|/Linux'
+    device = 'host1.example.org'
+    prodState = 1000
+    eventState = 0
+    severity = 3
+    summary = 'Disk nearly full'
+
+    def __init__(self, evid, **kw):
+        self.evid = evid
+        self.__dict__.update(kw)
+
+
+class TestEventCache(unittest.TestCase):
+    def testUnchangedEventSkipped(self):
+        cache = EventCache(10)
+        self.assertFalse(cache.unchanged(StubEvent('ev-1')))
+        cache.add(StubEvent('ev-1'))
+        self.assertTrue(cache.unchanged(StubEvent('ev-1')))
+        self.assertEqual(cache.hits, 1)
+
+    def testChangedEventLookedAtAgain(self):
+        cache = EventCache(10)
+        cache.add(StubEvent('ev-1'))
+        self.assertFalse(cache.unchanged(StubEvent('ev-1', count=2)))
+        self.assertFalse(cache.unchanged(StubEvent('ev-1', severity=5)))
+        self.assertFalse(cache.unchanged(StubEvent('ev-1', DeviceGroups='|/Windows')))
+
+    def testLeastRecentlyUsedForgotten(self):
+        cache = EventCache(2)
+        cache.add(StubEvent('ev-1'))
+        cache.add(StubEvent('ev-2'))
+        cache.unchanged(StubEvent('ev-1'))
+        cache.add(StubEvent('ev-3'))
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.unchanged(StubEvent('ev-1')))
+        self.assertFalse(cache.unchanged(StubEvent('ev-2')))
+        self.assertTrue(cache.unchanged(StubEvent('ev-3')))
+
+    def testNewGenerationForgetsAll(self):
+        cache = EventCache(10, 'one')
+        cache.add(StubEvent('ev-1'))
+        cache.setGeneration('two')
+        self.assertFalse(cache.unchanged(StubEvent('ev-1')))
+
+    def testFingerprintIsStable(self):
+        # The same in every run, whatever the hash seed
+        self.assertEqual(fingerprint(StubEvent('ev-1')), fingerprint(StubEvent('ev-2')))
+        self.assertEqual(fingerprint(StubEvent('ev-1')), FINGERPRINT)
+        self.assertEqual(fingerprint(StubEvent('ev-1', count=1L, summary=u'Disk nearly full')), FINGERPRINT)
+
+    def testSavedForSameConfig(self):
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'cache.state')
+            cache = EventCache(10, 'one', path)
+            cache.add(StubEvent('ev-1'))
+            cache.save()
+            self.assertTrue(EventCache(10, 'one', path).unchanged(StubEvent('ev-1')))
+            self.assertFalse(EventCache(10, 'two', path).unchanged(StubEvent('ev-1')))
+        finally:
+            shutil.rmtree(dir)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestEventCache))
+    return suite
@@ -0,0 +1,194 @@
+#
+# Tests for running tickets from the event loop.
+#
+
+import os, time, shutil, tempfile, unittest
+
+from ZenPacks.skills1st.TroubleTicket.eventloop import EventLoop, LoopDriver, LoopTicketPool, \
+     DEFAULT_LOOP_CONCURRENCY
+from ZenPacks.skills1st.TroubleTicket.tickets import CommandBackend, TicketJob
+from ZenPacks.skills1st.TroubleTicket.settings import DaemonConfig
+from ZenPacks.skills1st.TroubleTicket.scheduler import CycleScheduler
+from ZenPacks.skills1st.TroubleTicket.engine import TicketEngine
+from ZenPacks.skills1st.TroubleTicket.replay import FakeEventManager
+
+# Takes a while to make a ticket, as a real ticket system would
+SCRIPT = """#!/bin/sh
+sleep 0.3
+echo TT-$1
+"""
+
+CONFIG = """
+[DAEMONSTUFF]
+ttcommand: %s %%evid%%
+cycletime: 60
+eventloop: yes
+max-concurrent-tickets: 5
+
+[Linux]
+devicegroups-1: /Linux
+"""
+
+
+class StubEvent(object):
+    def __init__(self, evid):
+        self.evid = evid
+        self.lastTime = 100
+
+
+class TestEventLoop(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def testTimersInOrder(self):
+        calls = []
+        self.loop.callLater(0.2, lambda: calls.append('b'))
+        self.loop.callLater(0.1, lambda: calls.append('a'))
+        cancelled = self.loop.callLater(0.15, lambda: calls.append('x'))
+        self.loop.cancel(cancelled)
+        self.loop.callLater(0.3, self.loop.stop)
+        self.loop.run()
+        self.assertEqual(calls, ['a', 'b'])
+
+    def testCallSoonWakesTheLoop(self):
+        calls = []
+        self.loop.callLater(30, self.loop.stop)
+        self.loop.callSoon(lambda: calls.append(1))
+        start = time.time()
+        self.loop.runOnce()
+        self.assertEqual(calls, [1])
+        self.assertTrue(time.time() - start < 5)
+
+
+class TestTicketProcess(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+        self.results = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def done(self, ticket, errmsg):
+        self.results.append( (ticket, errmsg) )
+        if len(self.results) == 3:
+            self.loop.stop()
+
+    def testSeveralAtOnce(self):
+        backend = CommandBackend('/bin/sh', 5)
+        start = time.time()
+        for n in range(3):
+            backend.start(self.loop, ['/bin/sh', '-c', 'sleep 0.3; echo TT-%d' % (n)], self.done)
+        self.loop.run()
+        self.assertEqual(sorted(self.results), [('TT-0', None), ('TT-1', None), ('TT-2', None)])
+        # Not one after another
+        self.assertTrue(time.time() - start < 0.8)
+
+    def testHungCommandIsKilled(self):
+        backend = CommandBackend('/bin/sleep 10', 0.3)
+        for n in range(3):
+            backend.start(self.loop, ['/bin/sleep', '10'], self.done)
+        start = time.time()
+        self.loop.run()
+        self.assertTrue(time.time() - start < 5)
+        for ticket, errmsg in self.results:
+            self.assertEqual(ticket, None)
+            self.assertTrue('did not finish within' in errmsg)
+
+    def testHungCommandKilledWhileWaiting(self):
+        # The kill is done by a timer, so waiting for the jobs runs the timers
+        pool = LoopTicketPool(self.loop, 2)
+        backend = CommandBackend('/bin/sleep 10', 0.3)
+        pool.submit(TicketJob(StubEvent('ev-1'), [('Section', backend, ['/bin/sleep', '10'])], False))
+        start = time.time()
+        jobs = list(pool.wait())
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(jobs[0].results[0][1], None)
+        self.assertTrue('did not finish within' in jobs[0].results[0][2])
+
+    def testMissingCommand(self):
+        backend = CommandBackend('/nonexistent/ttscript', 5)
+        backend.start(self.loop, ['/nonexistent/ttscript'], self.done)
+        self.assertEqual(self.results[0][0], None)
+        self.assertTrue('/nonexistent/ttscript' in self.results[0][1])
+
+
+class TestLoopEngine(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        script = os.path.join(self.dir, 'ttscript')
+        f = open(script, 'w')
+        f.write(SCRIPT)
+        f.close()
+        os.chmod(script, 0755)
+        path = os.path.join(self.dir, 'zentt.conf')
+        f = open(path, 'w')
+        f.write(CONFIG % (script))
+        f.close()
+        self.config = DaemonConfig(path)
+        self.zem = FakeEventManager([ {'evid': 'e%d' % (n), 'DeviceGroups': '|/Linux', 'lastTime': 100 + n}
+                                      for n in range(5) ])
+        self.loop = EventLoop()
+        self.driver = LoopDriver(self.loop, CycleScheduler(60))
+        self.engine = TicketEngine(self.zem, self.config, self.dir, 'test', makePool=self.driver.makePool)
+
+    def tearDown(self):
+        self.engine.close()
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def testMoreTicketsAtOnceByDefault(self):
+        f = open(self.config.path, 'w')
+        f.write((CONFIG % ('/bin/echo')).replace('max-concurrent-tickets: 5', ''))
+        f.close()
+        self.assertEqual(DaemonConfig(self.config.path).concurrency, DEFAULT_LOOP_CONCURRENCY)
+
+    def testCycleDoesNotWait(self):
+        engine = self.engine
+        self.assertTrue(self.config.eventloop)
+        start = time.time()
+        engine.runCycle(wait=False)
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEqual(engine.pool.running, 5)
+        # The watermark stops at the oldest event still being worked on
+        self.assertEqual(engine.poller.lastTime, 100)
+
+        # Events with tickets in progress are not started again
+        engine.runCycle(wait=False)
+        self.assertEqual(len(engine.pool.jobs), 5)
+
+        for job in engine.pool.wait():
+            engine.finished(job)
+        self.assertEqual(engine.between.counts['ticketsCreated'], 5)
+        engine.runCycle(wait=False)
+        self.assertEqual(engine.stats.counts['ticketsCreated'], 5)
+        self.assertEqual(engine.poller.lastTime, 104)
+        self.assertEqual(sorted([ self.zem.status[evid]['ownerid'] for evid in self.zem.status ]),
+                         [ 'Ticket TT-e%d' % (n) for n in range(5) ])
+
+    def testDriverRecordsTicketsBetweenCycles(self):
+        cycles = []
+        def beforeCycle():
+            cycles.append(time.time())
+            if len(cycles) == 1:
+                self.loop.callLater(1.0, self.driver.cycleNow)
+            return len(cycles) < 2
+        self.driver.run(self.engine, beforeCycle)
+        self.driver.stop()
+        self.assertEqual(len(cycles), 2)
+        self.assertEqual(self.engine.pool.jobs, {})
+        self.assertEqual(self.engine.between.counts['ticketsCreated'], 5)
+        # The acks are written by a timer, or when zentt stops
+        self.engine.writer.flush()
+        self.assertEqual(len([ evid for evid in self.zem.status if self.zem.status[evid]['eventState'] == 1 ]), 5)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestEventLoop))
+    suite.addTest(makeSuite(TestTicketProcess))
+    suite.addTest(makeSuite(TestLoopEngine))
+    return suite
@@ -0,0 +1,98 @@
+#
+# Tests for loading event details a page at a time, against a stand-in
+# for the event manager that records the queries it is sent.
+#
+
+import unittest
+
+from ZenPacks.skills1st.TroubleTicket.events import fetchDetails, fetchEvents, evidList, EVENT_FIELDS
+
+
+class StubEvent(object):
+    def __init__(self, evid, **fields):
+        self.evid = evid
+        self.__dict__.update(fields)
+
+
+# Answers "evid in (...)" queries from the events it holds
+class RecordingEventManager(object):
+    def __init__(self, events):
+        self.events = dict([ (evt.evid, evt) for evt in events ])
+        self.queries = []
+
+    def getEventList(self, resultFields, where, orderby):
+        self.queries.append( (list(resultFields), where, orderby) )
+        assert where.startswith("evid in ('") and where.endswith("')")
+        evids = where[len("evid in ('"):-2].split("', '")
+        return [ self.events[evid] for evid in evids if evid in self.events ]
+
+
+class TestFetchDetails(unittest.TestCase):
+    def testOneQueryForAllEvids(self):
+        zem = RecordingEventManager([ StubEvent('ev-1', device='host1'), StubEvent('ev-2', device='host2') ])
+        records = fetchDetails(zem, ['ev-1', 'ev-2', 'ev-3'])
+        self.assertEqual(zem.queries, [ (EVENT_FIELDS, "evid in ('ev-1', 'ev-2', 'ev-3')", "") ])
+        self.assertEqual(sorted(records), ['ev-1', 'ev-2'])
+        self.assertEqual(records['ev-2'].device, 'host2')
+        # Fields the row does not have are None
+        self.assertEqual(records['ev-2'].summary, None)
+
+    def testNoQueryForNoEvids(self):
+        zem = RecordingEventManager([])
+        self.assertEqual(fetchDetails(zem, []), {})
+        self.assertEqual(zem.queries, [])
+
+    def testEvidsQuoted(self):
+        self.assertEqual(evidList(["it's", 'back\\slash']), "('it\\'s', 'back\\\\slash')")
+
+
+class TestFetchEvents(unittest.TestCase):
+    def setUp(self):
+        self.polled = [ StubEvent('ev-%02d' % (n)) for n in range(10) ]
+        self.zem = RecordingEventManager([ StubEvent(evt.evid, device='host%d' % (n))
+                                           for n, evt in enumerate(self.polled) ])
+
+    def pages(self):
+        return [ len(where.split(', ')) for fields, where, orderby in self.zem.queries ]
+
+    def testPagesOfFetchsize(self):
+        records = list(fetchEvents(self.zem, self.polled, 4))
+        self.assertEqual(self.pages(), [4, 4, 2])
+        # In the poll order
+        self.assertEqual([ evt.evid for evt in records ], [ evt.evid for evt in self.polled ])
+
+    def testExactPages(self):
+        list(fetchEvents(self.zem, self.polled, 5))
+        self.assertEqual(self.pages(), [5, 5])
+        self.zem.queries = []
+        list(fetchEvents(self.zem, self.polled, 10))
+        self.assertEqual(self.pages(), [10])
+
+    def testPageAtATime(self):
+        records = fetchEvents(self.zem, self.polled, 4)
+        for n in range(4):
+            records.next()
+        # The second page is only fetched when it is needed
+        self.assertEqual(len(self.zem.queries), 1)
+        records.next()
+        self.assertEqual(len(self.zem.queries), 2)
+
+    def testGoneEventsSkipped(self):
+        del self.zem.events['ev-03']
+        del self.zem.events['ev-04']
+        records = list(fetchEvents(self.zem, self.polled, 4))
+        self.assertEqual([ evt.evid for evt in records ],
+                         ['ev-00', 'ev-01', 'ev-02', 'ev-05', 'ev-06', 'ev-07', 'ev-08', 'ev-09'])
+        self.assertEqual(self.pages(), [4, 4, 2])
+
+    def testNoEvents(self):
+        self.assertEqual(list(fetchEvents(self.zem, [], 4)), [])
+        self.assertEqual(self.zem.queries, [])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestFetchDetails))
+    suite.addTest(makeSuite(TestFetchEvents))
+    return suite
@@ -0,0 +1,85 @@
+#
+# Tests for 'zentt explain' and the filter profiler.
+#
+
+import os, shutil, tempfile, unittest
+
+from ZenPacks.skills1st.TroubleTicket.settings import DaemonConfig
+from ZenPacks.skills1st.TroubleTicket.explain import explainEvent, RuleProfiler
+from ZenPacks.skills1st.TroubleTicket.rules import EventFields
+
+CONFIG = """
+[DAEMONSTUFF]
+ttcommand: /bin/echo %evid% %param-queue%
+cycletime: 60
+
+[Linux]
+devicegroups-1: /Linux
+severity-min: 4
+param-queue: L1
+
+[NotTest]
+notdevice-re-1: ^test
+"""
+
+
+class StubEvent(object):
+    evid = 'ev-1'
+    device = 'testbox'
+    severity = 5
+    eventState = 0
+    prodState = 1000
+    DeviceGroups = '|/Linux'
+    summary = 'Disk full'
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class TestExplain(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'zentt.conf')
+        f = open(path, 'w')
+        f.write(CONFIG)
+        f.close()
+        self.config = DaemonConfig(path)
+
+    def tearDown(self):
+        self.config.backends.close()
+        shutil.rmtree(self.dir)
+
+    def section(self, lines, name):
+        for line in lines:
+            if line.startswith('Section %s:' % (name)):
+                return line
+        return None
+
+    def testMatchAndRejection(self):
+        lines = explainEvent(self.config, StubEvent())
+        self.assertTrue('MATCH' in self.section(lines, 'Linux'))
+        self.assertTrue("rejected by notdevice - notdevice option notdevice-re-1 matches device 'testbox'"
+                        in self.section(lines, 'NotTest'))
+        self.assertTrue("Linux would send: ['/bin/echo', 'ev-1', 'L1']" in lines[-1])
+
+    def testIntegerRejection(self):
+        lines = explainEvent(self.config, StubEvent(severity=2, device='web1'))
+        self.assertTrue('rejected by severity - severity 2 is not min 4' in self.section(lines, 'Linux'))
+        self.assertTrue('Result: a ticket from section NotTest' in lines[-2])
+
+    def testProfilerCounts(self):
+        profiler = RuleProfiler()
+        for evt in (StubEvent(), StubEvent(severity=2)):
+            fields = EventFields(evt)
+            for rule in self.config.rules.sections:
+                profiler.select(rule, evt, fields)
+        self.assertEqual(profiler.sections['Linux'][:2], [2, 1])
+        self.assertEqual(profiler.sections['NotTest'][:2], [2, 2])
+        self.assertEqual(profiler.prefixes['severity'][:2], [2, 1])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestExplain))
+    return suite
@@ -0,0 +1,97 @@
+#
+# Tests for the zentt.conf checks made by 'zentt lint'.
+#
+
+import unittest, ConfigParser, StringIO
+
+from ZenPacks.skills1st.TroubleTicket.lint import lintConfig, formatLint, hasErrors, backtrackRisk
+import sre_parse
+
+CONFIG = """
+[DAEMONSTUFF]
+ttcommand: /bin/echo %evid%
+cycletime: 60
+
+[A Linux]
+devicegroups-1: /Linux
+severity-min: 3
+
+[B Linux critical]
+devicegroups-1: /linux
+severity-min: 5
+notsummary-1: Trivial
+
+[C Linux subgroups]
+devicegroups-re-1: ^/Linux/
+severity-min: 5
+
+[D Broken]
+severity-min: 5
+severity-max: 3
+
+[E Values]
+severity-min: 3
+severity-1: 1
+severity-2: 4
+
+[F Acked]
+eventstate-1: 1
+"""
+
+
+def lint(text):
+    config = ConfigParser.ConfigParser()
+    config.readfp(StringIO.StringIO(text))
+    return lintConfig(config)
+
+def messages(findings, section):
+    return [ (level, message) for level, s, message in findings if s == section ]
+
+
+class TestLint(unittest.TestCase):
+    def setUp(self):
+        self.findings, self.costs = lint(CONFIG)
+
+    def testShadowed(self):
+        found = messages(self.findings, 'B Linux critical')
+        self.assertEqual(len(found), 1)
+        self.assertTrue(found[0][1].startswith('shadowed by section A Linux'))
+        # The regex also accepts groups below /Linux, which A does not
+        self.assertEqual(messages(self.findings, 'C Linux subgroups'), [])
+
+    def testNotShadowedWithMultiTicket(self):
+        findings, costs = lint(CONFIG.replace('cycletime: 60', 'cycletime: 60\nmulti-ticket: yes'))
+        self.assertEqual(messages(findings, 'B Linux critical'), [])
+
+    def testIntContradictions(self):
+        self.assertEqual(messages(self.findings, 'D Broken'),
+                         [('error', 'severity-min 5 is above severity-max 3, so the section can never match')])
+        self.assertEqual(messages(self.findings, 'E Values'),
+                         [('warning', 'severity values 1 are outside the severity-min/max range and can never match')])
+        self.assertEqual(messages(self.findings, 'F Acked'),
+                         [('error', 'eventstate filters exclude 0 (new), and only new events get tickets')])
+        self.assertTrue(hasErrors(self.findings))
+
+    def testBacktracking(self):
+        for pattern in (r'^(\w+\s?)*$', r'(a+)+b', r'(a|ab)*c', r'(x|x)+y'):
+            self.assertTrue(backtrackRisk(sre_parse.parse(pattern)), pattern)
+        for pattern in (r'^threshold', r'interface (eth|ge-)[0-9/]+ down', r'(ab|cd)*e', r'\.example\.org$'):
+            self.assertEqual(backtrackRisk(sre_parse.parse(pattern)), None, pattern)
+
+    def testBadRegex(self):
+        findings, costs = lint(CONFIG + "\n[G Bad]\nsummary-re-1: ([a-z\n")
+        self.assertEqual(messages(findings, 'G Bad')[0][0], 'error')
+
+    def testCosts(self):
+        costs = dict([ (row[0], row[1:]) for row in self.costs ])
+        self.assertEqual(costs['A Linux'], (3, 1, 1, 0))
+        self.assertEqual(costs['C Linux subgroups'], (31, 1, 0, 3))
+        lines = formatLint(self.findings, self.costs, {'sections': {'A Linux': [4, 2, 0.0002]}})
+        self.assertTrue([ line for line in lines if line.startswith('A Linux') and line.endswith('50.0') ])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestLint))
+    return suite
@@ -0,0 +1,183 @@
+#
+# Tests for the outbox of tickets waiting to be retried.
+# The outbox is kept in a scratch SQLite file.
+#
+
+import os, shutil, tempfile, time, unittest
+
+from ZenPacks.skills1st.TroubleTicket import outbox
+from ZenPacks.skills1st.TroubleTicket.outbox import Outbox
+from ZenPacks.skills1st.TroubleTicket.settings import DaemonConfig
+from ZenPacks.skills1st.TroubleTicket.engine import TicketEngine
+from ZenPacks.skills1st.TroubleTicket.replay import FakeEventManager
+
+# Every cycle is a full scan, and a failed ticket is given up straight away
+CONFIG = """
+[DAEMONSTUFF]
+ttcommand: /bin/false %evid%
+cycletime: 60
+resynctime: 0
+retrylimit: 0
+
+[Linux]
+devicegroups-1: /Linux
+"""
+
+
+class StubEvent(object):
+    def __init__(self, evid, eventState=0):
+        self.evid = evid
+        self.eventState = eventState
+
+
+class StubBackends(object):
+    def get(self, name):
+        if name != 'command':
+            raise KeyError(name)
+        return name
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'outbox.db')
+        self.events = {}
+        self.fetchDetails = outbox.fetchDetails
+        outbox.fetchDetails = self.fakeFetchDetails
+        self.outbox = Outbox(self.path, 10, 40, 3)
+
+    def tearDown(self):
+        outbox.fetchDetails = self.fetchDetails
+        self.outbox.close()
+        shutil.rmtree(self.dir)
+
+    def fakeFetchDetails(self, zem, evids):
+        result = {}
+        for evid in evids:
+            if evid in self.events:
+                result[evid] = self.events[evid]
+        return result
+
+    def failTicket(self, evid, backend='command', multiTicket=False):
+        return self.outbox.failed(evid, [('Section', backend, ['ticket', evid])], multiTicket, 'error')
+
+    def testBackoffDoubles(self):
+        self.assertEqual(round(self.outbox.backoff(1) / 10), 1)
+        self.assertEqual(round(self.outbox.backoff(2) / 20), 1)
+        self.assertEqual(round(self.outbox.backoff(5) / 40), 1)
+
+    def testKeptAcrossRestart(self):
+        self.failTicket('ev-1')
+        self.outbox.close()
+        self.outbox = Outbox(self.path, 10, 40, 3)
+        self.assertTrue(self.outbox.contains('ev-1'))
+
+    def testUnsaveablePayloadGivenUp(self):
+        self.failTicket('ev-1')
+        self.assertFalse(self.outbox.failed('ev-1', [('Section', 'command', object())], False, 'error'))
+        self.assertEqual(len(self.outbox), 0)
+        self.assertTrue(self.outbox.contains('ev-1'))
+
+    def testNotDueUntilRetryTime(self):
+        self.events['ev-1'] = StubEvent('ev-1')
+        self.failTicket('ev-1')
+        self.assertEqual(self.outbox.dueJobs(None, StubBackends()), [])
+        jobs = self.outbox.dueJobs(None, StubBackends(), time.time() + 60)
+        self.assertEqual(len(jobs), 1)
+        self.assertTrue(jobs[0].retry)
+        self.assertEqual(jobs[0].requests, [('Section', 'command', ['ticket', 'ev-1'])])
+
+    def testGivenUpAfterLimit(self):
+        for n in range(3):
+            self.assertTrue(self.failTicket('ev-1'))
+        self.assertFalse(self.failTicket('ev-1'))
+        self.assertEqual(len(self.outbox), 0)
+        # Still left alone by the event scan, after a restart too
+        self.assertTrue(self.outbox.contains('ev-1'))
+        self.outbox.close()
+        self.outbox = Outbox(self.path, 10, 40, 3)
+        self.assertTrue(self.outbox.contains('ev-1'))
+        self.assertEqual(self.outbox.dueJobs(None, StubBackends(), time.time() + 3600), [])
+
+    def testGivenUpTriedAgainWithNewRules(self):
+        self.outbox.close()
+        self.outbox = Outbox(self.path, 10, 40, 0, 'gen-1')
+        self.assertFalse(self.failTicket('ev-1'))
+        self.outbox.close()
+        self.outbox = Outbox(self.path, 10, 40, 0, 'gen-1')
+        self.assertTrue(self.outbox.contains('ev-1'))
+        self.outbox.close()
+        self.outbox = Outbox(self.path, 10, 40, 0, 'gen-2')
+        self.assertFalse(self.outbox.contains('ev-1'))
+        # and while running
+        self.assertFalse(self.failTicket('ev-2'))
+        self.outbox.clearGivenUp('gen-3')
+        self.assertFalse(self.outbox.contains('ev-2'))
+
+    def testGivenUpForgottenOnceDealtWith(self):
+        self.outbox.retrylimit = 0
+        self.events['ev-1'] = StubEvent('ev-1', 1)
+        self.events['ev-2'] = StubEvent('ev-2')
+        for evid in ('ev-1', 'ev-2', 'ev-3'):
+            self.assertFalse(self.failTicket(evid))
+        now = time.time()
+        self.outbox.dueJobs(None, StubBackends(), now)
+        self.assertEqual([ evid for evid in ('ev-1', 'ev-2', 'ev-3') if self.outbox.contains(evid) ], ['ev-2'])
+        # Not checked again for a while
+        del self.events['ev-2']
+        self.outbox.dueJobs(None, StubBackends(), now + 60)
+        self.assertTrue(self.outbox.contains('ev-2'))
+        self.outbox.dueJobs(None, StubBackends(), now + outbox.GIVENUP_CHECKTIME)
+        self.assertFalse(self.outbox.contains('ev-2'))
+
+    def testDealtWithEventsDropped(self):
+        self.events['ev-2'] = StubEvent('ev-2', 1)
+        self.events['ev-3'] = StubEvent('ev-3', 1)
+        self.events['ev-4'] = StubEvent('ev-4')
+        self.failTicket('ev-1')
+        self.failTicket('ev-2')
+        self.failTicket('ev-3', multiTicket=True)
+        self.failTicket('ev-4', backend='gone')
+        jobs = self.outbox.dueJobs(None, StubBackends(), time.time() + 60)
+        self.assertEqual([ job.evt.evid for job in jobs ], ['ev-3'])
+        self.assertEqual(len(self.outbox), 1)
+
+
+class TestGivenUp(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'zentt.conf')
+        self.write(CONFIG)
+        self.zem = FakeEventManager([ {'evid': 'e1', 'DeviceGroups': '|/Linux', 'lastTime': 100} ])
+        self.engine = TicketEngine(self.zem, DaemonConfig(self.path), self.dir, 'test')
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        f = open(self.path, 'w')
+        f.write(text)
+        f.close()
+
+    def testFullScanDoesNotStartAgain(self):
+        engine = self.engine
+        engine.runCycle()
+        self.assertEqual(engine.stats.counts['ticketsFailed'], 1)
+        self.assertEqual(self.zem.status['e1']['ownerid'], 'Ticket FAILED')
+        engine.runCycle()
+        self.assertEqual(engine.stats.counts['ticketsFailed'], 0)
+        self.assertEqual(engine.stats.counts['eventsPending'], 1)
+        # New rules may do better, so the event is tried again
+        self.write(CONFIG.replace('/bin/false', '/bin/echo'))
+        engine.reconfigure(DaemonConfig(self.path))
+        engine.runCycle()
+        self.assertEqual(engine.stats.counts['ticketsCreated'], 1)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestOutbox))
+    suite.addTest(makeSuite(TestGivenUp))
+    return suite
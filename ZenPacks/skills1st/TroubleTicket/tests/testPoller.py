@@ -0,0 +1,139 @@
+#
+# Tests for the incremental polling of the event status table, against
+# a stand-in for the event manager that records the queries it is sent.
+#
+
+import os, time, shutil, tempfile, unittest
+
+from ZenPacks.skills1st.TroubleTicket.poller import EventPoller, POLL_FIELDS
+
+
+class StubEvent(object):
+    def __init__(self, evid, lastTime, stateChange=0):
+        self.evid = evid
+        self.lastTime = lastTime
+        self.stateChange = stateChange
+
+
+# Returns the events it is given, whatever the query
+class RecordingEventManager(object):
+    def __init__(self):
+        self.events = []
+        self.queries = []
+
+    def getEventList(self, resultFields, where, orderby):
+        self.queries.append( (list(resultFields), where, orderby) )
+        return list(self.events)
+
+
+class TestEventPoller(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.statefile = os.path.join(self.dir, 'zentt-poll.json')
+        self.zem = RecordingEventManager()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def makePoller(self, generation='gen-1', resynctime=3600):
+        return EventPoller(self.zem, self.statefile, resynctime, generation)
+
+    def lastWhere(self):
+        return self.zem.queries[-1][1]
+
+    def testIncrementalAfterFirstScan(self):
+        poller = self.makePoller()
+        self.zem.events = [ StubEvent('ev-1', 100.0, 90.0), StubEvent('ev-2', 150.5, 120.0) ]
+        poller.poll()
+        self.assertEqual(self.zem.queries[0], (POLL_FIELDS, '', 'lastTime ASC, firstTime ASC'))
+        poller.commit()
+        self.zem.events = []
+        poller.poll()
+        self.assertEqual(self.lastWhere(), '(lastTime >= 150.500000 or stateChange >= FROM_UNIXTIME(120))')
+
+    def testFullScanAfterResynctime(self):
+        poller = self.makePoller()
+        self.zem.events = [ StubEvent('ev-1', 100.0) ]
+        poller.poll()
+        poller.commit()
+        poller.lastFull = time.time() - 3601
+        poller.poll()
+        self.assertEqual(self.lastWhere(), '')
+        # The full scan starts the resynctime again
+        poller.commit()
+        poller.poll()
+        self.assertNotEqual(self.lastWhere(), '')
+
+    def testWatermarkMovesOnlyOnCommit(self):
+        poller = self.makePoller()
+        self.zem.events = [ StubEvent('ev-1', 100.0) ]
+        poller.poll()
+        self.assertEqual(poller.lastTime, 0)
+        self.assertFalse(os.path.exists(self.statefile))
+        poller.commit()
+        self.assertEqual(poller.lastTime, 100.0)
+
+    def testCommitLimitNeverMovesBack(self):
+        poller = self.makePoller()
+        self.zem.events = [ StubEvent('ev-1', 100.0), StubEvent('ev-2', 200.0) ]
+        poller.poll()
+        # ev-1 is still being worked on
+        poller.commit(100.0)
+        self.assertEqual(poller.lastTime, 100.0)
+        poller.poll()
+        poller.commit(50.0)
+        self.assertEqual(poller.lastTime, 100.0)
+        self.assertEqual(self.makePoller().lastTime, 100.0)
+        poller.poll()
+        poller.commit()
+        self.assertEqual(poller.lastTime, 200.0)
+
+    def testSavedStateUsedAfterRestart(self):
+        poller = self.makePoller()
+        self.zem.events = [ StubEvent('ev-1', 100.0, 90.0) ]
+        poller.poll()
+        poller.commit()
+        restarted = self.makePoller()
+        self.assertEqual((restarted.lastTime, restarted.stateChange, restarted.lastFull),
+                         (poller.lastTime, poller.stateChange, poller.lastFull))
+        restarted.poll()
+        self.assertEqual(self.lastWhere(), '(lastTime >= 100.000000 or stateChange >= FROM_UNIXTIME(90))')
+
+    def testNewGenerationStartsWithFullScan(self):
+        poller = self.makePoller()
+        self.zem.events = [ StubEvent('ev-1', 100.0) ]
+        poller.poll()
+        poller.commit()
+        restarted = self.makePoller(generation='gen-2')
+        self.assertEqual(restarted.lastTime, 0)
+        restarted.poll()
+        self.assertEqual(self.lastWhere(), '')
+
+    def testCorruptStateFileIgnored(self):
+        f = open(self.statefile, 'w')
+        f.write('{"generation": "gen-1", "lastTi')
+        f.close()
+        poller = self.makePoller()
+        self.assertEqual(poller.lastTime, 0)
+        self.zem.events = [ StubEvent('ev-1', 100.0) ]
+        poller.poll()
+        self.assertEqual(self.lastWhere(), '')
+        # and replaced by a good one
+        poller.commit()
+        self.assertEqual(self.makePoller().lastTime, 100.0)
+
+    def testResetForcesFullScan(self):
+        poller = self.makePoller()
+        self.zem.events = [ StubEvent('ev-1', 100.0) ]
+        poller.poll()
+        poller.commit()
+        poller.reset()
+        poller.poll()
+        self.assertEqual(self.lastWhere(), '')
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestEventPoller))
+    return suite
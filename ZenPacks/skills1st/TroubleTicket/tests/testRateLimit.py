@@ -0,0 +1,128 @@
+#
+# Tests for the ticket rate limits.
+#
+
+import os, shutil, tempfile, unittest, ConfigParser, StringIO
+
+from ZenPacks.skills1st.TroubleTicket.ratelimit import TokenBucket, RateLimiter
+from ZenPacks.skills1st.TroubleTicket.rules import compileConfig, RuleError, SectionRule
+from ZenPacks.skills1st.TroubleTicket.settings import DaemonConfig
+from ZenPacks.skills1st.TroubleTicket.engine import TicketEngine
+from ZenPacks.skills1st.TroubleTicket.replay import FakeEventManager, StubBackend, ReplayBackends
+
+CONFIG = """
+[DAEMONSTUFF]
+ttcommand: /bin/echo %evid%
+cycletime: 60
+ratelimit-target: 60
+ratelimit-target-burst: 3
+ratelimit-key: %param-tthost%
+
+[Linux]
+devicegroups-1: /Linux
+param-tthost: tickets.example.com
+"""
+
+
+class TestTokenBucket(unittest.TestCase):
+    def testRefill(self):
+        bucket = TokenBucket(60, 2, now=100.0)
+        bucket.take(100.0)
+        bucket.take(100.0)
+        self.assertFalse(bucket.available(100.5))
+        self.assertTrue(bucket.available(101.0))
+        # Never more than the burst
+        bucket.refill(1000.0)
+        self.assertEqual(bucket.tokens, 2.0)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.rule = SectionRule('Linux', [], {}, None, (60, 1))
+        self.limiter = RateLimiter()
+        self.limiter.configure(0, 0, None, [self.rule])
+        self.keys = [ self.limiter.keys(self.rule, None, 'command') ]
+
+    def testDeferInOrder(self):
+        self.assertTrue(self.limiter.allow('e1', self.keys, False, now=0.0))
+        self.assertFalse(self.limiter.allow('e2', self.keys, False, now=0.0))
+        self.assertFalse(self.limiter.allow('e3', self.keys, False, now=0.0))
+        self.assertEqual(self.limiter.deferred, ['e2', 'e3'])
+        self.assertTrue(self.limiter.isDeferred('e3'))
+
+    def testDueOnlyAsManyAsTokens(self):
+        self.limiter.allow('e1', self.keys, False, now=0.0)
+        for evid in ('e2', 'e3', 'e4'):
+            self.limiter.allow(evid, self.keys, False, now=0.0)
+        self.assertEqual(self.limiter.due(now=0.5), [])
+        # The burst of 1 caps the bucket however long it has been
+        self.assertEqual(self.limiter.due(now=2.5), ['e2'])
+        self.assertEqual(self.limiter.deferred, ['e3', 'e4'])
+
+    def testChangedLimitStartsFull(self):
+        self.limiter.allow('e1', self.keys, False, now=0.0)
+        rule = SectionRule('Linux', [], {}, None, (60, 5))
+        self.limiter.configure(0, 0, None, [rule])
+        self.assertFalse(self.limiter.blockedBy)
+        self.assertEqual(self.limiter.buckets, {})
+
+    def testSectionOptions(self):
+        config = ConfigParser.ConfigParser()
+        config.readfp(StringIO.StringIO("[A]\nratelimit: 10\nratelimit-burst: 4\n[B]\nratelimit: lots\n"))
+        self.assertRaises(RuleError, compileConfig, config)
+        config.remove_section('B')
+        self.assertEqual(compileConfig(config).sections[0].limit, (10, 4))
+
+
+class TestDeferredEvents(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'zentt.conf')
+        f = open(path, 'w')
+        f.write(CONFIG)
+        f.close()
+        config = DaemonConfig(path)
+        config.backends = ReplayBackends(config.backends, StubBackend)
+        self.zem = FakeEventManager([ {'evid': 'e%d' % (n), 'DeviceGroups': '|/Linux', 'lastTime': 100 + n}
+                                      for n in range(5) ])
+        self.engine = TicketEngine(self.zem, config, self.dir, 'test')
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.dir)
+
+    def testDeferredNotDropped(self):
+        self.engine.runCycle()
+        self.assertEqual(self.engine.stats.counts['ticketsCreated'], 3)
+        self.assertEqual(self.engine.limiter.deferred, ['e3', 'e4'])
+        # The poll watermark is kept at the oldest deferred event
+        self.assertEqual(self.engine.poller.lastTime, 103)
+        # Let the bucket fill up again
+        for bucket in self.engine.limiter.buckets.values():
+            bucket.tokens = float(bucket.burst)
+        self.engine.runCycle()
+        self.assertEqual(self.engine.stats.counts['ticketsCreated'], 2)
+        self.assertEqual(len(self.engine.limiter), 0)
+        self.assertEqual([ evid for evid in sorted(self.zem.status) if self.zem.status[evid]['eventState'] == 1 ],
+                         ['e0', 'e1', 'e2', 'e3', 'e4'])
+        self.assertEqual(self.engine.poller.lastTime, 104)
+
+    def testDeferredFoundAfterRestart(self):
+        self.engine.runCycle()
+        self.assertEqual(len(self.engine.limiter), 2)
+        config = self.engine.config
+        self.engine.close()
+        self.engine = TicketEngine(self.zem, config, self.dir, 'test')
+        self.engine.runCycle()
+        self.assertEqual(self.engine.stats.counts['ticketsCreated'], 2)
+        self.assertEqual([ evid for evid in sorted(self.zem.status) if self.zem.status[evid]['eventState'] == 1 ],
+                         ['e0', 'e1', 'e2', 'e3', 'e4'])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestTokenBucket))
+    suite.addTest(makeSuite(TestRateLimiter))
+    suite.addTest(makeSuite(TestDeferredEvents))
+    return suite
@@ -0,0 +1,118 @@
+#
+# Tests for the fake event manager and the offline replay.
+#
+
+import os, shutil, tempfile, unittest
+from MySQLdb import OperationalError
+
+from ZenPacks.skills1st.TroubleTicket.replay import FakeEventManager, StubBackend, ReplayBackends, \
+     replayEvents, formatReplay
+from ZenPacks.skills1st.TroubleTicket.settings import DaemonConfig
+from ZenPacks.skills1st.TroubleTicket.events import fetchDetails
+from ZenPacks.skills1st.TroubleTicket.writer import StatusWriter
+
+CONFIG = """
+[DAEMONSTUFF]
+ttcommand: /bin/echo %evid% %param-queue%
+cycletime: 60
+
+[Linux]
+devicegroups-1: /Linux
+severity-min: 4
+param-queue: L1
+
+[AUTOCLEAR]
+severity-max: 1
+"""
+
+
+def events():
+    return [
+        {'evid': 'linux-crit', 'device': 'web1', 'severity': 5, 'DeviceGroups': '|/Linux', 'lastTime': 100},
+        {'evid': "it's-quoted", 'device': 'web2', 'severity': 4, 'DeviceGroups': '|/Linux', 'lastTime': 101},
+        {'evid': 'windows', 'device': 'win1', 'severity': 5, 'DeviceGroups': '|/Windows', 'lastTime': 102},
+        {'evid': 'debug', 'device': 'web1', 'severity': 1, 'DeviceGroups': '|/Linux', 'lastTime': 103},
+    ]
+
+# A lock wait timeout, which the writer leaves to be retried
+def ignoredError():
+    raise OperationalError(1205, 'Lock wait timeout exceeded; try restarting transaction')
+
+
+class TestFakeEventManager(unittest.TestCase):
+    def testFetchByEvid(self):
+        zem = FakeEventManager(events())
+        records = fetchDetails(zem, ["it's-quoted", 'windows', 'missing'])
+        self.assertEqual(sorted(records.keys()), ["it's-quoted", 'windows'])
+        self.assertEqual(records['windows'].prodState, 1000)
+
+    def testIncrementalPoll(self):
+        zem = FakeEventManager(events())
+        rows = zem.getEventList([], "(lastTime >= 102.000000 or stateChange >= FROM_UNIXTIME(1000))",
+                                "lastTime ASC, firstTime ASC")
+        self.assertEqual([row.evid for row in rows], ['windows', 'debug'])
+
+    def testWriterStatements(self):
+        zem = FakeEventManager(events())
+        writer = StatusWriter(zem)
+        writer.ticketCreated("it's-quoted", 'T1')
+        writer.ticketFailed('windows')
+        writer.clearEvent('debug')
+        writer.flush()
+        self.assertEqual(zem.status["it's-quoted"]['eventState'], 1)
+        self.assertEqual(zem.status["it's-quoted"]['ownerid'], 'Ticket T1')
+        self.assertEqual(zem.status['windows']['ownerid'], 'Ticket FAILED')
+        self.assertFalse('debug' in zem.status)
+        self.assertTrue(zem.history['debug']['summary'].endswith(' auto-cleared by zenTT '))
+
+    def testAutoclearTaggedOnce(self):
+        zem = FakeEventManager(events())
+        writer = StatusWriter(zem)
+        writer.clearEvent('debug')
+        # The delete fails the first time, after the summary has been tagged
+        delete = zem.manage_deleteEvents
+        zem.manage_deleteEvents = lambda evids: ignoredError()
+        writer.flush()
+        self.assertTrue('debug' in zem.status)
+        zem.manage_deleteEvents = delete
+        writer.flush()
+        self.assertFalse('debug' in zem.status)
+        self.assertEqual(zem.history['debug']['summary'].count('auto-cleared by zenTT'), 1)
+
+    def testUnknownClause(self):
+        zem = FakeEventManager(events())
+        self.assertRaises(ValueError, zem.getEventList, [], "severity > 3", "")
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'zentt.conf')
+        f = open(path, 'w')
+        f.write(CONFIG)
+        f.close()
+        self.config = DaemonConfig(path)
+        self.config.backends = ReplayBackends(self.config.backends, StubBackend)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testReplay(self):
+        zem = FakeEventManager(events())
+        totals, trace, elapsed = replayEvents(zem, self.config, 2)
+        self.assertEqual(totals.counts['ticketsCreated'], 2)
+        self.assertEqual(totals.counts['autoCleared'], 1)
+        self.assertEqual(len(trace.ticketTimes), 2)
+        self.assertEqual(zem.status['linux-crit']['ownerid'], 'Ticket REPLAY-1')
+        self.assertEqual(zem.status['windows']['eventState'], 0)
+        lines = formatReplay(len(events()), 2, totals, trace, elapsed)
+        self.assertTrue(lines[0].startswith('Replayed 4 events in 2 cycles'))
+        self.assertTrue('  Section Linux matched 2 events' in lines)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestFakeEventManager))
+    suite.addTest(makeSuite(TestReplay))
+    return suite
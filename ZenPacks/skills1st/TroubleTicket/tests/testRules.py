@@ -0,0 +1,314 @@
+#
+# Tests for the compiled form of the zentt.conf filter sections, checked
+# against configREMatch and configIntMatch, which work directly on the
+# ConfigParser object as zentt always used to.
+#
+
+import re, random, unittest, ConfigParser, StringIO
+
+from ZenPacks.skills1st.TroubleTicket.rules import compileConfig, selectEvent, \
+     configREMatch, configIntMatch, FILTER_ORDER, INT_FILTERS, MULTI_VALUED, \
+     compileAlternation, EventFields, StringFilter, RuleError, MAX_GROUPS, \
+     IntFilter, IntIndex, checkCost
+
+CONFIG = """
+[DAEMONSTUFF]
+ttcommand: /bin/echo %evid%
+
+[AUTOCLEAR]
+summary-re-1: ^Test event
+severity-max: 2
+
+[A Literals]
+devicegroups-1: /Linux
+devicegroups-2: /Windows
+device-1: WEB01
+notcomponent-1: httpd
+
+[B Regexes]
+devicegroups-re-1: ^/Linux/
+summary-re-1: disk (full|failed)
+notsummary-re-1: (?i)ignore me
+notmessage-re-1: ^Trivial
+
+[C Systems]
+systems-1: /Production
+notsystems-re-1: /Test$
+location-re-1: ^/London
+
+[D Mixed literals and regexes]
+deviceclass-1: /Server/Linux
+deviceclass-re-1: ^/Network/
+ipaddress-re-1: ^10\\.
+notdevice-1: web02
+
+[E Severity range]
+severity-min: 3
+severity-max: 4
+prodstate-min: 1000
+
+[F Severity list]
+severity-1: 2
+severity-2: 5
+eventstate-1: 0
+eventstate-2: 1
+
+[G Range and list]
+severity-min: 4
+severity-1: 2
+severity-2: 4
+severity-3: 5
+prodstate-max: 500
+
+[H Everything]
+devicegroups-re-1: ^/Linux
+notdevicegroups-1: /Linux/Retired
+severity-min: 4
+summary-re-1: disk
+component-1: kernel
+"""
+
+DEVICEGROUPS = ['', '/Linux', '/linux', '/Windows', '/Linux/Web', '/Linux/Retired', '/Other']
+SYSTEMS = ['', '/Production', '/Production/Test', '/Test', '/Staging']
+DEVICES = ['web01', 'web02', 'db01']
+CLASSES = ['/Server/Linux', '/server/linux', '/Network/Router', '/Server/Windows']
+SUMMARIES = ['disk full on /var', 'Disk Failed', 'Please IGNORE ME', 'Test event', 'cpu high']
+MESSAGES = ['Trivial thing', 'something serious', '']
+COMPONENTS = ['httpd', 'kernel', '']
+LOCATIONS = ['/London/DC1', '/Paris', '']
+ADDRESSES = ['10.0.0.1', '192.168.1.1', '']
+
+
+def readConfig(text):
+    config = ConfigParser.ConfigParser()
+    config.readfp(StringIO.StringIO(text))
+    return config
+
+
+class FakeEvent(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+# The same random events every time
+def makeEvents(n, seed=1):
+    rand = random.Random(seed)
+    events = []
+    for i in range(n):
+        events.append(FakeEvent(
+            DeviceGroups='|'.join(rand.sample(DEVICEGROUPS, rand.randint(1, 3))),
+            Systems='|'.join(rand.sample(SYSTEMS, rand.randint(1, 2))),
+            device=rand.choice(DEVICES),
+            DeviceClass=rand.choice(CLASSES),
+            prodState=rand.choice([-1, 300, 500, 1000, 1001]),
+            eventState=rand.choice([0, 1, 2]),
+            severity=rand.randint(0, 5),
+            summary=rand.choice(SUMMARIES),
+            message=rand.choice(MESSAGES),
+            component=rand.choice(COMPONENTS),
+            Location=rand.choice(LOCATIONS),
+            ipAddress=rand.choice(ADDRESSES)))
+    return events
+
+# What the ConfigParser-based selectEvent used to say about an event
+def referenceSelect(config, s, evt):
+    for prefix, attr in FILTER_ORDER:
+        value = getattr(evt, attr)
+        if prefix in INT_FILTERS:
+            if not configIntMatch(config, s, prefix, value):
+                return 0
+            continue
+        if attr in MULTI_VALUED:
+            items = value.split('|')
+        else:
+            items = [value]
+        if not configREMatch(config, s, prefix, items, True):
+            return 0
+        if configREMatch(config, s, 'not' + prefix, items, False):
+            return 0
+    return 1
+
+
+class TestCompiledRules(unittest.TestCase):
+    def setUp(self):
+        self.config = readConfig(CONFIG)
+        self.rules = compileConfig(self.config)
+        self.events = makeEvents(2000)
+
+    def checkSection(self, rule):
+        matched = 0
+        for evt in self.events:
+            expected = referenceSelect(self.config, rule.name, evt)
+            self.assertEqual(selectEvent(rule, evt), expected,
+                             'section %s disagrees for %r' % (rule.name, evt.__dict__))
+            matched += expected
+        return matched
+
+    def testSectionsAgree(self):
+        self.assertEqual([ rule.name for rule in self.rules.sections ],
+                         ['A Literals', 'B Regexes', 'C Systems', 'D Mixed literals and regexes',
+                          'E Severity range', 'F Severity list', 'G Range and list', 'H Everything'])
+        for rule in self.rules.sections:
+            matched = self.checkSection(rule)
+            # Each section must match some events and miss others to be a test at all
+            self.assertTrue(0 < matched < len(self.events), 'section %s matched %d' % (rule.name, matched))
+
+    def testAutoclearAgrees(self):
+        self.checkSection(self.rules.autoclear)
+
+    def testLiteralsIgnoreCase(self):
+        rule = self.rules.sections[0]
+        evt = FakeEvent(DeviceGroups='/Other|/WINDOWS', device='Web01', component='kernel')
+        self.assertEqual(selectEvent(rule, evt), 1)
+        evt.component = 'HTTPD'
+        self.assertEqual(selectEvent(rule, evt), 0)
+
+    def testIntFilters(self):
+        filters = dict([ (check[0], check[2]) for check in self.rules.sections[6].checks ])
+        self.assertEqual((filters['severity'].min, filters['severity'].max), (4, None))
+        self.assertEqual(sorted(filters['severity'].values), [2, 4, 5])
+        self.assertEqual([ v for v in range(6) if filters['severity'].accepts(v) ], [4, 5])
+        self.assertEqual(filters['prodstate'].max, 500)
+
+
+# Option names in any case, values with trailing spaces, and literals
+# that look like regexes
+PRECEDENCE_CONFIG = """
+[Devices]
+device-1: Web01  
+Device-2: web.*
+DEVICE-RE-1: ^db[0-9]+$  
+device-re-2: (?i)^MAIL
+notdevice-1: DB99
+notdevice-re-1: ^db0
+"""
+
+
+class TestLiteralsAndRegexes(unittest.TestCase):
+    def setUp(self):
+        self.config = readConfig(PRECEDENCE_CONFIG)
+        self.rule = compileConfig(self.config).sections[0]
+
+    def filters(self, rule):
+        return dict([ (check[0], check[2]) for check in rule.checks ])
+
+    def testAgreesWithConfigREMatch(self):
+        for device in ['web01', 'WEB01', 'Web01 ', 'xweb01', 'web.*', 'WEB.*', 'webserver', 'db1', 'DB12',
+                       'db99', 'db01', 'db1x', 'mail1', 'Mail', 'amail', '']:
+            evt = FakeEvent(device=device)
+            fields = EventFields(evt)
+            expected = configREMatch(self.config, 'Devices', 'device', [device], True)
+            self.assertEqual(self.filters(self.rule)['device'].match(fields, 'device'), expected, device)
+            negated = configREMatch(self.config, 'Devices', 'notdevice', [device], False)
+            self.assertEqual(self.filters(self.rule)['notdevice'].match(fields, 'device'), negated, device)
+
+    def testLiteralReportedFirst(self):
+        # Both a literal and a regex match: the literal is the one reported
+        config = readConfig("[A]\ndevice-re-1: ^web\ndevice-2: WEB01\n")
+        f = self.filters(compileConfig(config).sections[0])['device']
+        self.assertEqual(f.which(EventFields(FakeEvent(device='web01')), 'device'), 'device-2')
+        self.assertEqual(f.which(EventFields(FakeEvent(device='web02')), 'device'), 'device-re-1')
+
+    def testOtherPrefixesNotMixedUp(self):
+        # deviceclass-* and devicegroups-* options are not device options
+        config = readConfig("[A]\ndeviceclass-1: web01\ndevicegroups-re-1: web\n")
+        rule = compileConfig(config).sections[0]
+        self.assertFalse('device' in self.filters(rule))
+        self.assertEqual(configREMatch(config, 'A', 'device', ['web01'], True), True)
+
+
+class TestAlternation(unittest.TestCase):
+    def matches(self, f, value):
+        return f.which(EventFields(FakeEvent(summary=value)), 'summary')
+
+    def testMergedAgreesWithSeparate(self):
+        patterns = [ ('summary-re-%d' % (n), value) for n, value in
+                     enumerate(['^disk', 'full$', '(cpu|load) high', r'(a)\1', '(?x) spaced  out',
+                                '(?P<name>x)y', '(?(1)a|b)', 'plain']) ]
+        automata = compileAlternation(patterns)
+        # The backreference, the inline flag, the group name and the
+        # conditional reference are each compiled on their own
+        self.assertEqual(len(automata), 5)
+        f = StringFilter('summary', {}, patterns)
+        for value in ['disk full', 'Load High', 'aa', 'spacedout', 'xy', 'b', 'plain text', 'nothing']:
+            expected = None
+            for opt, pattern in patterns:
+                if re.search(pattern, value, re.IGNORECASE):
+                    expected = opt
+                    break
+            self.assertEqual(self.matches(f, value) is None, expected is None, value)
+        self.assertEqual(self.matches(f, 'disk'), 'summary-re-0')
+        self.assertEqual(self.matches(f, 'spacedout'), 'summary-re-4')
+
+    def testGroupsInThePatternsAreCounted(self):
+        # 60 options with a group each need 120 groups: too many for one expression
+        patterns = [ ('summary-re-%d' % (n), '^(foo|bar)%d$' % (n)) for n in range(60) ]
+        automata = compileAlternation(patterns)
+        self.assertEqual(len(automata), 2)
+        for automaton, names in automata:
+            self.assertTrue(automaton.groups <= MAX_GROUPS)
+        f = StringFilter('summary', {}, patterns)
+        self.assertEqual(self.matches(f, 'bar59'), 'summary-re-59')
+        self.assertEqual(self.matches(f, 'foo0'), 'summary-re-0')
+        self.assertEqual(self.matches(f, 'baz1'), None)
+
+    def testManyOptions(self):
+        patterns = [ ('summary-re-%d' % (n), 'host%03d$' % (n)) for n in range(250) ]
+        automata = compileAlternation(patterns)
+        self.assertEqual(len(automata), 3)
+        f = StringFilter('summary', {}, patterns)
+        for n in (0, 98, 99, 249):
+            self.assertEqual(self.matches(f, 'host%03d' % (n)), 'summary-re-%d' % (n))
+
+    def testTooManyGroupsIsARuleError(self):
+        config = readConfig('[A]\nsummary-re-1: %s\n' % ('(a)' * 120))
+        self.assertRaises(RuleError, compileConfig, config)
+
+
+class TestPrefilter(unittest.TestCase):
+    def setUp(self):
+        self.config = readConfig(CONFIG)
+        self.rules = compileConfig(self.config)
+
+    def testCheapestChecksFirst(self):
+        rule = self.rules.sections[7]
+        self.assertEqual([ check[0] for check in rule.checks ],
+                         ['severity', 'notdevicegroups', 'component', 'devicegroups', 'summary'])
+        costs = [ checkCost(check) for check in rule.checks ]
+        self.assertEqual(costs, sorted(costs))
+
+    def testCandidatesAreTheSectionsThatCanMatch(self):
+        for evt in makeEvents(2000, 2):
+            fields = EventFields(evt)
+            candidates = self.rules.candidates(fields)
+            # Every section that matches is a candidate, in the same order
+            self.assertEqual([ rule for rule in candidates if selectEvent(rule, evt, fields) ],
+                             [ rule for rule in self.rules.sections if selectEvent(rule, evt, fields) ])
+            # and every candidate accepts the event's integer attributes
+            for rule in self.rules.sections:
+                accepted = True
+                for prefix, attr, f, negate in rule.checks:
+                    if isinstance(f, IntFilter) and not f.accepts(getattr(evt, attr)):
+                        accepted = False
+                self.assertEqual(rule in candidates, accepted, rule.name)
+
+    def testIntIndexBuckets(self):
+        sections = self.rules.sections
+        index = IntIndex('severity', 'severity', sections)
+        # E accepts 3-4, F 2 and 5, G 4 and 5, H 4 and above; the rest anything
+        anything = set([0, 1, 2, 3])
+        expected = {-1: anything, 0: anything, 1: anything, 2: anything | set([5]),
+                    3: anything | set([4]), 4: anything | set([4, 6, 7]), 5: anything | set([5, 6, 7]),
+                    6: anything | set([7]), 100: anything | set([7])}
+        for value, positions in expected.items():
+            self.assertEqual(set(index.lookup(value)), positions, 'severity %d' % (value))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestCompiledRules))
+    suite.addTest(makeSuite(TestLiteralsAndRegexes))
+    suite.addTest(makeSuite(TestAlternation))
+    suite.addTest(makeSuite(TestPrefilter))
+    return suite
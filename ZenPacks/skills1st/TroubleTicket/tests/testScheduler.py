@@ -0,0 +1,61 @@
+#
+# Tests for the timing of the main loop. Times are passed in explicitly,
+# so nothing here actually waits.
+#
+
+import unittest
+
+from ZenPacks.skills1st.TroubleTicket.scheduler import CycleScheduler
+
+
+class TestCycleScheduler(unittest.TestCase):
+    def cycle(self, scheduler, start, duration, activity):
+        scheduler.start(start)
+        return scheduler.finish(activity, start + duration)
+
+    def testWorkTimeNotAdded(self):
+        scheduler = CycleScheduler(60, 60, 60)
+        self.assertEqual(self.cycle(scheduler, 1000, 15, 0), 45)
+        self.assertEqual(self.cycle(scheduler, 1060, 5, 0), 55)
+
+    def testNoDrift(self):
+        scheduler = CycleScheduler(60, 60, 60)
+        delay = self.cycle(scheduler, 1000, 10, 0)
+        # Waking up late does not push the following cycles back
+        delay = self.cycle(scheduler, 1000 + 10 + delay + 2, 10, 0)
+        self.assertEqual(scheduler.due, 1120)
+
+    def testFasterWhileBusy(self):
+        scheduler = CycleScheduler(60, 10, 60)
+        self.cycle(scheduler, 1000, 1, 5)
+        self.assertEqual(scheduler.interval, 30)
+        for n in range(5):
+            self.cycle(scheduler, scheduler.due, 1, 5)
+        self.assertEqual(scheduler.interval, 10)
+        self.cycle(scheduler, scheduler.due, 1, 0)
+        self.assertEqual(scheduler.interval, 20)
+
+    def testSlowerWhenQuiet(self):
+        scheduler = CycleScheduler(60, 10, 120)
+        for n in range(5):
+            self.cycle(scheduler, 1000 + n * 200, 1, 0)
+        self.assertEqual(scheduler.interval, 120)
+
+    def testNeverBelowOneSecond(self):
+        scheduler = CycleScheduler(60, 0, 60)
+        for n in range(20):
+            self.cycle(scheduler, scheduler.due or 1000, 0, 5)
+        self.assertEqual(scheduler.interval, 1)
+
+    def testOverrunStartsAtOnce(self):
+        scheduler = CycleScheduler(60, 60, 60)
+        self.assertEqual(self.cycle(scheduler, 1000, 90, 0), 0)
+        self.assertEqual(scheduler.overruns, 1)
+        self.assertEqual(self.cycle(scheduler, 1090, 10, 0), 50)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestCycleScheduler))
+    return suite
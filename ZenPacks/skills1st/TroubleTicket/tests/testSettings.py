@@ -0,0 +1,166 @@
+#
+# Tests for loading and checking zentt.conf, as done at startup and on reload.
+#
+
+import os, shutil, tempfile, unittest
+
+from ZenPacks.skills1st.TroubleTicket.settings import DaemonConfig, reloadConfig
+from ZenPacks.skills1st.TroubleTicket.rules import RuleError
+from ZenPacks.skills1st.TroubleTicket.tickets import TicketError, registerBackend, BACKENDS
+
+GOOD_CONFIG = """
+[DAEMONSTUFF]
+ttcommand: /bin/echo %evid%
+cycletime: 60
+fetchsize: 200
+
+[Linux]
+devicegroups-1: /Linux
+severity-min: 4
+"""
+
+
+# A plugin backend that fails in its own way when set up
+class BrokenBackend(object):
+    def fromOptions(cls, options):
+        return cls( int(options.get('brokenport', 'none')) )
+    fromOptions = classmethod(fromOptions)
+
+
+class TestDaemonConfig(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'zentt.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        f = open(self.path, 'w')
+        f.write(text)
+        f.close()
+
+    def testGoodConfig(self):
+        self.write(GOOD_CONFIG)
+        config = DaemonConfig(self.path)
+        self.assertEqual(config.cycletime, 60)
+        self.assertEqual(config.fetchsize, 200)
+        self.assertEqual([ rule.name for rule in config.rules.sections ], ['Linux'])
+        self.assertFalse(config.changed())
+
+    def testGenerationFollowsText(self):
+        self.write(GOOD_CONFIG)
+        first = DaemonConfig(self.path)
+        self.assertEqual(DaemonConfig(self.path).generation, first.generation)
+        self.write(GOOD_CONFIG + "summary: disk\n")
+        self.assertNotEqual(DaemonConfig(self.path).generation, first.generation)
+
+    def testBadRegexRejected(self):
+        self.write(GOOD_CONFIG + "summary-re-1: (unclosed\n")
+        self.assertRaises(RuleError, DaemonConfig, self.path)
+
+    def testBadNumberRejected(self):
+        self.write(GOOD_CONFIG.replace('fetchsize: 200', 'fetchsize: lots'))
+        self.assertRaises(RuleError, DaemonConfig, self.path)
+
+    def testFetchsizeMustBePositive(self):
+        for value in ('0', '-5'):
+            self.write(GOOD_CONFIG.replace('fetchsize: 200', 'fetchsize: ' + value))
+            try:
+                DaemonConfig(self.path)
+            except RuleError as e:
+                self.assertTrue(e.errmsg.startswith('fetchsize in the DAEMONSTUFF section must be at least 1'))
+            else:
+                self.fail('fetchsize: %s accepted' % (value))
+
+    def testWritebatchMustBePositive(self):
+        self.write(GOOD_CONFIG.replace('fetchsize: 200', 'writebatch: 0'))
+        self.assertRaises(RuleError, DaemonConfig, self.path)
+
+    def testCycleTimesAtLeastOneSecond(self):
+        self.write(GOOD_CONFIG.replace('fetchsize: 200', 'mincycletime: 0'))
+        self.assertRaises(RuleError, DaemonConfig, self.path)
+        self.write(GOOD_CONFIG.replace('cycletime: 60', 'cycletime: 0'))
+        self.assertRaises(RuleError, DaemonConfig, self.path)
+
+    def testEveryNumberChecked(self):
+        for option in ('tttimeout: abc', 'tttimeout: 0', 'max-concurrent-tickets: 0', 'retrytime: -1',
+                       'retrylimit: many', 'cachesize: -1', 'ratelimit-target: -5', 'breaker-probetime: 0',
+                       'shards: 0'):
+            self.write(GOOD_CONFIG.replace('fetchsize: 200', option))
+            try:
+                DaemonConfig(self.path)
+            except RuleError as e:
+                self.assertTrue(e.errmsg.startswith(option.split(':')[0] + ' in the DAEMONSTUFF section'), e.errmsg)
+            else:
+                self.fail('%s accepted' % (option))
+
+    def testPluginErrorIsATicketError(self):
+        registerBackend('broken', BrokenBackend)
+        try:
+            self.write(GOOD_CONFIG + "ttbackend: broken\n")
+            self.assertRaises(TicketError, DaemonConfig, self.path)
+        finally:
+            del BACKENDS['broken']
+
+    def testMissingCycletimeRejected(self):
+        self.write(GOOD_CONFIG.replace('cycletime: 60', ''))
+        self.assertRaises(RuleError, DaemonConfig, self.path)
+
+    def testUnparseableFileRejected(self):
+        self.write("no section header\n" + GOOD_CONFIG)
+        self.assertRaises(RuleError, DaemonConfig, self.path)
+
+    def testUnknownBackendRejected(self):
+        self.write(GOOD_CONFIG + "ttbackend: nosuchbackend\n")
+        self.assertRaises(TicketError, DaemonConfig, self.path)
+
+
+class TestReload(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'zentt.conf')
+        self.write(GOOD_CONFIG)
+        self.config = DaemonConfig(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text, mtime=1000):
+        f = open(self.path, 'w')
+        f.write(text)
+        f.close()
+        # Each version looks new, however quickly it is written
+        os.utime(self.path, (mtime, mtime))
+
+    def testBadFileKeepsTheOldRules(self):
+        self.write(GOOD_CONFIG.replace('fetchsize: 200', 'fetchsize: lots') + "summary-re-1: (unclosed\n", 2000)
+        self.assertTrue(self.config.changed())
+        config = reloadConfig(self.config)
+        self.assertTrue(config is self.config)
+        self.assertEqual(config.fetchsize, 200)
+        self.assertEqual([ rule.name for rule in config.rules.sections ], ['Linux'])
+        self.assertEqual([ check[0] for check in config.rules.sections[0].checks ], ['severity', 'devicegroups'])
+        # Not tried again until the file changes again
+        self.assertFalse(config.changed())
+
+    def testTouchedFileKeepsTheConfig(self):
+        self.write(GOOD_CONFIG, 2000)
+        config = reloadConfig(self.config)
+        self.assertTrue(config is self.config)
+        self.assertFalse(config.changed())
+
+    def testGoodFileIsUsed(self):
+        self.write(GOOD_CONFIG.replace('fetchsize: 200', 'fetchsize: 50'), 2000)
+        config = reloadConfig(self.config)
+        self.assertFalse(config is self.config)
+        self.assertEqual(config.fetchsize, 50)
+        self.assertNotEqual(config.generation, self.config.generation)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestDaemonConfig))
+    suite.addTest(makeSuite(TestReload))
+    return suite
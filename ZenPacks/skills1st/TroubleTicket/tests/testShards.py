@@ -0,0 +1,114 @@
+#
+# Tests for the sharded running of zentt.
+#
+
+import os, time, signal, shutil, tempfile, unittest
+
+from ZenPacks.skills1st.TroubleTicket.shards import Shard, shardOf, shardName, shardPidfile, \
+     ShardSupervisor, workerStatus
+from ZenPacks.skills1st.TroubleTicket.poller import EventPoller
+from ZenPacks.skills1st.TroubleTicket.ratelimit import RateLimiter
+from ZenPacks.skills1st.TroubleTicket.stats import CycleStats, writeStats
+from ZenPacks.skills1st.TroubleTicket.replay import FakeEventManager
+
+
+# Keeps the where clause of each query
+class RecordingEventManager(FakeEventManager):
+    def __init__(self, events):
+        FakeEventManager.__init__(self, events)
+        self.queries = []
+
+    def getEventList(self, resultFields=[], where="", orderby="", **kw):
+        self.queries.append(where)
+        return FakeEventManager.getEventList(self, resultFields, where, orderby, **kw)
+
+
+class TestSharding(unittest.TestCase):
+    def testShardOfIsStable(self):
+        # CRC-32, the same as MySQL's CRC32() function
+        self.assertEqual(shardOf('web01.example.com', 1000), 2033017035 % 1000)
+        for n in range(50):
+            self.assertTrue(0 <= shardOf('host%d' % (n), 3) < 3)
+
+    def testPollersSplitTheEvents(self):
+        self.dir = tempfile.mkdtemp()
+        try:
+            zem = RecordingEventManager([ {'evid': 'e%d' % (n), 'device': 'host%d' % (n % 7), 'lastTime': 100 + n}
+                                     for n in range(40) ])
+            seen = []
+            for index in range(3):
+                poller = EventPoller(zem, os.path.join(self.dir, '%d.state' % (index)), 3600, 'g', Shard(index, 3))
+                events = poller.poll()
+                evids = [ e.evid for e in events ]
+                # Only this shard's events are read from the database
+                mine = [ evid for evid in sorted(zem.status) if shardOf(zem.status[evid]['device'], 3) == index ]
+                self.assertEqual(sorted(evids), mine)
+                seen.extend(evids)
+                # and the watermark follows them
+                self.assertEqual(poller.pending[0], max([ zem.status[evid]['lastTime'] for evid in mine ]))
+                poller.commit()
+                poller.poll()
+                self.assertEqual(zem.queries[-1], "(lastTime >= %f or stateChange >= FROM_UNIXTIME(0))"
+                                 " and CRC32(device) %% 3 = %d" % (poller.lastTime, index))
+            self.assertEqual(sorted(seen), sorted([ 'e%d' % (n) for n in range(40) ]))
+        finally:
+            shutil.rmtree(self.dir)
+
+    def testRateLimitsAreShared(self):
+        limiter = RateLimiter()
+        limiter.configure(60, 10, None, (), 4)
+        self.assertEqual((limiter.targetRate, limiter.targetBurst), (15.0, 2))
+        limiter.configure(2, 2, None, (), 4)
+        self.assertEqual((limiter.targetRate, limiter.targetBurst), (0.5, 1))
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def worker(self, shard):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        time.sleep(30)
+
+    def testWorkerRestarted(self):
+        supervisor = ShardSupervisor(2, self.worker)
+        supervisor.startAll()
+        try:
+            self.assertEqual(sorted(supervisor.workers.values()), [0, 1])
+            dead = [ pid for pid, index in supervisor.workers.items() if index == 1 ][0]
+            os.kill(dead, signal.SIGKILL)
+            time.sleep(0.5)
+            # Not straight away, so that a failing worker does not spin
+            supervisor.check()
+            self.assertEqual(supervisor.workers.values(), [0])
+            self.assertEqual(supervisor.restarts, [1])
+            supervisor.check(now=time.time() + 60)
+            self.assertEqual(sorted(supervisor.workers.values()), [0, 1])
+            self.assertFalse(dead in supervisor.workers)
+        finally:
+            supervisor.stopAll()
+        self.assertEqual(supervisor.workers, {})
+
+    def testWorkerStatus(self):
+        f = open(shardPidfile(self.dir, 0), 'w')
+        f.write('%d\n' % (os.getpid()))
+        f.close()
+        stats = CycleStats()
+        stats.count('ticketsCreated', 3)
+        writeStats(os.path.join(self.dir, shardName(0) + '-stats.json'), time.time(), 5, stats, stats)
+        lines = workerStatus(self.dir, 2, 300)
+        self.assertTrue(lines[0].startswith('worker 1/2: running; pid=%d, 5 cycles' % (os.getpid())))
+        self.assertTrue(lines[0].endswith('3 tickets created)'))
+        self.assertEqual(lines[1], 'worker 2/2: not running')
+        self.assertTrue(workerStatus(self.dir, 2, 300, now=time.time() + 600)[0].startswith('worker 1/2: STALLED'))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestSharding))
+    suite.addTest(makeSuite(TestSupervisor))
+    return suite
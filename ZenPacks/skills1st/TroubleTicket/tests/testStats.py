@@ -0,0 +1,55 @@
+#
+# Tests for the per-cycle statistics and the 'zentt stats' output.
+#
+
+import os, shutil, tempfile, unittest
+
+from ZenPacks.skills1st.TroubleTicket.stats import CycleStats, timed, writeStats, readStats, formatStats
+
+
+class TestCycleStats(unittest.TestCase):
+    def testLatencyBuckets(self):
+        stats = CycleStats()
+        for seconds in (0.05, 0.1, 0.3, 45, 600):
+            stats.ticketLatency(seconds)
+        self.assertEqual(stats.latency, [2, 0, 1, 0, 0, 0, 0, 0, 1, 1])
+
+    def testMerge(self):
+        totals = CycleStats()
+        for n in range(3):
+            stats = CycleStats()
+            stats.count('ticketsCreated', 2)
+            stats.addTime('writeTime', 0.5)
+            stats.matched('Linux')
+            totals.merge(stats)
+        self.assertEqual(totals.counts['ticketsCreated'], 6)
+        self.assertEqual(totals.times['writeTime'], 1.5)
+        self.assertEqual(totals.sections, {'Linux': 3})
+
+    def testTimedPassesItemsOn(self):
+        stats = CycleStats()
+        self.assertEqual(list(timed(range(5), stats, 'fetchTime')), range(5))
+        self.assertTrue(stats.times['fetchTime'] >= 0)
+
+    def testFileRoundTrip(self):
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'stats.json')
+            stats = CycleStats()
+            stats.count('eventsPolled', 7)
+            stats.matched('Linux')
+            writeStats(path, 1000.0, 1, stats, stats)
+            state = readStats(path)
+            self.assertEqual(state['lastCycle']['eventsPolled'], 7)
+            lines = formatStats(state)
+            self.assertTrue(lines[0].startswith('zentt OK - 1 cycles'))
+            self.assertTrue('eventsPolled=7' in lines[0].split('|')[1].split())
+        finally:
+            shutil.rmtree(dir)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestCycleStats))
+    return suite
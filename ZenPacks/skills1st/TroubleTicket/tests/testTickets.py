@@ -0,0 +1,348 @@
+#
+# Tests for the ticket backends. The HTTP backend is run against a stub
+# ticket service on a local port, and the coprocess backend against the
+# --serve loop of zenoss-remote-ticket with a stub in place of the
+# Remedy macro, so no real ticket system is needed.
+#
+
+import os, time, errno, socket, shutil, tempfile, threading, unittest, httplib, BaseHTTPServer
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from ZenPacks.skills1st.TroubleTicket import tickets
+from ZenPacks.skills1st.TroubleTicket.tickets import HttpBackend, CoprocessBackend, EventData, TicketData, \
+     TicketError, TicketJob, TicketPool, Template, neverProcessed
+
+# Records the arguments of each request, NUL-separated after their number,
+# and replies with the server's pid. 'hang' and 'die' as the first
+# argument make the server stop answering or exit.
+STUB_CREATE = """#!/bin/sh
+exec 2>/dev/null
+create_ticket() {
+	case "$1" in
+	hang) sleep 5; return ;;
+	die) kill -9 $$ ;;
+	esac
+	printf '%%s\\0' "$#" "$@" >> '%s'
+	echo "TT-$$"
+}
+
+"""
+
+
+class StubTicketHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # HTTP/1.1 so that connections are kept alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append( (self.path, json.loads(body)) )
+        time.sleep(self.server.delay)
+        status = self.server.status
+        reply = json.dumps({'id': 'INC%d' % (len(self.server.requests))})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+        if self.server.dropConnections:
+            # Close without telling the client, as an idle timeout would
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubEvent(object):
+    evid = 'ev-1'
+    device = 'host1.example.org'
+    summary = 'Disk full'
+    severity = 5
+
+
+class TestHttpBackend(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubTicketHandler)
+        self.server.requests = []
+        self.server.connections = 0
+        self.server.status = 201
+        self.server.dropConnections = False
+        self.server.delay = 0
+        # The client gives up on slow replies, so writing them may fail
+        self.server.handle_error = lambda request, address: None
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        url = 'http://127.0.0.1:%d/tickets/%%param-queue%%' % (self.server.server_port)
+        self.backend = HttpBackend(url, "'Device=%device%' 'Summary=%summary% (%severity%)' 'Queue=%param-queue%'")
+        self.data = TicketData(EventData(StubEvent()), {'param-queue': 'L1'}, {})
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testTicketCreated(self):
+        ticket = self.backend.create( self.backend.prepare(self.data) )
+        self.assertEqual(ticket, 'INC1')
+        path, fields = self.server.requests[0]
+        self.assertEqual(path, '/tickets/L1')
+        self.assertEqual(fields, {'Device': 'host1.example.org', 'Summary': 'Disk full (5)', 'Queue': 'L1'})
+
+    def testConnectionReused(self):
+        for n in range(3):
+            self.backend.create( self.backend.prepare(self.data) )
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def testStaleConnectionRetried(self):
+        self.server.dropConnections = True
+        self.assertEqual(self.backend.create( self.backend.prepare(self.data) ), 'INC1')
+        self.assertEqual(self.backend.create( self.backend.prepare(self.data) ), 'INC2')
+
+    def testTimeoutNotRetried(self):
+        self.backend.create( self.backend.prepare(self.data) )
+        # The service gets the ticket but is too slow to answer: sending
+        # it again could make a second ticket
+        self.backend.timeout = 0.5
+        self.backend.close()
+        self.backend.create( self.backend.prepare(self.data) )
+        self.server.delay = 1.5
+        payload = self.backend.prepare(self.data)
+        self.assertRaises(TicketError, self.backend.create, payload)
+        time.sleep(1.5)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def testWhichErrorsAreRetried(self):
+        self.assertTrue(neverProcessed(httplib.BadStatusLine('')))
+        self.assertTrue(neverProcessed(socket.error(errno.ECONNRESET, 'Connection reset by peer')))
+        self.assertTrue(neverProcessed(socket.error(errno.EPIPE, 'Broken pipe')))
+        self.assertFalse(neverProcessed(httplib.BadStatusLine('garbage')))
+        self.assertFalse(neverProcessed(socket.timeout('timed out')))
+        self.assertFalse(neverProcessed(httplib.IncompleteRead('partial')))
+
+    def testHttpErrorFails(self):
+        self.server.status = 500
+        payload = self.backend.prepare(self.data)
+        self.assertRaises(TicketError, self.backend.create, payload)
+
+
+class TestCoprocessBackend(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'requests.log')
+        # The real request loop, so that its unquoting is tested too
+        f = open(os.path.join(os.path.dirname(tickets.__file__), 'lib', 'zenoss-remote-ticket'))
+        text = f.read()
+        f.close()
+        serve = text[text.index('if [ "$1" = "--serve" ]'):]
+        serve = serve[:serve.index('\nfi\n') + 4]
+        self.script = os.path.join(self.dir, 'ttserver')
+        f = open(self.script, 'w')
+        f.write(STUB_CREATE % (self.log) + serve)
+        f.close()
+        os.chmod(self.script, 0755)
+        self.backend = CoprocessBackend(self.script + ' --serve', '%device% %summary% Queue=L1', 2)
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.dir)
+
+    def create(self, device, summary='Disk full'):
+        evt = StubEvent()
+        evt.device = device
+        evt.summary = summary
+        return self.backend.create( self.backend.prepare(TicketData(EventData(evt), {}, {})) )
+
+    # The arguments of each request the server has seen
+    def received(self):
+        f = open(self.log, 'rb')
+        words = f.read().split('\0')[:-1]
+        f.close()
+        requests = []
+        while words:
+            count = int(words[0])
+            requests.append(words[1:count + 1])
+            words = words[count + 1:]
+        return requests
+
+    def testArgumentsArriveIntact(self):
+        summaries = ['it\'s "quoted"', 'disk $(touch %s/dollar) full' % (self.dir),
+                     'disk `touch %s/backtick` full' % (self.dir), 'full; touch %s/semicolon' % (self.dir),
+                     'first line\nsecond line\r\nthird', '\\ and * and $HOME', '']
+        replies = set()
+        for summary in summaries:
+            replies.add( self.create('host1', summary) )
+        # One server did them all
+        self.assertEqual(len(replies), 1)
+        expected = [ ['host1', summary, 'Queue=L1'] for summary in summaries ]
+        # Requests are one line each, so newlines become spaces
+        expected[4][1] = 'first line second line third'
+        self.assertEqual(self.received(), expected)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['requests.log', 'ttserver'])
+
+    def testHungServerIsReplaced(self):
+        self.backend.timeout = 0.5
+        first = self.create('host1')
+        start = time.time()
+        try:
+            self.create('hang')
+        except TicketError as e:
+            self.assertTrue('did not reply within' in e.errmsg, e.errmsg)
+        else:
+            self.fail('no TicketError')
+        self.assertTrue(time.time() - start < 2)
+        second = self.create('host2')
+        self.assertNotEqual(second, first)
+        self.assertEqual([ request[0] for request in self.received() ], ['host1', 'host2'])
+
+    def testDeadServerIsReplaced(self):
+        first = self.create('host1')
+        try:
+            self.create('die')
+        except TicketError as e:
+            self.assertTrue('exited' in e.errmsg, e.errmsg)
+        else:
+            self.fail('no TicketError')
+        second = self.create('host2')
+        self.assertNotEqual(second, first)
+        self.assertEqual(self.create('host3'), second)
+
+
+class TestTemplate(unittest.TestCase):
+    def setUp(self):
+        evt = StubEvent()
+        evt.summary = 'Disk full on /var'
+        self.data = TicketData(EventData(evt), {'param-queue': 'L1', 'param-device': 'param'},
+                               {'param-queue': 'L0', 'device': 'daemonstuff', 'ttuser': 'zenoss'})
+
+    def render(self, text):
+        return Template(text).render(self.data)
+
+    def testUnknownKeysLeftAlone(self):
+        self.assertEqual(self.render('create %nosuchkey% %evid%'), ['create', '%nosuchkey%', 'ev-1'])
+
+    def testLiteralPercents(self):
+        self.assertEqual(self.render('%% 100% %%severity%%'), ['%%', '100%', '%5%'])
+
+    def testQuotingSplitsOnlyTheTemplate(self):
+        # A value with spaces stays one argument, however it is quoted
+        self.assertEqual(self.render("'Summary: %summary%' \"%device% %severity%\" %summary%"),
+                         ['Summary: Disk full on /var', 'host1.example.org 5', 'Disk full on /var'])
+
+    def testKeysIgnoreCase(self):
+        self.assertEqual(self.render('%DEVICE% %Param-Queue%'), ['host1.example.org', 'L1'])
+
+    def testEventThenParamThenDaemonstuff(self):
+        self.assertEqual(self.render('%device% %param-queue% %param-device% %ttuser%'),
+                         ['host1.example.org', 'L1', 'param', 'zenoss'])
+
+    def testKeysFound(self):
+        self.assertEqual(Template('%device% x%Summary%y %% %nosuchkey%').keys,
+                         frozenset(['%device%', '%summary%', '%nosuchkey%']))
+
+
+# A ticket backend that takes a while and records what it was asked
+# for, in order, and how many tickets it was making at once
+class RecordingBackend(object):
+    def __init__(self, delay=0.0, failing=()):
+        self.delay = delay
+        self.failing = set(failing)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.running = 0
+        self.mostRunning = 0
+
+    def create(self, payload):
+        self.lock.acquire()
+        self.requests.append(payload)
+        self.running += 1
+        self.mostRunning = max(self.mostRunning, self.running)
+        self.lock.release()
+        time.sleep(self.delay)
+        self.lock.acquire()
+        self.running -= 1
+        self.lock.release()
+        if payload in self.failing:
+            raise TicketError("no ticket for %s in %s" % payload)
+        return 'TT-%s-%s' % payload
+
+
+class PoolEvent(object):
+    def __init__(self, evid):
+        self.evid = evid
+
+
+class TestTicketPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.stop()
+
+    def makeJob(self, backend, evid, sections, multiTicket):
+        return TicketJob(PoolEvent(evid), [ (section, backend, (evid, section)) for section in sections ], multiTicket)
+
+    def runJobs(self, size, jobs):
+        self.pool = TicketPool(size)
+        for job in jobs:
+            self.pool.submit(job)
+        return dict([ (job.evt.evid, job) for job in self.pool.wait() ])
+
+    def testSectionsInOrder(self):
+        backend = RecordingBackend()
+        done = self.runJobs(1, [ self.makeJob(backend, 'ev-1', ['A', 'B', 'C'], True) ])
+        self.assertEqual(backend.requests, [('ev-1', 'A'), ('ev-1', 'B'), ('ev-1', 'C')])
+        self.assertEqual(done['ev-1'].results,
+                         [('A', 'TT-ev-1-A', None), ('B', 'TT-ev-1-B', None), ('C', 'TT-ev-1-C', None)])
+
+    def testFirstSuccessEndsTheJob(self):
+        backend = RecordingBackend(failing=[('ev-1', 'A')])
+        done = self.runJobs(1, [ self.makeJob(backend, 'ev-1', ['A', 'B', 'C'], False) ])
+        self.assertEqual(backend.requests, [('ev-1', 'A'), ('ev-1', 'B')])
+        self.assertEqual(done['ev-1'].results,
+                         [('A', None, 'no ticket for ev-1 in A'), ('B', 'TT-ev-1-B', None)])
+
+    def testMultiTicketCarriesOnAfterFailure(self):
+        backend = RecordingBackend(failing=[('ev-1', 'B')])
+        done = self.runJobs(1, [ self.makeJob(backend, 'ev-1', ['A', 'B', 'C'], True) ])
+        self.assertEqual([ (section, ticket) for section, ticket, errmsg in done['ev-1'].results ],
+                         [('A', 'TT-ev-1-A'), ('B', None), ('C', 'TT-ev-1-C')])
+
+    def testNoMoreThanSizeAtOnce(self):
+        backend = RecordingBackend(delay=0.05)
+        start = time.time()
+        done = self.runJobs(3, [ self.makeJob(backend, 'ev-%d' % (n), ['A'], False) for n in range(12) ])
+        self.assertEqual(len(done), 12)
+        self.assertEqual(backend.mostRunning, 3)
+        # Four rounds of three, not twelve one after another
+        self.assertTrue(time.time() - start < 0.5)
+
+    def testResultsComeBackToTheirEvent(self):
+        backend = RecordingBackend(delay=0.01, failing=[ ('ev-%d' % (n), 'A') for n in range(0, 20, 3) ])
+        jobs = [ self.makeJob(backend, 'ev-%d' % (n), ['A', 'B'], False) for n in range(20) ]
+        done = self.runJobs(4, jobs)
+        self.assertEqual(sorted(done), sorted([ job.evt.evid for job in jobs ]))
+        for evid, job in done.items():
+            expected = [('A', 'TT-%s-A' % (evid), None)]
+            if int(evid[3:]) % 3 == 0:
+                expected = [('A', None, 'no ticket for %s in A' % (evid)), ('B', 'TT-%s-B' % (evid), None)]
+            self.assertEqual(job.results, expected)
+        self.assertFalse(self.pool.isBusy('ev-1'))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestHttpBackend))
+    suite.addTest(makeSuite(TestCoprocessBackend))
+    suite.addTest(makeSuite(TestTemplate))
+    suite.addTest(makeSuite(TestTicketPool))
+    return suite
@@ -0,0 +1,132 @@
+#
+# Tests for the grouped writes to the event status table, against a
+# stand-in for the event manager that records the calls it is sent.
+#
+
+import unittest
+from MySQLdb import OperationalError
+from Products.ZenEvents.Exceptions import ZenEventNotFound
+
+from ZenPacks.skills1st.TroubleTicket.writer import StatusWriter, AUTOCLEAR_TAG
+
+
+# Records each call, and raises the errors queued up for a method
+class RecordingEventManager(object):
+    def __init__(self):
+        self.calls = []
+        self.errors = {}
+
+    def call(self, method, *args):
+        self.calls.append( (method,) + args )
+        errors = self.errors.get(method)
+        if errors:
+            raise errors.pop(0)
+
+    def manage_setEventStates(self, eventState, evids):
+        self.call('manage_setEventStates', eventState, list(evids))
+
+    def updateEvents(self, update, whereClause, reason):
+        self.call('updateEvents', update, whereClause, reason)
+
+    def manage_deleteEvents(self, evids):
+        self.call('manage_deleteEvents', list(evids))
+
+
+class TestStatusWriter(unittest.TestCase):
+    def setUp(self):
+        self.zem = RecordingEventManager()
+        self.writer = StatusWriter(self.zem, 10)
+
+    def methods(self):
+        return [ call[0] for call in self.zem.calls ]
+
+    def testTicketsWrittenTogether(self):
+        self.writer.ticketCreated('ev-2', 'TT-2')
+        self.writer.ticketCreated('ev-1', 'TT-1')
+        self.writer.flush()
+        self.assertEqual(self.zem.calls, [
+            ('manage_setEventStates', 1, ['ev-1', 'ev-2']),
+            ('updateEvents',
+             "update status set ownerid = CASE evid WHEN 'ev-1' THEN 'Ticket TT-1' WHEN 'ev-2' THEN 'Ticket TT-2' END",
+             "where evid in ('ev-1', 'ev-2')", 'Trouble Ticket created'),
+        ])
+        self.assertEqual(self.writer.pending(), 0)
+        # Nothing left to write
+        self.writer.flush()
+        self.assertEqual(len(self.zem.calls), 2)
+
+    def testFailuresWrittenTogether(self):
+        self.writer.ticketFailed('ev-1')
+        self.writer.ticketFailed('ev-3')
+        # A later ticket for the same event wins
+        self.writer.ticketFailed('ev-2')
+        self.writer.ticketCreated('ev-2', 'TT-2')
+        self.writer.ticketFailed('ev-2')
+        self.writer.flush()
+        self.assertEqual(self.zem.calls[-1], ('updateEvents', "update status set ownerid='Ticket FAILED'",
+                                              "where evid in ('ev-1', 'ev-3')", 'Ticket creation failed'))
+        self.assertEqual(self.methods(), ['manage_setEventStates', 'updateEvents', 'updateEvents'])
+
+    def testFlushedAtWritebatch(self):
+        for n in range(9):
+            self.writer.ticketCreated('ev-%d' % (n), 'TT-%d' % (n))
+        self.assertEqual(self.zem.calls, [])
+        self.writer.ticketFailed('ev-9')
+        self.assertEqual(self.methods(), ['manage_setEventStates', 'updateEvents', 'updateEvents'])
+        self.assertEqual(len(self.zem.calls[0][2]), 9)
+        self.assertEqual(self.writer.pending(), 0)
+
+    def testBusyDatabaseRetriedNextFlush(self):
+        self.writer.ticketCreated('ev-1', 'TT-1')
+        self.zem.errors['manage_setEventStates'] = [ OperationalError(1205, 'Lock wait timeout exceeded') ]
+        self.writer.flush()
+        self.assertTrue(self.writer.isPending('ev-1'))
+        # The owner is not set on an event that was not acked
+        self.assertEqual(self.methods(), ['manage_setEventStates'])
+        self.writer.flush()
+        self.assertEqual(self.methods(), ['manage_setEventStates', 'manage_setEventStates', 'updateEvents'])
+        self.assertFalse(self.writer.isPending('ev-1'))
+
+    def testOtherDatabaseErrorsRaised(self):
+        self.writer.ticketFailed('ev-1')
+        self.zem.errors['updateEvents'] = [ OperationalError(1054, "Unknown column 'ownerid'") ]
+        self.assertRaises(OperationalError, self.writer.flush)
+        self.assertTrue(self.writer.isPending('ev-1'))
+
+    def testGoneEventsForgotten(self):
+        self.writer.ticketFailed('ev-1')
+        self.zem.errors['updateEvents'] = [ ZenEventNotFound('ev-1') ]
+        self.writer.flush()
+        self.assertEqual(self.writer.pending(), 0)
+
+    def testAutoclearInChunks(self):
+        writer = StatusWriter(self.zem, 4)
+        # More than writebatch build up while the database is busy
+        writer.cleared.update([ 'ev-%d' % (n) for n in range(6) ])
+        writer.flush()
+        self.assertEqual(self.methods(), ['updateEvents', 'manage_deleteEvents', 'updateEvents', 'manage_deleteEvents'])
+        update, whereClause, reason = self.zem.calls[0][1:]
+        self.assertEqual(update, "update status set summary = CONCAT(summary, '%s')" % (AUTOCLEAR_TAG))
+        self.assertEqual(whereClause, "where evid in ('ev-0', 'ev-1', 'ev-2', 'ev-3') and summary not like '%%%s'"
+                                      % (AUTOCLEAR_TAG))
+        self.assertEqual(self.zem.calls[1][1], ['ev-0', 'ev-1', 'ev-2', 'ev-3'])
+        self.assertEqual(self.zem.calls[3][1], ['ev-4', 'ev-5'])
+        self.assertEqual(writer.nCleared, 6)
+
+    def testAutoclearDeleteRetried(self):
+        self.writer.clearEvent('ev-1')
+        self.zem.errors['manage_deleteEvents'] = [ OperationalError(1213, 'Deadlock found') ]
+        self.writer.flush()
+        self.assertTrue(self.writer.isPending('ev-1'))
+        self.writer.flush()
+        self.assertEqual(self.methods(), ['updateEvents', 'manage_deleteEvents', 'updateEvents', 'manage_deleteEvents'])
+        # The second tagging leaves the summary tagged once already alone
+        self.assertTrue(self.zem.calls[2][2].endswith("summary not like '%%%s'" % (AUTOCLEAR_TAG)))
+        self.assertEqual(self.writer.nCleared, 1)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestStatusWriter))
+    return suite
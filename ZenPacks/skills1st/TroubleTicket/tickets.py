@@ -0,0 +1,852 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Ticket creation for zentt.
+#			Tickets are created by a backend: the ttcommand run once per
+#			ticket, a long-lived co-process that is sent one request line
+#			per ticket, an HTTP/JSON service, or a plugin class. The backend
+#			can be chosen per section. Backends are driven by a bounded pool of worker
+#			threads so that several tickets can be in progress at once.
+#			Each event's tickets are handled by one worker, in section order.
+#			Tickets for a backend whose circuit breaker is open are held
+#			back rather than tried. With the event loop (eventloop.py)
+#			ticket commands are run as non-blocking subprocesses instead.
+#
+# Updates:
+#
+
+import os, re, time, errno, fcntl, socket, subprocess, threading, logging, Queue, shlex, pipes, httplib, urlparse, base64
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+logger = logging.getLogger('ZenTT')
+
+# Default number of ticket commands that may run at the same time
+DEFAULT_CONCURRENCY = 1
+
+# Default seconds to wait for a ticket command, server or service
+DEFAULT_TIMEOUT = 30
+
+# Exception class for failure to create tickets
+#
+class TicketError(Exception):
+    def __init__(self, errmsg):
+        self.errmsg = errmsg
+
+    def __str__(self):
+        return self.errmsg
+
+# Pattern for the %var% substitution keys in a command template
+KEYPATTERN = re.compile( r'(%[a-z0-9_-]+%)', re.IGNORECASE )
+
+# The %var% keys that are filled in from the event, with the event
+# attribute each comes from and whether leading '|' should be removed.
+# These override any DAEMONSTUFF or param-* option of the same name.
+#
+# NOTE:
+# May need to convert times to some other format.
+# Here is a handy pattern for parsing them...
+# pattern = '%Y/%m/%d %H:%M:%S'
+# epoch = int(time.mktime(time.strptime(evt.lastTime.split('.')[0], pattern)))
+#
+EVENT_KEYS = {
+    '%evid%': ('evid', False),
+    '%device%': ('device', False),
+    '%component%': ('component', False),
+    '%eventclass%': ('eventClass', False),
+    '%eventkey%': ('eventKey', False),
+    '%summary%': ('summary', False),
+    '%message%': ('message', False),
+    '%severity%': ('severity', False),
+    '%eventstate%': ('eventState', False),
+    '%eventclasskey%': ('eventClassKey', False),
+    '%eventgroup%': ('eventGroup', True),
+    '%statechange%': ('stateChange', False),
+    '%firsttime%': ('firstTime', False),
+    '%lasttime%': ('lastTime', False),
+    '%count%': ('count', False),
+    '%prodstate%': ('prodState', False),
+    '%suppid%': ('suppid', False),
+    '%manager%': ('manager', False),
+    '%agent%': ('agent', False),
+    '%deviceclass%': ('DeviceClass', False),
+    '%location%': ('Location', False),
+    '%systems%': ('Systems', True),
+    '%devicegroups%': ('DeviceGroups', True),
+    '%ipaddress%': ('ipAddress', False),
+    '%facility%': ('facility', False),
+    '%priority%': ('priority', False),
+    '%ntevid%': ('ntevid', False),
+    '%ownerid%': ('ownerid', False),
+    '%clearid%': ('clearid', False),
+    '%devicepriority%': ('DevicePriority', False),
+    '%eventclassmapping%': ('eventClassMapping', False),
+}
+
+# The substitution values for one event, worked out only when a
+# template asks for them and then remembered for the other sections
+#
+class EventData(object):
+    __slots__ = ('evt', 'cache')
+
+    def __init__(self, evt):
+        self.evt = evt
+        self.cache = {}
+
+    # Value for a lowercased '%key%', or None if it is not an event key
+    def get(self, key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        how = EVENT_KEYS.get(key)
+        if how is None:
+            return None
+        attr, stripBar = how
+        value = str(getattr(self.evt, attr))
+        if stripBar:
+            value = value.lstrip('|')
+        self.cache[key] = value
+        return value
+
+# All the substitution values for one ticket: event data first,
+# then the section's param-* options, then the DAEMONSTUFF options
+#
+class TicketData(object):
+    __slots__ = ('eventData', 'params', 'options')
+
+    def __init__(self, eventData, params, options):
+        self.eventData = eventData
+        self.params = params
+        self.options = options
+
+    def get(self, key):
+        value = self.eventData.get(key)
+        if value is not None:
+            return value
+        name = key[1:-1]
+        value = self.params.get(name)
+        if value is not None:
+            return value
+        return self.options.get(name)
+
+
+# A command line (or request) template, parsed into arguments once.
+# Each argument is kept as a tuple of pieces where the odd-numbered
+# pieces are %var% keys, so rendering only looks up the keys that the
+# template actually uses.
+#
+class Template(object):
+    __slots__ = ('args', 'keys')
+
+    def __init__(self, text):
+        args = []
+        keys = set()
+        for arg in shlex.split( text ):
+            # Split the argument into a list where each %var% is a separate item
+            pieces = KEYPATTERN.split( arg )
+            for key in pieces[1::2]:
+                keys.add( key.lower() )
+            args.append( tuple(pieces) )
+        self.args = tuple(args)
+        # Lowercased '%var%' keys referenced by the template
+        self.keys = frozenset(keys)
+
+    # Substitute the values from data (anything with a get(key) method).
+    # Unknown keys are left as they are.
+    def render(self, data):
+        values = {}
+        for key in self.keys:
+            value = data.get(key)
+            if value is not None:
+                values[key] = value
+        result = []
+        for pieces in self.args:
+            if len(pieces) == 1:
+                result.append( pieces[0] )
+                continue
+            out = list(pieces)
+            for index in range(1, len(out), 2):
+                out[index] = values.get( out[index].lower(), out[index] )
+            result.append( ''.join(out) )
+        return result
+
+# Check the output from a backend and return the ticket ID
+#
+def checkTicket( output ):
+    ticket = output.rstrip()
+    # Sanity check
+    if not re.search( r'[0-9]+', ticket ):
+        raise TicketError("No ticket ID returned from troubleticket system")
+    return ticket
+
+# Kill a process if it is still running after timeout seconds.
+# Returns the timer, to be cancelled once the process is done with,
+# and a list that has True added to it if the process was killed.
+#
+def killAfter( p, timeout ):
+    killed = []
+    # Marked first, so that whoever sees the process end knows why
+    def kill():
+        killed.append(True)
+        try:
+            p.kill()
+        except OSError:
+            pass
+    timer = threading.Timer( timeout, kill )
+    timer.setDaemon(True)
+    timer.start()
+    return timer, killed
+
+# Run the ticket creation command and return the ticket ID
+# Raises TicketError if no ticket was created, or if the command
+# has not finished after timeout seconds (when given)
+#
+def runTicketCommand( ttargs, timeout=None ):
+    try:
+        # Run the ticket create script (while passing necessary arguments to it).
+        # close_fds stops commands started by other workers holding our pipe open.
+        p = subprocess.Popen(ttargs, stdout=subprocess.PIPE, close_fds=True)
+
+        if not p:
+            raise TicketError("Unable to run ticket creation command %s" % (ttargs[0]))
+
+        # Let the command run and collect its output.
+        # An ssh to a host that has gone can hang for a long time, so
+        # the command is killed if it takes too long.
+        killed = None
+        if timeout:
+            timer, killed = killAfter( p, timeout )
+        try:
+            (stdoutdata, stderrdata) = p.communicate()
+        finally:
+            if timeout:
+                timer.cancel()
+        if killed:
+            raise TicketError("Ticket creation command %s did not finish within %s seconds" % (ttargs[0], timeout))
+        logger.debug( "TT Script stdout: %s" % (stdoutdata) )
+        logger.debug( "TT Script stderr: %s" % (stderrdata) )
+
+    except OSError as e:
+        if e.filename:
+            raise TicketError("Error while running ticket creation command: %s: %s" % (e.filename, e.strerror))
+        else:
+            raise TicketError("Error while running ticket creation command: %s" % (e.strerror))
+
+    # Get the ticket ID
+    return checkTicket( stdoutdata )
+
+
+# Seconds between checks that a command whose output has ended has exited
+REAP_INTERVAL = 0.05
+
+# Run the ticket creation command without waiting for it, for an event
+# loop (anything with addReader, removeReader, callLater and cancel).
+# When it has finished done(ticket ID, None) or done(None, error message)
+# is called from the loop.
+#
+class TicketProcess(object):
+    def __init__(self, loop, ttargs, timeout, done):
+        self.loop = loop
+        self.name = ttargs[0]
+        self.timeout = timeout
+        self.done = done
+        self.output = []
+        self.killed = False
+        self.p = subprocess.Popen(ttargs, stdout=subprocess.PIPE, close_fds=True)
+        self.fd = self.p.stdout.fileno()
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        loop.addReader( self.fd, self.readable )
+        self.timer = None
+        if timeout:
+            self.timer = loop.callLater( timeout, self.expire )
+
+    def readable(self):
+        try:
+            data = os.read( self.fd, 65536 )
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if data:
+            self.output.append( data )
+            return
+        self.closeOutput()
+        self.reap()
+
+    def closeOutput(self):
+        if self.fd is not None:
+            self.loop.removeReader( self.fd )
+            self.p.stdout.close()
+            self.fd = None
+
+    # The command has taken too long: kill it, without waiting for the
+    # end of its output as something it started may still hold it open
+    def expire(self):
+        self.timer = None
+        self.killed = True
+        try:
+            self.p.kill()
+        except OSError:
+            pass
+        self.closeOutput()
+        self.reap()
+
+    def reap(self):
+        if self.p.poll() is None:
+            self.loop.callLater( REAP_INTERVAL, self.reap )
+            return
+        if self.timer is not None:
+            self.loop.cancel( self.timer )
+            self.timer = None
+        if self.killed:
+            self.done( None, "Ticket creation command %s did not finish within %s seconds" % (self.name, self.timeout) )
+            return
+        stdoutdata = ''.join( self.output )
+        logger.debug( "TT Script stdout: %s" % (stdoutdata) )
+        try:
+            ticket = checkTicket( stdoutdata )
+        except TicketError as e:
+            self.done( None, e.errmsg )
+            return
+        self.done( ticket, None )
+
+
+# Backends create tickets in two steps: prepare() runs in the main thread
+# and renders its templates from the TicketData into whatever the
+# backend needs, then create() runs in a worker thread and returns the
+# ticket ID or raises TicketError. close() is called when zentt stops.
+# A backend may also have start(loop, payload, done), which the event
+# loop uses instead of create() to make the ticket without a thread.
+# Each backend class has a fromOptions() class method that builds it from
+# the DAEMONSTUFF options, raising TicketError if something is missing.
+#
+
+# Run ttcommand once for each ticket
+#
+class CommandBackend(object):
+    def __init__(self, ttcommand, tttimeout=DEFAULT_TIMEOUT):
+        self.ttcommand = Template( ttcommand )
+        self.timeout = float(tttimeout)
+
+    def fromOptions(cls, options):
+        if not options.get('ttcommand'):
+            raise TicketError("ttbackend command needs ttcommand to be set")
+        return cls( options['ttcommand'], options.get('tttimeout', DEFAULT_TIMEOUT) )
+    fromOptions = classmethod(fromOptions)
+
+    def prepare(self, data):
+        return self.ttcommand.render( data )
+
+    def create(self, ttargs):
+        logger.debug( "command: %s" % ( str(ttargs) ) )
+        return runTicketCommand( ttargs, self.timeout )
+
+    def start(self, loop, ttargs, done):
+        logger.debug( "command: %s" % ( str(ttargs) ) )
+        try:
+            TicketProcess( loop, ttargs, self.timeout, done )
+        except OSError as e:
+            done( None, "Error while running ticket creation command: %s: %s" % (ttargs[0], e.strerror) )
+
+    def close(self):
+        pass
+
+
+# One running copy of the ticket server command
+#
+class Coprocess(object):
+    def __init__(self, args):
+        self.args = args
+        try:
+            self.p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      close_fds=True)
+        except OSError as e:
+            raise TicketError("Error while starting ticket server %s: %s" % (args[0], e.strerror))
+        logger.info( "Started ticket server, pid %d" % (self.p.pid) )
+
+    # Send one request line and read back one reply line.
+    # The server is killed if it has not replied within timeout seconds.
+    def request(self, line, timeout=None):
+        killed = None
+        if timeout:
+            timer, killed = killAfter( self.p, timeout )
+        try:
+            try:
+                self.p.stdin.write( line + '\n' )
+                self.p.stdin.flush()
+                reply = self.p.stdout.readline()
+            except (IOError, OSError) as e:
+                raise TicketError("Lost contact with ticket server: %s" % (e))
+        finally:
+            if timeout:
+                timer.cancel()
+        if killed:
+            raise TicketError("Ticket server %s did not reply within %s seconds" % (self.args[0], timeout))
+        if not reply:
+            raise TicketError("Ticket server exited (status %s)" % (self.p.poll()))
+        return reply
+
+    def close(self):
+        try:
+            self.p.stdin.close()
+            self.p.wait()
+        except (IOError, OSError):
+            pass
+
+
+# Keep the ticket server command (ttserver) running and send it one line
+# per ticket: the ttrequest template with substitutions done, as
+# shell-quoted words. The server replies with one line holding the
+# ticket ID. A separate server is run for each distinct ttserver command
+# (e.g. when sections use different hosts) and for each ticket that is
+# in progress at the same time.
+#
+class CoprocessBackend(object):
+    def __init__(self, ttserver, ttrequest, tttimeout=DEFAULT_TIMEOUT):
+        self.ttserver = Template( ttserver )
+        self.ttrequest = Template( ttrequest )
+        self.timeout = float(tttimeout)
+        self.lock = threading.Lock()
+        # server args -> list of idle Coprocesses
+        self.idle = {}
+
+    def fromOptions(cls, options):
+        if not options.get('ttserver') or not options.get('ttrequest'):
+            raise TicketError("ttbackend coprocess needs both ttserver and ttrequest to be set")
+        return cls( options['ttserver'], options['ttrequest'], options.get('tttimeout', DEFAULT_TIMEOUT) )
+    fromOptions = classmethod(fromOptions)
+
+    def prepare(self, data):
+        server = tuple( self.ttserver.render( data ) )
+        words = self.ttrequest.render( data )
+        # Requests are one line each, so no newlines can be sent
+        line = ' '.join([ pipes.quote( re.sub(r'[\r\n]+', ' ', word) ) for word in words ])
+        return (server, line)
+
+    def create(self, payload):
+        server, line = payload
+        # Requests read back from the outbox have the server as a list
+        server = tuple(server)
+        logger.debug( "request: %s" % (line) )
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(server, [])
+            if idle:
+                proc = idle.pop()
+            else:
+                proc = None
+        finally:
+            self.lock.release()
+        if proc is None:
+            proc = Coprocess( list(server) )
+
+        try:
+            reply = proc.request( line, self.timeout )
+        except TicketError:
+            # Do not reuse a server that has gone wrong
+            proc.close()
+            raise
+
+        self.lock.acquire()
+        try:
+            self.idle[server].append(proc)
+        finally:
+            self.lock.release()
+        return checkTicket( reply )
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for procs in self.idle.values():
+                for proc in procs:
+                    proc.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+
+# Split a template of 'Name=value' words into a list of
+# (name, Template) pairs, so that only the values are substituted
+#
+def namedTemplates( text ):
+    result = []
+    for word in shlex.split( text or '' ):
+        if '=' not in word:
+            raise TicketError("Expected Name=value but found %s" % (word))
+        name, value = word.split('=', 1)
+        result.append( (name, Template( pipes.quote(value) )) )
+    return result
+
+# Render a list of (name, Template) pairs into a dictionary
+#
+def renderNamed( templates, data ):
+    result = {}
+    for name, template in templates:
+        result[name] = ''.join( template.render( data ) )
+    return result
+
+
+# Does an error sending a request on a kept-alive connection show that
+# the server closed it before reading the request? That is the case if
+# writing failed, or the connection was closed or reset before any of
+# the reply arrived. A timeout does not count: the server may have got
+# the request and be slow to answer it.
+#
+def neverProcessed( e ):
+    if isinstance(e, httplib.BadStatusLine):
+        # Older versions of httplib give the empty line, newer ones say so
+        return e.line in ('', "''") or e.line.startswith('No status line received')
+    if isinstance(e, socket.timeout):
+        return False
+    return isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+# POST each ticket as a JSON object to a web service and read the ticket
+# ID from the JSON reply. Options:
+#   tturl:       URL to send tickets to (may use %var% substitutions)
+#   ttfields:    the ticket fields, as 'Name=value' words
+#   ttheaders:   extra HTTP headers, as 'Name=value' words
+#   ttuser, ttpassword: HTTP basic authentication
+#   ttidfield:   field of the reply holding the ticket ID (default 'id')
+#   tttimeout:   seconds to wait for the service (default DEFAULT_TIMEOUT)
+# Connections are kept open and reused, one per ticket in progress.
+#
+class HttpBackend(object):
+    def __init__(self, tturl, ttfields, ttheaders='', ttuser=None, ttpassword=None,
+                 ttidfield='id', tttimeout=DEFAULT_TIMEOUT):
+        self.tturl = Template( pipes.quote(tturl) )
+        self.ttfields = namedTemplates( ttfields )
+        self.headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        for name, template in namedTemplates( ttheaders ):
+            self.headers[name] = ''.join( template.render( {} ) )
+        if ttuser:
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode( '%s:%s' % (ttuser, ttpassword or '') )
+        self.idfield = ttidfield
+        self.timeout = float(tttimeout)
+        self.lock = threading.Lock()
+        # (scheme, host, port) -> list of idle connections
+        self.idle = {}
+
+    def fromOptions(cls, options):
+        if not options.get('tturl'):
+            raise TicketError("ttbackend http needs tturl to be set")
+        return cls( options['tturl'], options.get('ttfields', ''), options.get('ttheaders', ''),
+                    options.get('ttuser'), options.get('ttpassword'),
+                    options.get('ttidfield', 'id'), options.get('tttimeout', DEFAULT_TIMEOUT) )
+    fromOptions = classmethod(fromOptions)
+
+    def prepare(self, data):
+        url = ''.join( self.tturl.render( data ) )
+        body = json.dumps( renderNamed( self.ttfields, data ) )
+        return (url, body)
+
+    # An idle connection if there is one (unless fresh is set), else a new one.
+    # Returns (connection, whether it was reused).
+    def connect(self, key, fresh=False):
+        if not fresh:
+            self.lock.acquire()
+            try:
+                idle = self.idle.get(key)
+                if idle:
+                    return idle.pop(), True
+            finally:
+                self.lock.release()
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, key, conn):
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(key, []).append(conn)
+        finally:
+            self.lock.release()
+
+    # Send the request on a pooled connection and return (status, reply body)
+    def send(self, url, body):
+        parts = urlparse.urlsplit( url )
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn, reused = self.connect( key )
+        try:
+            response = self.post( conn, path, body )
+        except (httplib.HTTPException, IOError) as e:
+            conn.close()
+            # A kept-alive connection may have been closed by the server
+            # while it was idle. Only then, when the server cannot have
+            # acted on the ticket, is it sent once more on a new connection.
+            if not (reused and neverProcessed(e)):
+                raise TicketError("Error while sending ticket to %s: %s" % (url, e))
+            conn, reused = self.connect( key, fresh=True )
+            try:
+                response = self.post( conn, path, body )
+            except (httplib.HTTPException, IOError) as e:
+                conn.close()
+                raise TicketError("Error while sending ticket to %s: %s" % (url, e))
+        # Once the reply has started the ticket may have been made, so a
+        # failure reading it is never retried
+        try:
+            reply = response.read()
+        except (httplib.HTTPException, IOError) as e:
+            conn.close()
+            raise TicketError("Error while reading reply from %s: %s" % (url, e))
+        if (response.getheader('connection') or '').lower() == 'close':
+            conn.close()
+        else:
+            self.release( key, conn )
+        return response.status, reply
+
+    def post(self, conn, path, body):
+        conn.request('POST', path, body, self.headers)
+        return conn.getresponse()
+
+    def create(self, payload):
+        url, body = payload
+        logger.debug( "POST %s: %s" % (url, body) )
+        status, reply = self.send( url, body )
+        if status < 200 or status > 299:
+            raise TicketError("Ticket service %s returned HTTP status %d" % (url, status))
+        try:
+            ticket = json.loads( reply )
+            if isinstance(ticket, dict):
+                ticket = ticket.get( self.idfield, '' )
+            ticket = str(ticket)
+        except ValueError:
+            ticket = reply
+        return checkTicket( ticket )
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+
+# The built-in backends, by ttbackend name
+BACKENDS = {
+    'command': CommandBackend,
+    'coprocess': CoprocessBackend,
+    'http': HttpBackend,
+}
+
+# Make another backend class available under a ttbackend name
+#
+def registerBackend( name, cls ):
+    BACKENDS[name.lower()] = cls
+
+# Find the backend class for a ttbackend name. Besides the registered
+# names, 'package.module.ClassName' loads a plugin class.
+#
+def backendClass( name ):
+    cls = BACKENDS.get( name.lower() )
+    if cls is not None:
+        return cls
+    if '.' not in name:
+        raise TicketError("Unknown ttbackend %s" % (name))
+    modname, clsname = name.rsplit('.', 1)
+    try:
+        module = __import__( modname, globals(), locals(), [clsname] )
+        return getattr( module, clsname )
+    except (ImportError, AttributeError) as e:
+        raise TicketError("Cannot load ttbackend %s: %s" % (name, e))
+
+
+# The backends used by a rule set: the DAEMONSTUFF 'ttbackend' (default
+# 'command') plus any that sections choose with their own 'ttbackend'
+# option. All are built from the DAEMONSTUFF options when zentt starts.
+#
+class BackendSet(object):
+    def __init__(self, rules):
+        self.default = rules.option('ttbackend', 'command')
+        self.backends = {}
+        names = [self.default] + [ rule.backend for rule in rules.sections if rule.backend ]
+        for name in names:
+            if name not in self.backends:
+                cls = backendClass( name )
+                try:
+                    self.backends[name] = cls.fromOptions( rules.daemonOptions )
+                except TicketError:
+                    self.close()
+                    raise
+                except Exception as e:
+                    # Most likely a plugin backend that does not like its options
+                    self.close()
+                    raise TicketError("Cannot set up ttbackend %s: %s" % (name, e))
+
+    # The backend that creates tickets for a section
+    def forRule(self, rule):
+        return self.backends[ rule.backend or self.default ]
+
+    # Backends by ttbackend name, for requests kept in the outbox
+    def get(self, name):
+        return self.backends[ name ]
+
+    def nameOf(self, backend):
+        for name, b in self.backends.items():
+            if b is backend:
+                return name
+        raise KeyError(backend)
+
+    def close(self):
+        for backend in self.backends.values():
+            backend.close()
+
+
+# The tickets to be created for one event: a list of
+# (section, backend, prepared request) in section order. Without
+# multi-ticket the sections are tried in turn until one ticket has been
+# created.
+#
+class TicketJob(object):
+    def __init__(self, evt, requests, multiTicket):
+        self.evt = evt
+        self.requests = requests
+        self.multiTicket = multiTicket
+        # True if these requests are being retried from the outbox
+        self.retry = False
+        # List of (section, ticket ID or None, error message or None)
+        self.results = []
+        # Seconds taken by each attempt to create a ticket
+        self.latencies = []
+        # Requests not tried because their backend's circuit breaker is open
+        self.held = []
+        # Index of the next request, and whether there is no more to do
+        self.next = 0
+        self.done = False
+
+    # The next request to try, with its backend's breaker (or None), or
+    # None when the job is finished. breakers is a BreakerSet or None.
+    # Requests for a backend out of use are held on the way. Without
+    # multi-ticket a held request ends the job, as the later sections
+    # are only meant to be tried if its ticket fails.
+    def nextRequest(self, breakers=None):
+        while not self.done and self.next < len(self.requests):
+            request = self.requests[self.next]
+            self.next += 1
+            breaker = None
+            if breakers is not None:
+                breaker = breakers.forBackend( request[1] )
+            if breaker is not None and not breaker.allow():
+                self.held.append( request )
+                if not self.multiTicket:
+                    self.done = True
+                continue
+            return request, breaker
+        self.done = True
+        return None
+
+    # Record one attempt: the ticket ID, or None and the error message
+    def attempted(self, request, breaker, ticket, errmsg, seconds):
+        self.latencies.append( seconds )
+        self.results.append( (request[0], ticket, errmsg) )
+        if ticket is None:
+            if breaker is not None:
+                breaker.failed()
+            return
+        if breaker is not None:
+            breaker.succeeded()
+        if not self.multiTicket:
+            # We have created one ticket for this event.
+            # Do not consider any more sections
+            self.done = True
+
+    # Create the tickets, one after another
+    def run(self, breakers=None):
+        while True:
+            step = self.nextRequest( breakers )
+            if step is None:
+                return
+            request, breaker = step
+            start = time.time()
+            try:
+                ticket = request[1].create( request[2] )
+            except TicketError as e:
+                self.attempted( request, breaker, None, e.errmsg, time.time() - start )
+                continue
+            self.attempted( request, breaker, ticket, None, time.time() - start )
+
+
+# A fixed number of worker threads running TicketJobs.
+# Jobs are submitted and their results collected by the main thread only.
+# If breakers (a BreakerSet) is given the jobs check it before each ticket.
+#
+class TicketPool(object):
+    def __init__(self, size=DEFAULT_CONCURRENCY, breakers=None):
+        self.size = max(1, size)
+        self.breakers = breakers
+        self.todo = Queue.Queue()
+        self.done = Queue.Queue()
+        # evids of events whose jobs have not been collected yet
+        self.inFlight = set()
+        self.workers = []
+        for n in range(self.size):
+            t = threading.Thread(target=self.work, name='zentt-ticket-%d' % (n))
+            t.setDaemon(True)
+            t.start()
+            self.workers.append(t)
+
+    def work(self):
+        while True:
+            job = self.todo.get()
+            if job is None:
+                return
+            try:
+                job.run( self.breakers )
+            except Exception as e:
+                logger.exception("Unexpected error creating tickets for %s" % (job.evt.evid))
+                job.results.append( (None, None, str(e)) )
+            self.done.put(job)
+
+    def submit(self, job):
+        self.inFlight.add(job.evt.evid)
+        self.todo.put(job)
+
+    def isBusy(self, evid):
+        return evid in self.inFlight
+
+    # Jobs that have finished, without waiting for any others
+    def completed(self):
+        while True:
+            try:
+                job = self.done.get_nowait()
+            except Queue.Empty:
+                return
+            self.inFlight.discard(job.evt.evid)
+            yield job
+
+    # All outstanding jobs, waiting for them to finish
+    def wait(self):
+        while self.inFlight:
+            # Wake up now and then so that signals are seen while we wait
+            try:
+                job = self.done.get(True, 1.0)
+            except Queue.Empty:
+                continue
+            self.inFlight.discard(job.evt.evid)
+            yield job
+
+    # Drop the jobs that no worker has started yet
+    def cancel(self):
+        while True:
+            try:
+                job = self.todo.get_nowait()
+            except Queue.Empty:
+                return
+            if job is not None:
+                self.inFlight.discard(job.evt.evid)
+
+    # Stop the workers once the queued jobs are done
+    def stop(self):
+        for t in self.workers:
+            self.todo.put(None)
+        for t in self.workers:
+            t.join(5)
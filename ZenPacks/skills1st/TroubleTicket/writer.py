@@ -0,0 +1,132 @@
+# Author:		Jane Curry and Andrew Findlay
+# Copyright:		Skills 1st Ltd
+# Description:		Grouped writes to the Zenoss event status table.
+#			Acknowledgements, ownerid changes and AUTOCLEAR deletions are
+#			collected during a cycle and written with a few statements
+#			covering many events, rather than several single-row
+#			statements per event.
+#
+# Updates:
+#
+
+import time, logging
+from MySQLdb import OperationalError
+from Products.ZenEvents.Exceptions import ZenEventNotFound
+from events import sqlQuote, evidList
+
+logger = logging.getLogger('ZenTT')
+
+# MySQL errors that mean "try again later" (lock wait timeout, deadlock,
+# etc.) rather than anything being wrong with the statement itself
+IGNORED_DB_ERRORS = (1205, 1213, 1422, 1206, 2002)
+
+# Added to the summary of each event deleted because it matches AUTOCLEAR
+AUTOCLEAR_TAG = ' auto-cleared by zenTT '
+
+# Largest number of events held before the writes are flushed early
+DEFAULT_WRITEBATCH = 500
+
+# Is this a database error that we can safely ignore?
+#
+def ignorable( err ):
+    return err[0] in IGNORED_DB_ERRORS
+
+
+class StatusWriter(object):
+    def __init__(self, zem, writebatch=DEFAULT_WRITEBATCH):
+        self.zem = zem
+        self.writebatch = writebatch
+        # evid -> ticket ID for events that need acking
+        self.created = {}
+        # evids of events where ticket creation failed
+        self.failed = set()
+        # evids of events to be auto-cleared
+        self.cleared = set()
+        # Number of events auto-cleared since the count was last reset
+        self.nCleared = 0
+        # Seconds spent writing to the database since last reset
+        self.writeTime = 0.0
+
+    # Is there a write pending for this event?
+    def isPending(self, evid):
+        return (evid in self.created) or (evid in self.failed) or (evid in self.cleared)
+
+    def pending(self):
+        return len(self.created) + len(self.failed) + len(self.cleared)
+
+    # A ticket has been created: ack the event and set its ownerid
+    def ticketCreated(self, evid, ticket):
+        self.created[evid] = ticket
+        self.failed.discard(evid)
+        self.checkSize()
+
+    # Ticket creation failed: mark the event so that people can see
+    def ticketFailed(self, evid):
+        if evid not in self.created:
+            self.failed.add(evid)
+        self.checkSize()
+
+    # The event matches AUTOCLEAR: tag its summary and delete it
+    def clearEvent(self, evid):
+        self.cleared.add(evid)
+        self.checkSize()
+
+    def checkSize(self):
+        if self.pending() >= self.writebatch:
+            self.flush()
+
+    # Run one grouped statement, ignoring the transient database errors.
+    # Returns True if the writes were done and can be forgotten.
+    def run(self, what, method, *args):
+        start = time.time()
+        try:
+            try:
+                method(*args)
+            except OperationalError as err:
+                if not ignorable(err):
+                    raise
+                logger.warning("Database busy while writing %s - will retry: %s" % (what, err))
+                return False
+            except ZenEventNotFound:
+                pass
+        finally:
+            self.writeTime += time.time() - start
+        return True
+
+    # Write everything that is pending
+    def flush(self):
+        if self.created:
+            evids = sorted(self.created.keys())
+            if self.run('acknowledgements', self.zem.manage_setEventStates, 1, evids):
+                cases = ' '.join([ "WHEN %s THEN %s" % (sqlQuote(evid), sqlQuote('Ticket ' + self.created[evid]))
+                                   for evid in evids ])
+                update = "update status set ownerid = CASE evid %s END" % (cases)
+                whereClause = "where evid in %s" % (evidList(evids))
+                reason = 'Trouble Ticket created'
+                # If this fails the next flush acks the events again, which is harmless
+                if self.run('ticket owners', self.zem.updateEvents, update, whereClause, reason):
+                    self.created = {}
+
+        if self.failed:
+            evids = sorted(self.failed)
+            update = "update status set ownerid='Ticket FAILED'"
+            whereClause = "where evid in %s" % (evidList(evids))
+            reason = 'Ticket creation failed'
+            if self.run('ticket failures', self.zem.updateEvents, update, whereClause, reason):
+                self.failed = set()
+
+        if self.cleared:
+            evids = sorted(self.cleared)
+            # Keep each statement to a sensible size
+            for start in range(0, len(evids), self.writebatch):
+                chunk = evids[start:start+self.writebatch]
+                update = "update status set summary = CONCAT(summary, %s)" % (sqlQuote(AUTOCLEAR_TAG))
+                # A summary already tagged by an earlier flush whose delete
+                # failed is not tagged again
+                whereClause = "where evid in %s and summary not like %s" % (evidList(chunk), sqlQuote('%' + AUTOCLEAR_TAG))
+                reason = 'Event matches AUTOCLEAR criteria'
+                if not self.run('auto-cleared summaries', self.zem.updateEvents, update, whereClause, reason):
+                    continue
+                if self.run('auto-cleared events', self.zem.manage_deleteEvents, chunk):
+                    self.cleared.difference_update(chunk)
+                    self.nCleared += len(chunk)
@@ -11,6 +11,18 @@
 
 # Perform initial imports.
 from daemon import Daemon
+from rules import RuleError
+from settings import DaemonConfig, reloadConfig
+from events import fetchDetails
+from tickets import TicketError, TicketPool
+from engine import TicketEngine
+from eventloop import EventLoop, LoopDriver
+from scheduler import CycleScheduler
+from stats import readStats, formatStats
+from explain import explainEvent, readProfile, formatProfile
+from lint import lintConfig, formatLint, hasErrors
+from shards import ShardSupervisor, shardName, shardPidfile, readPid, pidRunning, workerStatus, \
+     SUPERVISE_INTERVAL, STALL_CYCLES
 import os, sys
 import logging
 # Zenoss imports
@@ -19,16 +31,17 @@ import logging
 # Perform Zenoss specific imports.
 import Globals
 from Products.ZenUtils.ZenScriptBase import ZenScriptBase
-from Products.ZenEvents.Exceptions import ZenEventNotFound
 from transaction import commit
 from Products.ZenUtils import Time
-from MySQLdb import OperationalError
-import time, socket, re, subprocess, shlex, ConfigParser, datetime
+import time, socket, re, ConfigParser, datetime, signal
 
 # Discover paths to files.
 pidfile = os.path.join(os.environ['ZENHOME'], 'var/zentt-localhost.pid')
 zenconfpath = os.path.join(os.environ['ZENHOME'], 'etc/zentt.conf')
 logfile = os.path.join(os.environ['ZENHOME'], 'log/zentt.log')
+vardir = os.path.join(os.environ['ZENHOME'], 'var')
+statsfile = os.path.join(os.environ['ZENHOME'], 'var/zentt-stats.json')
+profilefile = os.path.join(os.environ['ZENHOME'], 'var/zentt-profile.json')
 
 # Configure logging.
 
@@ -49,536 +62,227 @@ fh.setFormatter(logFormatter)
 # add the handler to the logger
 logger.addHandler(fh)
 
-# Exception class for failure to create tickets
-#
-class TicketError(Exception):
-    def __init__(self, errmsg):
-        self.errmsg = errmsg
-
-# Match a list of strings against the list of regexes or literal strings in a specific config section
-# e.g. to find whether a device group is of interest
-# If no options in the section match the supplied prefix, return the supplied default value
-#
-def configREMatch( config, s, prefix, list, default ):
-    seen = 0
-    # Compare against all '^<prefix>.*' strings in this config section
-    # First build a pattern to match the options we are interested in
-    optpattern = re.compile( prefix+'-(re-)?', re.IGNORECASE )
-    for opt in config.options(s):
-	# Ignore config options that do not have the prefix of interest
-	m = optpattern.match(opt)
-	if not m: continue
-	# Note that we have seen at least one matching option
-	seen = 1
-	# Is this a regex match item? (name has -re)
-	suffix = m.group(1)
-	if suffix and (suffix.lower() == 're-'):
-	    # The option value should be treated as a regex
-	    pattern = re.compile( config.get(s, opt).rstrip(), re.IGNORECASE )
-	    # Is there a match for that pattern in the supplied list?
-	    for item in list:
-		if pattern.search( item ):
-		    return True;
-	else:
-	    # Is the exact option value in the supplied list?
-	    for item in list:
-		if config.get(s, opt).rstrip().lower() == item.lower():
-		    return True;
-    if seen:
-	# We saw at least one matching option and none of their values matched the list
-        return False
-    else:
-	# We did not see any matching options
-        return default
-
-# Get an integer option value from the config
-#
-def getIntOptValue( config, s, opt ):
-    value = config.get(s, opt).rstrip()
-    if not re.search( '^[-+]?[0-9]+$', value ):
-	logger.error("Option %s in section %s has a non-integer value: %s" % (opt, s, value))
-	return 0
-    return int(value)
-
-# Match an integer against a range specified by -min and -max options
-# or against a list of acceptable values.
-# If the section specifies a range and also a list of values, any
-# values outside the range will not be matched.
-#
-def configIntMatch( config, s, prefix, value ):
-    # First build a pattern to match the options we are interested in
-    optpattern = re.compile( prefix+'-(.+)', re.IGNORECASE )
-    # Assume the value is in range until proved otherwise
-    inrange = 1
-    # Assume the value is not in the list until proved otherwise
-    inlist = 0
-    # We have not yet seen a range spec
-    seenrange = 0
-    # We have not yet seen a list spec
-    seenlist = 0
-
-    # Walk through ALL the options
-    for opt in config.options(s):
-	# Ignore config options that do not have the prefix of interest
-	m = optpattern.match(opt)
-	if not m: continue
-
-	optvalue = getIntOptValue( config, s, opt )
-	suffix = m.group(1)
-
-	# Is this a -min option?
-	if suffix and (suffix.lower() == 'min'):
-	    seenrange = 1
-	    if value < optvalue:
-	        inrange = 0
-	    continue
-
-	# Is this a -man option?
-	if suffix and (suffix.lower() == 'max'):
-	    seenrange = 1
-	    if value > optvalue:
-	        inrange = 0
-	    continue
-
-        # All other options are assumed to be list values
-	seenlist = 1
-	if value == optvalue:
-	    inlist = 1
-
-    # Right, now we need to sort out the result!
-    # If we have a range spec then the value must comply
-    if seenrange and not inrange: return 0
-    # If we have a list spec then the value must comply
-    if seenlist and not inlist: return 0
-    # Default case
-    return 1
-
-# Filter code to select events that match in a section
-def selectEvent( config, s, evt ):
-    # Does the event have a group that this section is interested in?
-    if not configREMatch( config, s, 'devicegroups', evt.DeviceGroups.split('|'), True ):
-	logger.debug( "devicegroup match fails" )
-	return 0
-
-    # Does the event have a devicegroup that this section wants to avoid?
-    if configREMatch( config, s, 'notdevicegroups', evt.DeviceGroups.split('|'), False ):
-	logger.debug( "notdevicegroup match fails" )
-	return 0
-
-    # Does the event have a device that this section is interested in?
-    if not configREMatch( config, s, 'device', [evt.device], True ):
-	logger.debug( "device match fails" )
-	return 0
-
-    # Does the event have a device that this section wants to avoid?
-    if configREMatch( config, s, 'notdevice', [evt.device], False ):
-	logger.debug( "notdevice match fails" )
-	return 0
-
-    # Does the event have a device class that this section is interested in?
-    if not configREMatch( config, s, 'deviceclass', [evt.DeviceClass], True ):
-	logger.debug( "deviceclass match fails" )
-	return 0
-
-    # Does the event have a device class that this section wants to avoid?
-    if configREMatch( config, s, 'notdeviceclass', [evt.DeviceClass], False ):
-	logger.debug( "notdeviceclass match fails" )
-	return 0
-
-    # Check the production state
-    if not configIntMatch( config, s, 'prodstate', evt.prodState ):
-	logger.debug( "prodstate match fails" )
-	return 0
-
-    # Check the eventState
-    if not configIntMatch( config, s, 'eventstate', evt.eventState ):
-	logger.debug( "eventstate match fails" )
-	return 0
-
-    # Check the severity
-    if not configIntMatch( config, s, 'severity', evt.severity ):
-	logger.debug( "severity match fails" )
-	return 0
-
-    # Does the event have a summary that this section is interested in?
-    if not configREMatch( config, s, 'summary', [evt.summary], True ):
-	logger.debug( "summary match fails" )
-	return 0
-
-    # Does the event have a summary that this section wants to avoid?
-    if configREMatch( config, s, 'notsummary', [evt.summary], False ):
-	logger.debug( "notsummary match fails" )
-	return 0
-
-    # Does the event have a message that this section is interested in?
-    if not configREMatch( config, s, 'message', [evt.message], True ):
-	logger.debug( "message match fails" )
-	return 0
-
-    # Does the event have a message that this section wants to avoid?
-    if configREMatch( config, s, 'notmessage', [evt.message], False ):
-	logger.debug( "notmessage match fails" )
-	return 0
-
-    # Does the event have a component that this section is interested in?
-    if not configREMatch( config, s, 'component', [evt.component], True ):
-	logger.debug( "component match fails" )
-	return 0
-
-    # Does the event have a component that this section wants to avoid?
-    if configREMatch( config, s, 'notcomponent', [evt.component], False ):
-	logger.debug( "notcomponent match fails" )
-	return 0
-
-    # Does the event have a location that this section is interested in?
-    if not configREMatch( config, s, 'location', [evt.Location], True ):
-	logger.debug( "location match fails" )
-	return 0
-
-    # Does the event have a location that this section wants to avoid?
-    if configREMatch( config, s, 'notlocation', [evt.Location], False ):
-	logger.debug( "notlocation match fails" )
-	return 0
-
-    # Does the event have a systems organiser that this section is interested in?
-    if not configREMatch( config, s, 'systems', evt.Systems.split('|'), True ):
-	logger.debug( "systems match fails" )
-	return 0
-
-    # Does the event have a systems organiser that this section wants to avoid?
-    if configREMatch( config, s, 'notsystems', evt.Systems.split('|'), False ):
-	logger.debug( "notsystems match fails" )
-	return 0
-
-    # Does the event have an ipaddress that this section is interested in?
-    if not configREMatch( config, s, 'ipaddress', [evt.ipAddress], True ):
-	logger.debug( "ipaddress match fails" )
-	return 0
-
-    # Does the event have an ipaddress that this section wants to avoid?
-    if configREMatch( config, s, 'notipaddress', [evt.ipAddress], False ):
-	logger.debug( "notipaddress match fails" )
-	return 0
-
-    # We want this one!
-    return 1
-
-
-# Function to analyse an event and possibly create a troubleticket
-def analyseEvent( config, dmd, evt ):
-    logger.debug( "analyseEvent" )
-
-    # Configure initial variables for ticket create routine.
-    ticket = None
-    p = None
-    ticketerror = 0
-    ntickets = 0
-
-    # We are only interested in new events
-    if evt.eventState != 0:
-        return 0
-
-    # Do we want to allow the creation of multiple tickets for a single event?
-    multiTicket = 0
-    if config.has_option("DAEMONSTUFF", "multi-ticket"):
-	multiTicket = config.get("DAEMONSTUFF", "multi-ticket")
-	if ((multiTicket == '1') or (multiTicket.lower() == 'yes')):
-	    multiTicket = 1
-	else:
-	    multiTicket = 0
-    logger.debug( "multiTicket: %d", multiTicket )
-
-    # Log a warning if a device does not belong to any groups.
-    if not evt.DeviceGroups.replace('|',''):
-	logger.warning("Device %s is not in a device group in event %s" % (evt.device, evt.evid))
-
-    # Consider each section in the config file in turn
-    # Do this in alphabetical order, ignoring case
-    for s in sorted(config.sections(), key=str.lower):
+# The files written by the running daemon with the given suffix, e.g.
+# '-stats.json': one for each worker in sharded mode
+def daemonFiles( suffix ):
+    try:
+        config = DaemonConfig( zenconfpath )
+    except (RuleError, TicketError):
+        return [ os.path.join(vardir, 'zentt' + suffix) ]
+    config.backends.close()
+    if config.shards > 1:
+        return [ os.path.join(vardir, shardName(n) + suffix) for n in range(config.shards) ]
+    return [ os.path.join(vardir, 'zentt' + suffix) ]
+
+# Print what 'zentt lint' finds in a config file and exit,
+# with status 1 if the file has errors
+def lintCommand( path ):
+    config = ConfigParser.ConfigParser()
+    try:
+        if not config.read( path ):
+            print 'Cannot read %s' % (path)
+            sys.exit(1)
+    except ConfigParser.Error as e:
+        print 'Cannot use %s: %s' % (path, e)
+        sys.exit(1)
+    # Measured times from the running daemon, if it is profiling this file
+    profile = None
+    if path == zenconfpath:
         try:
-	    if ((s == 'DAEMONSTUFF') or (s == 'AUTOCLEAR')):
-		# Ignore the main daemon config section and the history matching section
-		# (DEFAULT is automatically skipped)
-		continue
-
-	    logger.debug( "## Section %s" % (s) )
-
-	    # Compare event against filters - do we want it?
-	    if not selectEvent( config, s, evt ):
-		continue
-
-	    logger.debug( "creating ticket" )
-
-	    # OK - we need to create a ticket, so grab the command-line template
-	    ttcommand = config.get("DAEMONSTUFF", "ttcommand")
-	    # Parse that into a list of args
-	    ttargs = shlex.split( ttcommand )
-
-	    # Prepare a dictionary with all the things we might want to substitute
-	    data = {}
-	    # Start by loading in all of the DAEMONSTUFF options
-	    for opt in config.options('DAEMONSTUFF'):
-		data['%'+opt+'%'] = config.get('DAEMONSTUFF', opt).rstrip()
-	    # Next load in the 'param-*' options from the current section
-	    # (this may override some existing values)
-	    optpattern = re.compile( 'param-', re.IGNORECASE )
-	    for opt in config.options(s):
-		# Ignore config options that do not have the prefix of interest
-		m = optpattern.match(opt)
-		if not m: continue
-		# Load the value
-		data['%'+opt+'%'] = config.get(s, opt).rstrip()
-	    # Now load in data from the event
-	    data['%evid%'] = str(evt.evid)
-	    data['%device%'] = str(evt.device)
-	    data['%component%'] = str(evt.component)
-	    data['%eventclass%'] = str(evt.eventClass)
-	    data['%eventkey%'] = str(evt.eventKey)
-	    data['%summary%'] = str(evt.summary)
-	    data['%message%'] = str(evt.message)
-	    data['%severity%'] = str(evt.severity)
-	    data['%eventstate%'] = str(evt.eventState)
-	    data['%eventclasskey%'] = str(evt.eventClassKey)
-	    data['%eventgroup%'] = str(evt.eventGroup).lstrip('|')
-	    data['%statechange%'] = str(evt.stateChange)
-	    data['%firsttime%'] = str(evt.firstTime)
-	    data['%lasttime%'] = str(evt.lastTime)
-	    data['%count%'] = str(evt.count)
-	    data['%prodstate%'] = str(evt.prodState)
-	    data['%suppid%'] = str(evt.suppid)
-	    data['%manager%'] = str(evt.manager)
-	    data['%agent%'] = str(evt.agent)
-	    data['%deviceclass%'] = str(evt.DeviceClass)
-	    data['%location%'] = str(evt.Location)
-	    data['%systems%'] = str(evt.Systems).lstrip('|')
-	    data['%devicegroups%'] = str(evt.DeviceGroups).lstrip('|')
-	    data['%ipaddress%'] = str(evt.ipAddress)
-	    data['%facility%'] = str(evt.facility)
-	    data['%priority%'] = str(evt.priority)
-	    data['%ntevid%'] = str(evt.ntevid)
-	    data['%ownerid%'] = str(evt.ownerid)
-	    data['%clearid%'] = str(evt.clearid)
-	    data['%devicepriority%'] = str(evt.DevicePriority)
-	    data['%eventclassmapping%'] = str(evt.eventClassMapping)
-
-	    # NOTE:
-	    # May need to convert times to some other format.
-	    # Here is a handy pattern for parsing them...
-	    # pattern = '%Y/%m/%d %H:%M:%S'
-	    # epoch = int(time.mktime(time.strptime(evt.lastTime.split('.')[0], pattern)))
-
-	    # Work through the argument list substituting where we can.
-	    #
-	    for index,arg in enumerate(ttargs):
-		# we have a string in 'arg' which may contain %var% substitution keys
-		# First we must split that string into a list where each %var% is a separate item
-		keypattern = re.compile( r'(%[a-z0-9_-]+%)', re.IGNORECASE )
-		keylist = re.split( keypattern, arg )
-		# Now walk through the list doing the substitutions
-		for index2,arg2 in enumerate(keylist):
-		    if data.has_key(arg2.lower()):
-			keylist[index2] = data[arg2.lower()]
-		# Finally, join all that up again and put it back in the main arg list
-		ttargs[index] = ''.join( keylist )
-
-	    logger.debug( "command: %s" % ( str(ttargs) ) )
-
-	    try:
-		# Run the ticket create script (while passing necessary arguments to it).
-		p = subprocess.Popen(ttargs, stdout=subprocess.PIPE)
-
-		if not p:
-		    raise TicketError("Unable to run ticket creation command %s" % (ttcommand))
-
-		# Let the command run and collect its output
-		(stdoutdata, stderrdata) = p.communicate()
-		logger.debug( "TT Script stdout: %s" % (stdoutdata) )
-		logger.debug( "TT Script stderr: %s" % (stderrdata) )
-
-	    except OSError as e:
-                if e.filename:
-		    raise TicketError("Error while running ticket creation command: %s: %s" % (e.filename, e.strerror))
-                else:
-		    raise TicketError("Error while running ticket creation command: %s" % (e.strerror))
-
-	    # Get the ticket ID
-	    ticket = stdoutdata.rstrip()
-	    # Sanity check
-	    if not re.search( r'[0-9]+', ticket ):
-		raise TicketError("No ticket ID returned from troubleticket system")
-
-	    ntickets += 1
-
-	    logger.info("Ticket %s created for event %s" % (ticket, evt.evid))
-
-	    # If ticket was successfully created, acknowledge the event in Zenoss.
-	    eventlist = [evt.evid]
-	    if evt.eventState == 0:
-		try:
-		    # Ack
-		    dmd.ZenEventManager.manage_setEventStates(1, eventlist)
-
-		    # Update event info
-		    update="update status set ownerid='%s'" % ('Ticket ' + ticket)
-		    whereClause = "where evid = '%s'" % (evt.evid)
-		    reason = 'Trouble Ticket created: ' + ticket
-		    dmd.ZenEventManager.updateEvents(update, whereClause, reason)
-
-		# Ignore certain errors thrown by MySQL and Zenoss.
-		except OperationalError, err:
-		    if err[0] == 1205:
-			pass
-		    elif err[0] == 1213:
-			pass
-		    elif err[0] == 1422:
-			pass
-		    elif err[0] == 1206:
-			pass
-		    elif err[0] == 2002:
-			pass
-		    else:
-			raise
-		except ZenEventNotFound:
-		    pass
-
-	    if not multiTicket:
-	        # We have created one ticket for this event.
-		# Do not consider any more sections
-		break
-
-        except TicketError as e:
-            logger.error( "Ticket creation failed for %s: %s" % (evt.evid, e.errmsg) )
-            ticketerror = 1
-	    # If this event has not errored before, we need to update the message
-	    if 'FAILED' not in evt.ownerid:
-	        try:
-		    update="update status set ownerid='Ticket FAILED'"
-		    whereClause = "where evid = '%s'" % (evt.evid)
-		    reason = 'Ticket creation failed'
-		    dmd.ZenEventManager.updateEvents(update, whereClause, reason)
-
-		# Ignore certain errors thrown by MySQL and Zenoss.
-		except OperationalError, err:
-		    if err[0] == 1205:
-			pass
-		    elif err[0] == 1213:
-			pass
-		    elif err[0] == 1422:
-			pass
-		    elif err[0] == 1206:
-			pass
-		    elif err[0] == 2002:
-			pass
-		    else:
-			raise
-		except ZenEventNotFound:
-		    pass
-
-            continue
-
-    if ticketerror: return -1
-
-    # We did it!
-    return ntickets
+            profile = readProfile( profilefile )
+        except (IOError, ValueError):
+            pass
+    findings, costs = lintConfig( config )
+    for line in formatLint( findings, costs, profile ):
+        print line
+    if hasErrors( findings ):
+        sys.exit(1)
+    sys.exit(0)
 
 
 # Daemon code space begins here.
 class MyDaemon(Daemon):
-    def run(self):
-
-	# Get handle on Zenoss itself
-        dmd = ZenScriptBase(connect=True).dmd
+    reloadRequested = False
+    driver = None
+
+    # SIGHUP handler: the config file is reloaded at the start of the next cycle
+    # (which begins straight away, as the signal ends any sleep)
+    def reload(self, signum, frame):
+        logger.info('Reload of %s requested' % (zenconfpath))
+        self.reloadRequested = True
+        if self.driver is not None:
+            self.driver.loop.callSoon( self.driver.cycleNow )
+
+    # SIGTERM handler: unwind the main loop so that pending writes are flushed.
+    # 'zentt stop' keeps sending SIGTERM until we have gone, so ignore the repeats.
+    def terminate(self, signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        logger.info('zentt shutting down')
+        raise SystemExit(0)
 
-        # Configure logging within daemon code space.
-        for handler in logging.root.handlers[:]:
-            logging.root.removeHandler(handler)
+    def run(self):
 
         logger.info('Start of daemon run self')
-	logger.info('logfile is %s ' % (logfile))
-
-
-        # Read in config file.
-        config = ConfigParser.ConfigParser()
-        config.read([zenconfpath])
-
-        # Gather general config file options in to variables.
-        ttcommand = config.get("DAEMONSTUFF", "ttcommand")
-        cycletime = config.get("DAEMONSTUFF", "cycletime")
-
-        # Run daemon forever.......
-        while True:
-
-	    logger.info( "zentt main loop" )
-
-	    # Keep track of how many tickets we have created
-	    numttcreated = 0
-
-            # Events to create new tickets for.....
-            # Ticket creation cycle begins here.
-            for e in dmd.ZenEventManager.getEventList([], "", "lastTime ASC, firstTime ASC"):
-
-                # Define initial variables for ticket creation cycle.
-                ttcreate = 0
-
-		logger.debug( "#### Event %s" % (e.evid) )
-
-		# Get the event details
-		evt = dmd.ZenEventManager.getEventDetailFromStatusOrHistory(e.evid)
-		if not evt:
-		    logger.warning("Event %s not found" % (e.evid))
-		    continue
-
-		# Create a ticket for all new events that match defined criteria
-		tt = analyseEvent( config, dmd, evt)
-
-		# Update the count of tickets created
-		if tt > 0:
-		    numttcreated = numttcreated + tt
-
-		# No errors, but if no ticket was created then we may want to clear the event
-		if ((tt == 0) and (config.has_section('AUTOCLEAR'))):
-		    # If no ticket was created then consider clearing the event
-		    logger.debug( "Checking AUTOCLEAR" )
-
-		    if selectEvent( config, 'AUTOCLEAR', evt ):
-			logger.debug( "Clearing event %s" % (e.evid) )
+        logger.info('logfile is %s ' % (logfile))
 
-			try:
-			    # Update event info
-			    update="update status set summary='%s'" % (evt.summary + ' auto-cleared by zenTT ')
-			    whereClause = "where evid = '%s'" % (e.evid)
-			    reason = 'Event matches AUTOCLEAR criteria'
 
-			    logger.info( "Clearing event %s: %s" % (e.evid, reason) )
-
-			    dmd.ZenEventManager.updateEvents(update, whereClause, reason)
+        # Read in and compile the config file
+        try:
+            config = DaemonConfig( zenconfpath )
+        except (RuleError, TicketError) as e:
+            logger.error( "Cannot use %s: %s" % (zenconfpath, e.errmsg) )
+            sys.exit(1)
+
+        # With more than one shard this process only looks after the workers
+        if config.shards > 1:
+            config.backends.close()
+            self.supervise( config )
+        else:
+            self.runEngine( config )
+
+    # Run a worker process for each shard, starting again any that die,
+    # until we are stopped. The workers are stopped and started again
+    # if the number of shards is changed.
+    def supervise(self, config):
+        self.supervisorPid = os.getpid()
+        supervisor = ShardSupervisor( config.shards, self.runWorker )
+
+        # Stopping the supervisor stops the workers, once they have
+        # finished their tickets and writes
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGHUP, self.reload)
+
+        logger.info( "Running %d zentt workers" % (config.shards) )
+        try:
+            supervisor.startAll()
+            while True:
+                if self.reloadRequested or config.changed():
+                    requested = self.reloadRequested
+                    self.reloadRequested = False
+                    newconfig = reloadConfig( config )
+                    if newconfig is not config:
+                        newconfig.backends.close()
+                        if newconfig.shards != config.shards:
+                            logger.info( "Changing from %d to %d zentt workers" % (config.shards, newconfig.shards) )
+                            supervisor.stopAll()
+                            supervisor.nshards = newconfig.shards
+                            supervisor.startAll()
+                            requested = False
+                        config = newconfig
+                    # The workers notice a changed file by themselves
+                    if requested:
+                        supervisor.signalAll( signal.SIGHUP )
+                supervisor.check()
+                time.sleep( SUPERVISE_INTERVAL )
+        finally:
+            supervisor.stopAll()
+
+    # The body of a worker process, run by the supervisor in a new process
+    def runWorker(self, shard):
+        # Tell this worker's log lines from the others'
+        workerFormatter = logging.Formatter(fmt='%%(asctime)s %%(levelname)s ZenTT-%d: %%(message)s' % (shard.index + 1),
+                                            datefmt='%Y-%m-%d %H:%M:%S')
+        for handler in logger.handlers:
+            handler.setFormatter(workerFormatter)
+        self.reloadRequested = False
+
+        # Never run two workers for the same shard, e.g. if one was left
+        # behind when an earlier supervisor was killed
+        workerpidfile = shardPidfile( vardir, shard.index )
+        pid = readPid( workerpidfile )
+        if pid and pid != os.getpid() and pidRunning(pid):
+            logger.error( "zentt worker %s is already running as pid %d" % (shard, pid) )
+            sys.exit(1)
+        file(workerpidfile,'w+').write("%s\n" % os.getpid())
 
-			    dmd.ZenEventManager.manage_deleteEvents(e.evid)
+        try:
+            try:
+                config = DaemonConfig( zenconfpath )
+            except (RuleError, TicketError) as e:
+                logger.error( "Cannot use %s: %s" % (zenconfpath, e.errmsg) )
+                sys.exit(1)
+            logger.info( "zentt worker %s starting" % (shard) )
+            self.runEngine( config, shard )
+        finally:
+            os.remove( workerpidfile )
+
+    # Poll for events and create tickets until we are stopped. shard is
+    # the part of the events this process owns, or None if it owns them all.
+    def runEngine(self, config, shard=None):
+
+        # Get handle on Zenoss itself
+        dmd = ZenScriptBase(connect=True).dmd
 
-			# Ignore certain errors thrown by MySQL and Zenoss.
-			except OperationalError, err:
-			    if err[0] == 1205:
-				pass
-			    elif err[0] == 1213:
-				pass
-			    elif err[0] == 1422:
-				pass
-			    elif err[0] == 1206:
-				pass
-			    elif err[0] == 2002:
-				pass
-			    else:
-				raise
-			except ZenEventNotFound:
-			    pass
+        # Configure logging within daemon code space.
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
 
-            # Write activity summary to log file.
-            if numttcreated > 0:
-                    logger.info('Tickets created: %d', numttcreated)
+        # Cycles start at a steady rate, faster while events are arriving
+        scheduler = CycleScheduler( config.cycletime, config.mincycletime, config.maxcycletime )
+
+        # With the event loop, cycles do not wait for their tickets
+        makePool = TicketPool
+        if config.eventloop:
+            self.driver = LoopDriver( EventLoop(), scheduler )
+            makePool = self.driver.makePool
+            logger.info( "zentt running tickets from an event loop" )
+
+        # Everything that is kept from one cycle to the next
+        if shard is None:
+            engine = TicketEngine( dmd.ZenEventManager, config, vardir, makePool=makePool )
+        else:
+            engine = TicketEngine( dmd.ZenEventManager, config, vardir, shardName(shard.index), shard, makePool )
+
+        # Make sure pending writes are not lost when we are stopped,
+        # and reload the config file when asked to
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGHUP, self.reload)
+        # Let database calls carry on through a SIGHUP; sleeps still end early
+        signal.siginterrupt(signal.SIGHUP, False)
 
-            # Sleep for the amount of seconds configured in the cycletime setting before starting the next cycle.
-            logger.debug('End of cycle - sleeping for %s seconds', cycletime)
-            time.sleep(int(cycletime))
+        try:
+            if self.driver is not None:
+                self.driver.run( engine, lambda: self.betweenCycles(engine, scheduler, shard) )
+            else:
+                # Run daemon forever.......
+                while self.betweenCycles( engine, scheduler, shard ):
+                    scheduler.start()
+                    nlooked = engine.runCycle()
+
+                    # Sleep until the next cycle is due. The cycletime setting is the
+                    # time from the start of one cycle to the start of the next.
+                    scheduler.sleep( nlooked )
+        finally:
+            if self.driver is not None:
+                self.driver.stop()
+            engine.close()
+
+    # Run before each cycle. Returns False if zentt should stop.
+    def betweenCycles(self, engine, scheduler, shard):
+
+        logger.info( "zentt main loop" )
+
+        # A worker stops if its supervisor has gone, so that a new
+        # supervisor does not start a second worker for its shard
+        if shard is not None and os.getppid() != self.supervisorPid:
+            logger.error( "zentt supervisor has gone - worker %s stopping" % (shard) )
+            return False
+
+        # Pick up a new config file between cycles. If it is no good we
+        # carry on with the old one.
+        config = engine.config
+        if self.reloadRequested or config.changed():
+            self.reloadRequested = False
+            newconfig = reloadConfig( config )
+            if newconfig is not config:
+                if newconfig.eventloop != config.eventloop:
+                    logger.warning( "The eventloop option only takes effect when zentt is restarted" )
+                # Workers have their shards changed by the supervisor
+                if shard is None and newconfig.shards != config.shards:
+                    logger.warning( "The shards option only takes effect when zentt is restarted" )
+                engine.reconfigure( newconfig )
+                scheduler.configure( newconfig.cycletime, newconfig.mincycletime, newconfig.maxcycletime )
+        return True
 
 # Daemon runtime options are defined here.
 if __name__ == "__main__":
@@ -633,6 +337,52 @@ if __name__ == "__main__":
                         else:
                             print '%s is missing, aborting start.' % (zenconfpath)
 
+                # Option to make a running daemon reload its config file.
+                elif 'reload' == sys.argv[1]:
+                        try:
+                            pf = file(daemon.pidfile,'r')
+                            pid = int(pf.read().strip())
+                            pf.close()
+                        except IOError:
+                            pid = None
+
+                        if not pid:
+                            print 'not running'
+                        else:
+                            try:
+                                os.kill(pid, signal.SIGHUP)
+                                print 'reloading %s' % (zenconfpath)
+                            except OSError:
+                                print 'not running'
+
+                # Option to show the performance figures of the running daemon.
+                # In sharded mode each worker's figures are shown in turn.
+                elif 'stats' == sys.argv[1]:
+                        for path in daemonFiles( '-stats.json' ):
+                            try:
+                                state = readStats( path )
+                            except (IOError, ValueError):
+                                print 'no statistics in %s - is zentt running?' % (path)
+                                sys.exit(1)
+                            for line in formatStats( state ):
+                                print line
+
+                # Option to show where the filters spent their time in the
+                # last cycle, when the profile option is set.
+                elif 'profile' == sys.argv[1]:
+                        for path in daemonFiles( '-profile.json' ):
+                            try:
+                                profile = readProfile( path )
+                            except (IOError, ValueError):
+                                print 'no profile in %s - is the profile option set?' % (path)
+                                sys.exit(1)
+                            for line in formatProfile( profile ):
+                                print line
+
+                # Option to check the config file for mistakes and costly filters.
+                elif 'lint' == sys.argv[1]:
+                        lintCommand( zenconfpath )
+
                 # Option to get daemon status.
                 elif 'status' == sys.argv[1]:
                         try:
@@ -659,6 +409,17 @@ if __name__ == "__main__":
                             else:
                                 print 'not running'
 
+                        # In sharded mode, how each of the workers is getting on
+                        try:
+                            config = DaemonConfig( zenconfpath )
+                        except (RuleError, TicketError):
+                            config = None
+                        if config is not None:
+                            config.backends.close()
+                            if config.shards > 1:
+                                for line in workerStatus( vardir, config.shards, config.maxcycletime * STALL_CYCLES ):
+                                    print line
+
                 # Option to generate XML options to be displayed when clicking on 
                 # "edit config" in the Daemons section of the Zenoss UI.
                 elif 'genxmlconfigs' == sys.argv[1]:
@@ -677,12 +438,33 @@ config%20does%20get%20cleared%20it%20can%20be%20restored%20from%20zentt.conf.bak
 		else:
 
                         # Print valid options if invalid option is specified.
-			print "usage: zentt start|stop|restart|status|genxmlconfigs"
+			print "usage: zentt start|stop|restart|reload|status|stats|profile|lint [file]|genxmlconfigs|explain <evid>"
 			sys.exit(2)
 		sys.exit(0)
 
+        # Option to show what each filter section makes of one event.
+	elif len(sys.argv) == 3 and 'explain' == sys.argv[1]:
+                try:
+                    config = DaemonConfig( zenconfpath )
+                except (RuleError, TicketError) as e:
+                    print 'Cannot use %s: %s' % (zenconfpath, e.errmsg)
+                    sys.exit(1)
+                dmd = ZenScriptBase(connect=True).dmd
+                evt = fetchDetails( dmd.ZenEventManager, [sys.argv[2]] ).get( sys.argv[2] )
+                if evt is None:
+                    print 'Event %s is not in the event status table' % (sys.argv[2])
+                    sys.exit(1)
+                for line in explainEvent( config, evt ):
+                    print line
+                config.backends.close()
+                sys.exit(0)
+
+        # Option to check another config file before it is installed.
+	elif len(sys.argv) == 3 and 'lint' == sys.argv[1]:
+                lintCommand( sys.argv[2] )
+
 	else:
 
                 # Print valid options if invalid option is specified.
-		print "usage: zentt start|stop|restart|status|genxmlconfigs"
+		print "usage: zentt start|stop|restart|reload|status|stats|profile|lint [file]|genxmlconfigs|explain <evid>"
 		sys.exit(2)